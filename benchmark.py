@@ -0,0 +1,245 @@
+"""Microbenchmarks for the bot's storage helpers and hot handlers.
+
+Runs against a throwaway SQLite file per table size and prints JSON, e.g.:
+
+    python benchmark.py --sizes 1000,100000,1000000 --ops 5000 --output bench.json
+
+Each benchmark reports ops/sec plus p50/p99/max latency in milliseconds, so runs can be diffed over time.
+--member-memory N also measures the heap held by a guild of N cached members against LEAN_MEMBER_CACHE.
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import discord
+
+import main
+
+GUILD_ID = 1
+MINIGAMES_CHANNEL_ID = 100
+POPULATE_CHUNK = 100_000
+
+# Minimal stand-ins for the discord.py objects on_message touches
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.bot = False
+        self.mention = f"<@{user_id}>"
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.category_id = None
+
+    async def send(self, *args, **kwargs):
+        return None
+
+class FakeMessage:
+    _ids = 0
+
+    def __init__(self, guild: FakeGuild, channel: FakeChannel, author: FakeUser):
+        FakeMessage._ids += 1
+        self.id = FakeMessage._ids
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.content = "benchmark message"
+        self._state = main.bot._connection
+
+def summarize(samples: list[float], total: float) -> dict:
+    """ops/sec over the whole run plus latency percentiles in milliseconds."""
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "ops": len(samples),
+        "ops_per_sec": round(len(samples) / total, 1),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 4),
+        "p50_ms": round(cuts[49] * 1000, 4),
+        "p99_ms": round(cuts[98] * 1000, 4),
+        "max_ms": round(max(samples) * 1000, 4),
+    }
+
+async def measure(ops: int, operation) -> dict:
+    """Run `operation(i)` sequentially `ops` times and time each call."""
+    samples = []
+    started = time.perf_counter()
+    for i in range(ops):
+        t0 = time.perf_counter()
+        await operation(i)
+        samples.append(time.perf_counter() - t0)
+    return summarize(samples, time.perf_counter() - started)
+
+async def populate(size: int, seed: int):
+    """Fill users and diamonds with `size` members of one guild."""
+    rng = random.Random(seed)
+    for start in range(0, size, POPULATE_CHUNK):
+        user_ids = range(start + 1, min(start + POPULATE_CHUNK, size) + 1)
+        users = [(user_id, GUILD_ID, rng.randint(0, 99), rng.randint(0, 200), rng.randint(0, 5000)) for user_id in user_ids]
+        diamonds = [(GUILD_ID, user_id, rng.randint(100, 100_000), 0) for user_id in user_ids]
+        await main.bot.db.executemany(
+            "INSERT INTO users (user_id, guild_id, xp, level, messages) VALUES (?, ?, ?, ?, ?)", users
+        )
+        await main.bot.db.executemany(
+            "INSERT INTO diamonds (guild_id, user_id, balance, total_earned) VALUES (?, ?, ?, ?)", diamonds
+        )
+
+async def run_size(size: int, ops: int, seed: int, workdir: str) -> dict:
+    rng = random.Random(seed)
+    path = os.path.join(workdir, f"bench-{size}.db")
+    main.bot.db = main.Database(path)
+    await main.bot.db.connect()
+
+    # Fresh in-memory state for every size
+    main.balance_cache = main.BalanceCache()
+    main.xp_aggregator = main.XPAggregator()
+    main.xp_rankings = main.GuildRankings(main.xp_rankings.query, main.xp_rankings.key, main.xp_rankings.overlay)
+    main.diamond_rankings = main.GuildRankings(main.diamond_rankings.query, main.diamond_rankings.key)
+    main.xp_policy = main.XPPolicy()
+
+    try:
+        await main.bot.setup_database()
+        await main.run_migrations()
+        await main.load_channel_config()
+        await main.set_channel_configs(GUILD_ID, {"minigames": MINIGAMES_CHANNEL_ID})
+
+        started = time.perf_counter()
+        await populate(size, seed)
+        populate_seconds = time.perf_counter() - started
+
+        main.event_logger.start()
+        random_user = lambda _: rng.randint(1, size)
+        results = {}
+
+        main.balance_cache = main.BalanceCache()
+        results["get_user_diamonds"] = await measure(ops, lambda i: main.get_user_diamonds(random_user(i), GUILD_ID))
+        results["get_user_diamonds"]["cache_hit_rate"] = round(main.balance_cache.hits / ops, 4)
+
+        async def uncached_balance(i):
+            user_id = random_user(i)
+            main.balance_cache.invalidate(GUILD_ID, user_id)
+            await main.get_user_diamonds(user_id, GUILD_ID)
+        results["get_user_diamonds_uncached"] = await measure(ops, uncached_balance)
+
+        results["add_diamonds"] = await measure(ops, lambda i: main.add_diamonds(random_user(i), GUILD_ID, 100, reason="benchmark"))
+        results["remove_diamonds"] = await measure(ops, lambda i: main.remove_diamonds(random_user(i), GUILD_ID, 1, reason="benchmark"))
+        results["get_channel_config"] = await measure(ops, lambda i: main.get_channel_config(GUILD_ID))
+
+        guild = FakeGuild(GUILD_ID)
+        channel = FakeChannel(200)
+        results["on_message"] = await measure(ops, lambda i: main.on_message(FakeMessage(guild, channel, FakeUser(random_user(i)))))
+        spammer = FakeUser(size + 1)
+        results["on_message_cooldown"] = await measure(ops, lambda i: main.on_message(FakeMessage(guild, channel, spammer)))
+
+        started = time.perf_counter()
+        index = await main.xp_rankings.get(GUILD_ID)
+        load_seconds = time.perf_counter() - started
+        results["leaderboard_page"] = await measure(ops, lambda i: main.get_top_users(
+            GUILD_ID, main.LEADERBOARD_PAGE_SIZE, main.page_start(rng.randint(1, max(1, size // main.LEADERBOARD_PAGE_SIZE)), len(index))
+        ))
+        results["leaderboard_page"]["index_load_seconds"] = round(load_seconds, 3)
+        results["leaderboard_rank"] = await measure(ops, lambda i: asyncio.sleep(0, index.rank(random_user(i))))
+
+        await main.xp_aggregator.flush()
+        await main.diamond_ledger.flush()
+        await main.event_logger.close()
+        return {"size": size, "populate_seconds": round(populate_seconds, 2), "benchmarks": results}
+    finally:
+        await main.bot.db.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+def member_payload(user_id: int) -> dict:
+    return {
+        "user": {"id": str(user_id), "username": f"member{user_id}", "global_name": f"Member {user_id}",
+                 "discriminator": "0", "avatar": f"{user_id:032x}"},
+        "roles": [], "joined_at": "2024-01-01T00:00:00+00:00", "deaf": False, "mute": False, "flags": 0,
+    }
+
+def measure_members(count: int) -> dict:
+    """Heap held by one guild's members: the full gateway cache vs the lean MemberResolver."""
+    state = main.bot._connection
+    results = {"members": count, "member_cache_size": main.MEMBER_CACHE_SIZE}
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    guild = discord.Guild(data={"id": str(GUILD_ID), "name": "benchmark"}, state=state)
+    for user_id in range(1, count + 1):
+        guild._add_member(discord.Member(data=member_payload(user_id), guild=guild, state=state))
+    results["full_cache_mb"] = round((tracemalloc.get_traced_memory()[0] - baseline) / 2**20, 1)
+    del guild
+    state._users.clear()
+    tracemalloc.stop()
+
+    # Lean mode: no chunked members, only the resolver's LRU filled to capacity
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    guild = discord.Guild(data={"id": str(GUILD_ID), "name": "benchmark"}, state=state)
+    resolver = main.MemberResolver(lean=True)
+    for user_id in range(1, count + 1):
+        resolver.touch(discord.Member(data=member_payload(user_id), guild=guild, state=state))
+    results["lean_cache_mb"] = round((tracemalloc.get_traced_memory()[0] - baseline) / 2**20, 1)
+    del guild, resolver
+    state._users.clear()
+    tracemalloc.stop()
+    return results
+
+async def run(args) -> dict:
+    report = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "ops": args.ops,
+        "results": [],
+    }
+    # process_commands compares message authors against the logged-in user
+    main.bot._connection.user = FakeUser(0)
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as workdir:
+        for size in args.sizes:
+            print(f"⏱️ Benchmarking {size:,} users...", file=sys.stderr)
+            report["results"].append(await run_size(size, args.ops, args.seed, workdir))
+    if args.member_memory:
+        print(f"⏱️ Measuring member cache memory for {args.member_memory:,} members...", file=sys.stderr)
+        report["member_memory"] = measure_members(args.member_memory)
+    return report
+
+def parse_sizes(value: str) -> list[int]:
+    sizes = [int(float(size)) for size in value.split(",") if size]
+    if any(size < 1 or size > 10_000_000 for size in sizes):
+        raise argparse.ArgumentTypeError("sizes must be between 1 and 10,000,000")
+    return sizes
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=parse_sizes, default=[1_000, 100_000], help="comma-separated user counts, 1k to 10M (e.g. 1000,1e6)")
+    parser.add_argument("--ops", type=int, default=2_000, help="operations per benchmark")
+    parser.add_argument("--member-memory", type=int, default=0, help="also measure member cache memory for a guild this big (e.g. 500000)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--tmpdir", default=None, help="where the temporary databases go (default: system temp)")
+    parser.add_argument("--output", default=None, help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    # The bot logs with print(); keep stdout clean for the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Results written to {args.output}", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,327 @@
+"""Cluster launcher: runs the bot as several worker processes, each with its own range of gateway shards.
+
+    python cluster.py --workers 4 --shards 16                  # real gateway, DISCORD_BOT_TOKEN required
+    python cluster.py --workers 3 --shards 6 --stand-in --duration 30 --kill-leader-after 12
+
+Workers are ordinary `main.py` processes configured through SHARD_IDS, SHARD_COUNT and
+CLUSTER_WORKER_ID. They share one SQLite database (DB_PATH) and elect a leader through its `leases`
+table. Crashed workers are restarted with backoff, and Ctrl+C shuts every worker down cleanly.
+
+With --stand-in no Discord connection is made. Each worker gets fake guilds for its own shards and
+replays synthetic traffic through the real handlers (see loadtest.py) against a temporary database.
+The report shows shard ownership, the hand-over of birthday announcements from the leader, and how
+leadership moves when the leader is killed.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import signal
+import sys
+import tempfile
+import time
+from typing import Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EVENT_PREFIX = "CLUSTER_EVENT "
+RESTART_BACKOFF_MAX = 60  # seconds
+
+def shard_ranges(shards: int, workers: int) -> list[list[int]]:
+    """Contiguous shard ranges, as even as possible: 10 shards on 3 workers -> 0-3, 4-6, 7-9."""
+    base, extra = divmod(shards, workers)
+    ranges, start = [], 0
+    for worker in range(workers):
+        size = base + (worker < extra)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+class Cluster:
+    def __init__(self, args, env: dict[str, str]):
+        self.args = args
+        self.env = env
+        self.ranges = shard_ranges(args.shards, args.workers)
+        self.processes: dict[int, asyncio.subprocess.Process] = {}
+        self.stopping = False
+        self.started = time.time()
+        self.events: list[dict] = []  # stand-in reports from workers, plus kills
+        self.leader: Optional[str] = None
+
+    def worker_env(self, worker: int) -> dict[str, str]:
+        env = {
+            **self.env,
+            "SHARD_IDS": ",".join(map(str, self.ranges[worker])),
+            "SHARD_COUNT": str(self.args.shards),
+            "CLUSTER_WORKER_ID": f"worker-{worker}",
+            "PYTHONUNBUFFERED": "1",
+        }
+        # One metrics endpoint per worker: METRICS_PORT, METRICS_PORT + 1, ...
+        if int(env.get("METRICS_PORT", "0")):
+            env["METRICS_PORT"] = str(int(env["METRICS_PORT"]) + worker)
+        return env
+
+    def command(self) -> list[str]:
+        if self.args.stand_in:
+            return [sys.executable, os.path.join(HERE, "cluster.py"), "--stand-in-worker",
+                    "--guilds", str(self.args.guilds), "--users", str(self.args.users),
+                    "--rate", str(self.args.rate), "--until", str(self.started + self.args.duration)]
+        return [sys.executable, os.path.join(HERE, "main.py")]
+
+    async def supervise(self, worker: int):
+        backoff = 1
+        while not self.stopping:
+            launched = time.monotonic()
+            process = await asyncio.create_subprocess_exec(
+                *self.command(), env=self.worker_env(worker), cwd=HERE,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+            )
+            self.processes[worker] = process
+            print(f"🚀 worker-{worker} started (pid {process.pid}, shards {self.ranges[worker][0]}-{self.ranges[worker][-1]})", file=sys.stderr)
+            async for line in process.stdout:
+                self.handle_output(worker, line.decode(errors="replace").rstrip())
+            code = await process.wait()
+            self.processes.pop(worker, None)
+            if self.stopping or (self.args.stand_in and time.time() >= self.started + self.args.duration):
+                break
+            # Back off on crash loops, but start over once a worker has stayed up a while
+            backoff = 1 if time.monotonic() - launched > RESTART_BACKOFF_MAX else min(backoff * 2, RESTART_BACKOFF_MAX)
+            print(f"❌ worker-{worker} exited with code {code}; restarting in {backoff}s", file=sys.stderr)
+            await asyncio.sleep(backoff)
+
+    def handle_output(self, worker: int, line: str):
+        if line.startswith(EVENT_PREFIX):
+            event = json.loads(line[len(EVENT_PREFIX):])
+            self.events.append(event)
+            if event["type"] == "leader":
+                if event["leader"]:
+                    self.leader = event["worker"]
+                elif self.leader == event["worker"]:
+                    self.leader = None
+            return
+        print(f"[worker-{worker}] {line}", file=sys.stderr)
+
+    async def kill_leader(self, delay: float):
+        await asyncio.sleep(delay)
+        if self.leader is None:
+            print("⚠️ No leader to kill", file=sys.stderr)
+            return
+        worker = int(self.leader.split("-")[1])
+        process = self.processes.get(worker)
+        if process:
+            print(f"💥 Killing leader worker-{worker}", file=sys.stderr)
+            self.events.append({"type": "leader", "worker": self.leader, "leader": False, "at": time.time(), "killed": True})
+            self.leader = None
+            process.kill()
+
+    def stop(self):
+        # SIGINT lets discord.py close the gateway and the bot release its lease and flush buffers
+        self.stopping = True
+        for process in self.processes.values():
+            process.send_signal(signal.SIGINT)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop)
+        supervisors = []
+        for worker in range(self.args.workers):
+            supervisors.append(asyncio.create_task(self.supervise(worker)))
+            # Gateway identifies are rate limited per bot; don't have every worker identify at once
+            if not self.args.stand_in and worker < self.args.workers - 1:
+                await asyncio.sleep(self.args.stagger)
+        if self.args.stand_in and self.args.kill_leader_after:
+            asyncio.create_task(self.kill_leader(self.args.kill_leader_after))
+        await asyncio.gather(*supervisors)
+
+    def report(self) -> dict:
+        """Stand-in summary: who owned which guilds, who led when, and whether anything ran twice."""
+        workers: dict[str, dict] = {}
+        intervals = []
+        open_since: dict[str, float] = {}
+        announced: dict[int, int] = {}
+        for event in sorted(self.events, key=lambda event: event["at"]):
+            name = event["worker"]
+            summary = workers.setdefault(name, {"runs": 0, "guilds": 0, "events": 0, "errors": 0, "led_for_s": 0.0, "killed": False})
+            if event["type"] == "result":
+                summary["runs"] += 1
+                summary["guilds"] = event["guilds"]
+                summary["events"] += event["events"]
+                summary["errors"] += event["errors"]
+            elif event["type"] == "birthday":
+                announced[event["guild"]] = announced.get(event["guild"], 0) + 1
+            elif event["type"] == "leader":
+                summary["killed"] |= event.get("killed", False)
+                if event["leader"]:
+                    open_since.setdefault(name, event["at"])
+                elif name in open_since:
+                    intervals.append((open_since.pop(name), event["at"], name))
+        for name, since in open_since.items():
+            intervals.append((since, time.time(), name))
+        for start, end, name in intervals:
+            workers[name]["led_for_s"] = round(workers[name]["led_for_s"] + end - start, 2)
+
+        intervals.sort()
+        overlap = sum(max(0.0, previous[1] - current[0]) for previous, current in zip(intervals, intervals[1:]))
+        return {
+            "workers": dict(sorted(workers.items())),
+            "shards": {f"worker-{worker}": shards for worker, shards in enumerate(self.ranges)},
+            "leadership": [
+                {"worker": name, "from_s": round(start - self.started, 2), "to_s": round(end - self.started, 2)}
+                for start, end, name in intervals
+            ],
+            "leader_overlap_s": round(overlap, 3),
+            "birthday_guilds": len(announced),
+            "birthday_duplicates": sum(count - 1 for count in announced.values()),
+        }
+
+async def prepare_stand_in(path: str, guilds: int, users: int, seed: int):
+    """Schema, one birthday today per guild and a due birthday job, so the leader has work straight away."""
+    import main
+    main.bot.db = main.Database(path)
+    await main.bot.db.connect()
+    try:
+        await main.bot.setup_database()
+        today = datetime.datetime.now(datetime.timezone.utc).strftime("%m-%d")
+        rng = random.Random(seed)
+        await main.bot.db.executemany(
+            "INSERT OR REPLACE INTO birthdays (user_id, guild_id, birth_date, birth_year, timezone) VALUES (?, ?, ?, ?, NULL)",
+            [(rng.randint(2, users + 1) + guild * 10**6, stand_in_guild_id(guild), today, 2000) for guild in range(1, guilds + 1)]
+        )
+        await main.bot.db.execute(
+            "INSERT INTO jobs (job_key, kind, run_at, payload) VALUES ('birthday_check', 'birthday_check', ?, '{}')",
+            (time.time() // 3600 * 3600,)
+        )
+    finally:
+        await main.bot.db.close()
+
+def stand_in_guild_id(index: int) -> int:
+    # Snowflake-shaped: the shard is (guild_id >> 22) % shard_count
+    return index << 22
+
+def emit(**event):
+    print(EVENT_PREFIX + json.dumps({"at": time.time(), **event}), flush=True)
+
+async def stand_in_worker(args):
+    """One cluster worker without a gateway: what login, GUILD_CREATE and READY would do, then synthetic traffic."""
+    import main
+    import loadtest
+
+    worker = main.CLUSTER_WORKER_ID
+
+    @main.leader_lease.on_change
+    async def report_leadership(leader: bool):
+        emit(type="leader", worker=worker, leader=leader)
+
+    announce_birthdays = main.announce_birthdays
+
+    async def counted_announce(guild, celebrants, year):
+        emit(type="birthday", worker=worker, guild=guild.id)
+        await announce_birthdays(guild, celebrants, year)
+    main.announce_birthdays = counted_announce
+
+    await main.bot._async_setup_hook()
+    main.bot._connection.user = loadtest.FakeMember(1, bot=True)
+    await main.bot.setup_hook()
+
+    guilds = {}
+    for index in range(1, args.guilds + 1):
+        guild_id = stand_in_guild_id(index)
+        if main.owns_guild(guild_id):
+            guilds[index] = guild = loadtest.FakeGuild(guild_id)
+            main.bot._connection._guilds[guild_id] = guild
+            await main.set_channel_configs(guild_id, {
+                "general": loadtest.GENERAL_CHANNEL_ID, "minigames": loadtest.MINIGAMES_CHANNEL_ID,
+                "ticket": loadtest.TICKET_CHANNEL_ID, "transcript": loadtest.TRANSCRIPT_CHANNEL_ID,
+            })
+    main.bot._ready.set()
+    print(f"✅ Stand-in gateway ready: {len(guilds)} guild(s) on shards {main.SHARD_IDS}")
+
+    duration = max(0.0, args.until - time.time())
+    trace = [event for event in loadtest.synthetic_trace(args.rate, duration, args.guilds, args.users, seed=os.getpid())
+             if event["guild"] in guilds]
+    rng = random.Random(os.getpid())
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    errors = 0
+    tasks = set()
+
+    async def run_event(event: dict):
+        nonlocal errors
+        try:
+            await loadtest.handle(event, guilds, rng)
+        except Exception as e:
+            errors += 1
+            print(f"❌ {event.get('command') or event['event']}: {type(e).__name__}: {e}")
+
+    for event in trace:
+        delay = started + event["at"] - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.create_task(run_event(event))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.wait(tasks)
+    await asyncio.sleep(max(0.0, args.until - time.time()))
+
+    emit(type="result", worker=worker, guilds=len(guilds), events=len(trace), errors=errors)
+    await main.bot.close()
+
+async def run_cluster(args) -> Optional[dict]:
+    env = dict(os.environ)
+    workdir = None
+    if args.stand_in:
+        workdir = tempfile.TemporaryDirectory(dir=args.tmpdir)
+        path = os.path.join(workdir.name, "cluster.db")
+        await prepare_stand_in(path, args.guilds, args.users, args.seed)
+        env.update({
+            "DB_PATH": path,
+            "LEADER_LEASE_TTL": str(args.lease_ttl),
+            "JOB_POLL_INTERVAL": "1",
+            "BIRTHDAY_TIMEZONE": "UTC",
+            "BIRTHDAY_ANNOUNCE_HOUR": str(datetime.datetime.now(datetime.timezone.utc).hour),
+        })
+    elif not env.get("DISCORD_BOT_TOKEN"):
+        raise SystemExit("❌ DISCORD_BOT_TOKEN not found (use --stand-in to run without Discord)")
+
+    cluster = Cluster(args, env)
+    try:
+        await cluster.run()
+    finally:
+        if workdir:
+            workdir.cleanup()
+    return cluster.report() if args.stand_in else None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=2, help="worker processes")
+    parser.add_argument("--shards", type=int, default=None, help="total gateway shards (default: one per worker)")
+    parser.add_argument("--stagger", type=float, default=None, help="seconds between worker starts (default: 5 per shard)")
+    parser.add_argument("--stand-in", action="store_true", help="run against fake guilds instead of Discord")
+    parser.add_argument("--duration", type=float, default=20, help="stand-in: seconds to run")
+    parser.add_argument("--guilds", type=int, default=24, help="stand-in: guilds spread over the shards")
+    parser.add_argument("--users", type=int, default=500, help="stand-in: members per guild")
+    parser.add_argument("--rate", type=float, default=50, help="stand-in: events/sec across the cluster (each worker replays its guilds' share)")
+    parser.add_argument("--kill-leader-after", type=float, default=None, help="stand-in: SIGKILL the leader after this many seconds")
+    parser.add_argument("--lease-ttl", type=float, default=3, help="stand-in: LEADER_LEASE_TTL for the workers")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--tmpdir", default=None)
+    parser.add_argument("--stand-in-worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--until", type=float, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stand_in_worker:
+        asyncio.run(stand_in_worker(args))
+        sys.exit(0)
+
+    args.shards = args.shards or args.workers
+    if not 1 <= args.workers <= args.shards:
+        raise SystemExit("❌ Need at least one shard per worker")
+    if args.stagger is None:
+        args.stagger = 5.0 * -(-args.shards // args.workers)
+
+    report = asyncio.run(run_cluster(args))
+    if report:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,515 @@
+"""Offline load test: replays event traces through the bot's real handlers against fake Discord objects.
+
+No gateway or HTTP connection is made. Messages go through on_message; slash commands run the
+tree's checks and callbacks; ticket buttons run TicketView/CloseTicketView callbacks. Each run uses
+a fresh temporary database and reports throughput, per-event latency, event-loop lag and DB contention.
+
+    python loadtest.py --rates 50,100,200,400,800 --duration 20        # find where it falls over
+    python loadtest.py --rates 100 --duration 30 --record trace.jsonl  # save the synthetic trace
+    python loadtest.py --trace trace.jsonl --speed 4                   # replay a recorded trace 4x faster
+
+Trace files are JSON lines: {"at": seconds, "event": "message" | "command" | "ticket_open" |
+"ticket_close", "guild": id, "user": id, "command": name, "args": {...}}.
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+from typing import Optional
+
+import discord
+from PIL import Image
+
+import main
+
+GENERAL_CHANNEL_ID = 10
+MINIGAMES_CHANNEL_ID = 20
+TICKET_CHANNEL_ID = 30
+TRANSCRIPT_CHANNEL_ID = 40
+LAG_INTERVAL = 0.01  # seconds between event-loop lag probes
+
+# Synthetic mix: event weights, roughly a chatty server with some command traffic
+EVENT_MIX = {
+    "message": 85,
+    "coinflip": 3,
+    "dice": 2,
+    "tos_coin": 2,
+    "leaderboard": 2,
+    "level": 2,
+    "diamond_balance": 2,
+    "richlist": 1,
+    "ticket_open": 0.5,
+    "ticket_close": 0.5,
+}
+
+_ids = itertools.count(10**15)
+
+def _avatar_png() -> bytes:
+    output = io.BytesIO()
+    Image.new("RGB", (128, 128), (88, 101, 242)).save(output, format="PNG")
+    return output.getvalue()
+
+AVATAR_PNG = _avatar_png()
+
+# Fake Discord objects: just the attributes and coroutines the bot's handlers use
+class FakeAPI:
+    """Simulated Discord round trip for every fake API call."""
+    latency = 0.0
+    calls = 0
+
+    @classmethod
+    async def call(cls):
+        cls.calls += 1
+        if cls.latency:
+            await asyncio.sleep(cls.latency)
+
+class FakeAvatar:
+    def __init__(self, user_id: int):
+        self.key = f"avatar{user_id}"
+        self.url = f"https://cdn.example/avatars/{user_id}.png"
+
+    def replace(self, **kwargs):
+        return self
+
+    async def read(self) -> bytes:
+        await FakeAPI.call()
+        return AVATAR_PNG
+
+class FakeMember:
+    def __init__(self, user_id: int, bot: bool = False, admin: bool = False):
+        self.id = user_id
+        self.bot = bot
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+        self.display_avatar = FakeAvatar(user_id)
+        self.guild_permissions = discord.Permissions.all() if admin else discord.Permissions.none()
+
+    def __str__(self):
+        return self.name
+
+class FakeMessage:
+    def __init__(self, guild, channel, author: FakeMember, content: str = "", embeds=None):
+        self.id = next(_ids)
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.embeds = embeds or []
+        self.attachments = []
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self._state = main.bot._connection
+
+    async def edit(self, **kwargs):
+        await FakeAPI.call()
+
+class FakeChannel:
+    def __init__(self, guild, channel_id: int, name: str):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.mention = f"<#{channel_id}>"
+        self.category = None
+        self.category_id = None
+        self.history_messages: list[FakeMessage] = []
+
+    async def send(self, content=None, *, embed=None, view=None, file=None, **kwargs):
+        await FakeAPI.call()
+        if file is not None:
+            file.fp.read()  # the upload
+            file.close()
+        message = FakeMessage(self.guild, self, self.guild.me, content or "", [embed] if embed else [])
+        if self.name.startswith("ticket-"):
+            self.history_messages.append(message)
+        return message
+
+    async def history(self, limit=None, oldest_first=False):
+        messages = self.history_messages if oldest_first else list(reversed(self.history_messages))
+        for page in range(0, len(messages), 100):
+            await FakeAPI.call()
+            for message in messages[page:page + 100]:
+                yield message
+
+    def get_partial_message(self, message_id: int):
+        return FakeMessage(self.guild, self, self.guild.me)
+
+    async def delete(self):
+        await FakeAPI.call()
+        self.guild.channels.pop(self.id, None)
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.name = f"guild{guild_id}"
+        self.me = FakeMember(1, bot=True)
+        self.default_role = object()
+        self.members: dict[int, FakeMember] = {}
+        self.channels: dict[int, FakeChannel] = {}
+        self.open_tickets: list[FakeChannel] = []
+        for channel_id, name in ((GENERAL_CHANNEL_ID, "general"), (MINIGAMES_CHANNEL_ID, "minigames"),
+                                 (TICKET_CHANNEL_ID, "tickets"), (TRANSCRIPT_CHANNEL_ID, "transcripts")):
+            self.channels[channel_id] = FakeChannel(self, channel_id, name)
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+    def get_member(self, user_id: int) -> FakeMember:
+        member = self.members.get(user_id)
+        if member is None:
+            member = self.members[user_id] = FakeMember(user_id, admin=user_id % 50 == 0)
+        return member
+
+    async def query_members(self, *, user_ids: list[int], limit: int = 5, cache: bool = True) -> list[FakeMember]:
+        await FakeAPI.call()  # one gateway round trip per batch, as with LEAN_MEMBER_CACHE
+        return [self.get_member(user_id) for user_id in user_ids[:limit]]
+
+    async def create_text_channel(self, name: str, overwrites=None, category=None):
+        await FakeAPI.call()
+        channel = FakeChannel(self, next(_ids), name)
+        self.channels[channel.id] = channel
+        return channel
+
+class FakeResponse:
+    def __init__(self):
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def _respond(self, *args, **kwargs):
+        if self._done:
+            raise RuntimeError("interaction already responded to")
+        self._done = True
+        await FakeAPI.call()
+
+    send_message = defer = send_modal = edit_message = _respond
+
+class FakeFollowup:
+    async def send(self, *args, file=None, **kwargs):
+        await FakeAPI.call()
+        if file is not None:
+            file.close()
+
+class FakeInteraction:
+    def __init__(self, guild: FakeGuild, channel: FakeChannel, user: FakeMember):
+        self.id = next(_ids)
+        self.guild = guild
+        self.channel = channel
+        self.user = user
+        self.message = None
+        self.command = None
+        self.extras = {}
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+
+# Traces
+def synthetic_trace(rate: float, duration: float, guilds: int, users: int, seed: int) -> list[dict]:
+    """Poisson arrivals at `rate` events/sec with the EVENT_MIX distribution."""
+    rng = random.Random(seed)
+    kinds, weights = zip(*EVENT_MIX.items())
+    events, at = [], 0.0
+    while True:
+        at += rng.expovariate(rate)
+        if at >= duration:
+            return events
+        kind = rng.choices(kinds, weights)[0]
+        event = {"at": round(at, 6), "guild": rng.randint(1, guilds), "user": rng.randint(2, users + 1)}
+        if kind in ("message", "ticket_open", "ticket_close"):
+            event["event"] = kind
+        else:
+            event.update(event="command", command=kind, args=command_args(kind, rng))
+        events.append(event)
+
+def command_args(command: str, rng: random.Random) -> dict:
+    if command == "coinflip":
+        return {"choice": rng.choice(["heads", "tails"])}
+    if command == "dice":
+        return {"guess": rng.randint(1, 6)}
+    if command == "tos_coin":
+        return {"choice": rng.choice(["head", "tail"]), "bet": rng.choice([100, 200, 500])}
+    if command in ("leaderboard", "richlist"):
+        return {"page": rng.randint(1, 5), "around_me": rng.random() < 0.2}
+    return {}
+
+def load_trace(path: str, speed: float) -> list[dict]:
+    with open(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    for event in events:
+        event["at"] /= speed
+    return sorted(events, key=lambda event: event["at"])
+
+# Dispatch into the bot
+CHOICE_ARGS = {"choice", "guess"}
+
+async def run_command(interaction: FakeInteraction, name: str, args: dict):
+    """What the command tree does for an invocation: interaction check, command checks, callback, completion."""
+    command = main.bot.tree.get_command(name)
+    interaction.command = command
+    kwargs = {
+        key: discord.app_commands.Choice(name=str(value).title(), value=value) if key in CHOICE_ARGS else value
+        for key, value in args.items()
+    }
+    await main.bot.tree.interaction_check(interaction)
+    try:
+        for check in command.checks:
+            if not await discord.utils.maybe_coroutine(check, interaction):
+                raise discord.app_commands.CheckFailure(f"check failed for {name}")
+        await command.callback(interaction, **kwargs)
+    except discord.app_commands.AppCommandError as error:
+        await main.bot.tree.on_error(interaction, error)
+        return "rejected"
+    await main.on_app_command_completion(interaction, command)
+
+async def handle(event: dict, guilds: dict[int, FakeGuild], rng: random.Random):
+    guild = guilds[event["guild"]]
+    user = guild.get_member(event["user"])
+    kind = event["event"]
+
+    if kind == "message":
+        channel = guild.get_channel(GENERAL_CHANNEL_ID)
+        await main.on_message(FakeMessage(guild, channel, user, "load test message"))
+    elif kind == "command":
+        channel = guild.get_channel(MINIGAMES_CHANNEL_ID)
+        return await run_command(FakeInteraction(guild, channel, user), event["command"], event.get("args", {}))
+    elif kind == "ticket_open":
+        interaction = FakeInteraction(guild, guild.get_channel(TICKET_CHANNEL_ID), user)
+        channels_before = set(guild.channels)
+        await main.TicketView().create_ticket.callback(interaction)
+        for channel_id in set(guild.channels) - channels_before:
+            channel = guild.channels[channel_id]
+            # Some conversation for the transcript
+            for n in range(rng.randint(5, 150)):
+                author = user if n % 3 else guild.get_member(50)
+                channel.history_messages.append(FakeMessage(guild, channel, author, f"ticket message {n} " * rng.randint(1, 8)))
+            guild.open_tickets.append(channel)
+    elif kind == "ticket_close":
+        if not guild.open_tickets:
+            return "skipped"
+        channel = guild.open_tickets.pop(rng.randrange(len(guild.open_tickets)))
+        await main.CloseTicketView().close_ticket.callback(FakeInteraction(guild, channel, guild.get_member(50)))
+
+# Measurement
+def percentiles(samples: list[float]) -> dict:
+    if not samples:
+        return {"p50_ms": None, "p99_ms": None, "max_ms": None}
+    if len(samples) == 1:
+        samples = samples * 2
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"p50_ms": round(cuts[49] * 1000, 3), "p99_ms": round(cuts[98] * 1000, 3), "max_ms": round(max(samples) * 1000, 3)}
+
+async def lag_monitor(samples: list[float]):
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LAG_INTERVAL
+        await asyncio.sleep(LAG_INTERVAL)
+        samples.append(max(0.0, loop.time() - expected))
+
+async def prepare(workdir: str, label: str, guild_count: int, users: int, seed: int) -> dict[int, FakeGuild]:
+    """Fresh database and in-memory state, populated with `users` members per guild."""
+    main.bot.db = main.Database(os.path.join(workdir, f"loadtest-{label}.db"))
+    await main.bot.db.connect()
+    main.balance_cache = main.BalanceCache()
+    main.xp_aggregator = main.XPAggregator()
+    main.xp_rankings = main.GuildRankings(main.xp_rankings.query, main.xp_rankings.key, main.xp_rankings.overlay)
+    main.diamond_rankings = main.GuildRankings(main.diamond_rankings.query, main.diamond_rankings.key)
+    main.minigame_limiter = main.TokenBucketLimiter(main.MINIGAME_RATE, main.MINIGAME_BURST)
+    main.event_logger = main.EventLogger()
+    main.transcript_index = main.TranscriptIndex()
+    main.xp_policy = main.XPPolicy()
+
+    await main.bot.setup_database()
+    await main.run_migrations()
+    await main.load_channel_config()
+
+    rng = random.Random(seed)
+    guilds = {}
+    for guild_id in range(1, guild_count + 1):
+        guilds[guild_id] = FakeGuild(guild_id)
+        await main.set_channel_configs(guild_id, {
+            "general": GENERAL_CHANNEL_ID, "minigames": MINIGAMES_CHANNEL_ID,
+            "ticket": TICKET_CHANNEL_ID, "transcript": TRANSCRIPT_CHANNEL_ID,
+        })
+        await main.bot.db.executemany(
+            "INSERT INTO users (user_id, guild_id, xp, level, messages) VALUES (?, ?, ?, ?, ?)",
+            [(user_id, guild_id, rng.randint(0, 99), rng.randint(0, 50), rng.randint(0, 1000)) for user_id in range(2, users + 2)]
+        )
+        await main.bot.db.executemany(
+            "INSERT INTO diamonds (guild_id, user_id, balance, total_earned) VALUES (?, ?, ?, ?)",
+            [(guild_id, user_id, rng.randint(0, 5000), 0) for user_id in range(2, users + 2)]
+        )
+    await main.xp_policy.load()
+    main.bot.db.contention = dict.fromkeys(main.bot.db.contention, 0)
+    return guilds
+
+async def replay(events: list[dict], guilds: dict[int, FakeGuild], target_rate: Optional[float], seed: int) -> dict:
+    loop = asyncio.get_running_loop()
+    rng = random.Random(seed)
+    lag: list[float] = []
+    latencies: dict[str, list[float]] = {}
+    outcomes: dict[str, int] = {"ok": 0, "rejected": 0, "skipped": 0, "error": 0}
+    errors: dict[str, int] = {}
+    in_flight = 0
+    peak_in_flight = 0
+    api_calls = FakeAPI.calls
+
+    async def run_event(event: dict, scheduled: float):
+        nonlocal in_flight
+        name = event.get("command") or event["event"]
+        try:
+            outcome = await handle(event, guilds, rng) or "ok"
+        except Exception as e:
+            outcome = "error"
+            key = f"{name}: {type(e).__name__}: {e}"[:200]
+            errors[key] = errors.get(key, 0) + 1
+        finally:
+            in_flight -= 1
+        outcomes[outcome] += 1
+        latencies.setdefault(name, []).append(loop.time() - scheduled)
+
+    main.event_logger.start()
+    main.transcript_index.start()
+    monitor = asyncio.create_task(lag_monitor(lag))
+    tasks = set()
+    started = loop.time()
+    for event in events:
+        scheduled = started + event["at"]
+        delay = scheduled - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        in_flight += 1
+        peak_in_flight = max(peak_in_flight, in_flight)
+        task = asyncio.create_task(run_event(event, scheduled))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.wait(tasks)
+    elapsed = loop.time() - started
+    monitor.cancel()
+
+    queues = {
+        "log_queue": main.event_logger.queue.qsize(),
+        "log_dropped": main.event_logger.dropped,
+        "log_sampled_out": main.event_logger.sampled_out,
+        "xp_dirty": main.xp_aggregator.dirty_count,
+        "ledger_pending": main.diamond_ledger.pending_count,
+        "transcript_index_queue": main.transcript_index.queue.qsize(),
+    }
+    await main.xp_aggregator.flush()
+    await main.diamond_ledger.flush()
+    await main.event_logger.close()
+    await main.transcript_index.close()
+
+    db = main.bot.db.contention
+    all_latencies = [sample for samples in latencies.values() for sample in samples]
+    throughput = len(events) / elapsed if elapsed else 0.0
+    offered = len(events) / events[-1]["at"] if events and events[-1]["at"] else 0.0
+    loop_lag = percentiles(lag)
+    return {
+        "target_rate": target_rate,
+        "events": len(events),
+        "offered_eps": round(offered, 1),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_eps": round(throughput, 1),
+        "peak_in_flight": peak_in_flight,
+        "outcomes": outcomes,
+        "errors": errors,
+        "latency": percentiles(all_latencies),
+        "latency_by_event": {name: {"count": len(samples), **percentiles(samples)} for name, samples in sorted(latencies.items())},
+        "loop_lag": loop_lag,
+        "db_contention": {
+            "reads": db["reads"],
+            "read_wait_ratio": round(db["read_waits"] / db["reads"], 4) if db["reads"] else 0.0,
+            "read_wait_ms_total": round(db["read_wait_s"] * 1000, 1),
+            "max_read_wait_ms": round(db["max_read_wait_s"] * 1000, 3),
+            "writes": db["writes"],
+            "write_wait_ratio": round(db["write_waits"] / db["writes"], 4) if db["writes"] else 0.0,
+            "write_wait_ms_total": round(db["write_wait_s"] * 1000, 1),
+            "max_write_wait_ms": round(db["max_write_wait_s"] * 1000, 3),
+            "writer_busy_ratio": round(db["write_hold_s"] / elapsed, 4) if elapsed else 0.0,
+        },
+        "queues_at_end": queues,
+        "sql_by_total_time": [
+            {key: statement[key] for key in ("sql", "calls", "total_ms", "max_ms")}
+            for statement in main.bot.db.profiler.report(limit=5)["statements"]
+        ],
+        "api_calls": FakeAPI.calls - api_calls,
+        # Falling behind the offered rate, or the loop stalling, marks the breaking point
+        "saturated": throughput < 0.95 * offered or (loop_lag["p99_ms"] or 0) > 100,
+    }
+
+async def run(args) -> dict:
+    FakeAPI.latency = args.api_latency / 1000
+    # process_commands compares message authors against the logged-in user
+    main.bot._connection.user = FakeMember(1, bot=True)
+    report = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "guilds": args.guilds,
+        "users_per_guild": args.users,
+        "api_latency_ms": args.api_latency,
+        "runs": [],
+    }
+
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as workdir:
+        if args.trace:
+            plans = [("trace", None, load_trace(args.trace, args.speed))]
+        else:
+            plans = [(f"{rate:g}", rate, synthetic_trace(rate, args.duration, args.guilds, args.users, args.seed)) for rate in args.rates]
+
+        for label, rate, events in plans:
+            if args.record:
+                with open(args.record if len(plans) == 1 else f"{args.record}.{label}", "w") as f:
+                    for event in events:
+                        f.write(json.dumps(event) + "\n")
+            guilds = await prepare(workdir, label, args.guilds, args.users, args.seed)
+            try:
+                result = await replay(events, guilds, rate, args.seed)
+            finally:
+                await main.bot.db.close()
+            report["runs"].append(result)
+            print(
+                f"📈 {result['offered_eps']:>8.1f} ev/s offered → {result['throughput_eps']:>8.1f} ev/s, "
+                f"p99 {result['latency']['p99_ms']} ms, loop lag p99 {result['loop_lag']['p99_ms']} ms, "
+                f"writer busy {result['db_contention']['writer_busy_ratio']:.0%}, errors {result['outcomes']['error']}"
+                + (" ❌ saturated" if result["saturated"] else ""),
+                file=sys.__stderr__
+            )
+            if result["saturated"] and args.stop_on_saturation:
+                break
+    return report
+
+def parse_rates(value: str) -> list[float]:
+    return [float(rate) for rate in value.split(",") if rate]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rates", type=parse_rates, default=[50, 100, 200, 400], help="offered events/sec, one run each")
+    parser.add_argument("--duration", type=float, default=15, help="seconds per synthetic run")
+    parser.add_argument("--trace", default=None, help="replay this JSONL trace instead of a synthetic one")
+    parser.add_argument("--speed", type=float, default=1.0, help="time compression for --trace")
+    parser.add_argument("--record", default=None, help="write the synthetic trace(s) to this JSONL path")
+    parser.add_argument("--guilds", type=int, default=5)
+    parser.add_argument("--users", type=int, default=5_000, help="members per guild")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="simulated Discord API round trip in ms")
+    parser.add_argument("--stop-on-saturation", action="store_true", help="skip higher rates once a run saturates")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--tmpdir", default=None)
+    parser.add_argument("--output", default=None, help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    # The bot logs with print(); keep stdout clean for the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Results written to {args.output}", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=2))
@@ -3,12 +3,27 @@ import discord
 from discord.ext import commands, tasks
 import aiosqlite
 import asyncio
+import bisect
+import heapq
+import itertools
 import json
+import math
 import random
 import datetime
 from PIL import Image, ImageDraw, ImageFont
 import io
 import os
+import gzip
+import hashlib
+import html
+import tempfile
+import time
+import contextlib
+import functools
+import pathlib
+import zoneinfo
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Callable, Any
 
 # Bot configuration
@@ -17,27 +32,580 @@ intents.message_content = True
 intents.members = True
 intents.guilds = True
 
-class DiscordBot(commands.Bot):
+# Member caching: the default keeps every member of every guild in memory; lean mode keeps an LRU instead
+LEAN_MEMBER_CACHE = os.getenv("LEAN_MEMBER_CACHE", "0").lower() in ("1", "true", "yes")  # don't chunk guilds; resolve members on demand
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", "20000"))  # recently active or looked-up members kept in lean mode
+MEMBER_QUERY_BATCH = 100  # user IDs per query_members request (Discord's limit)
+
+# Cluster mode: cluster.py runs several of these processes, each with its own range of gateway shards
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))  # total shards across the cluster; 0 lets Discord recommend one
+SHARD_IDS = [int(shard) for shard in os.getenv("SHARD_IDS", "").split(",") if shard.strip()]  # this process's shards; empty runs them all
+CLUSTER_WORKER_ID = os.getenv("CLUSTER_WORKER_ID", "standalone")  # identifies this process in the leader lease
+DB_PATH = os.getenv("DB_PATH", "bot_database.db")  # SQLite file, shared by every process in a cluster
+
+if SHARD_IDS and not all(0 <= shard < SHARD_COUNT for shard in SHARD_IDS):
+    raise SystemExit("❌ SHARD_IDS must be set together with a larger SHARD_COUNT")
+
+def owns_guild(guild_id: int) -> bool:
+    """Whether this process's shards receive the guild's events (always true outside cluster mode).
+
+    Every per-guild cache (balances, rankings, channel config, XP policy) is only written by the
+    guild's owner, which is what keeps them coherent across processes sharing one database.
+    """
+    return not SHARD_IDS or (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
+
+# Metrics (Prometheus text format, served on METRICS_PORT)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 disables the /metrics endpoint
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")  # bind address for the /metrics endpoint
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+
+def metric_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def metric_labels(names: tuple, values: tuple, **extra) -> str:
+    pairs = [*zip(names, values), *extra.items()]
+    return "{" + ",".join(f'{name}="{metric_label_value(value)}"' for name, value in pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels, self.type = name, help, labels, "counter"
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield f"{self.name}{metric_labels(self.labels, label_values)} {value}"
+
+class Histogram:
+    """Fixed-bucket histogram: an observation is one bisect and two additions, so it can stay on in hot paths."""
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.type = name, help, labels, "histogram"
+        self.buckets = buckets
+        self.series: dict[tuple, list] = {}  # label values -> [per-bucket counts (last is +Inf), sum]
+
+    def observe(self, value: float, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for label_values, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{metric_labels(self.labels, label_values, le=bound)} {cumulative}"
+            yield f"{self.name}_sum{metric_labels(self.labels, label_values)} {total}"
+            yield f"{self.name}_count{metric_labels(self.labels, label_values)} {cumulative}"
+
+class Collected:
+    """Values read from the bot's own structures at scrape time (queue sizes, cache counters), so they cost nothing in between."""
+
+    def __init__(self, name: str, help: str, collect: Callable[[], Any], labels: tuple = (), type: str = "gauge"):
+        self.name, self.help, self.labels, self.type = name, help, labels, type
+        self.collect = collect  # a number, or {label values: number} when labelled
+
+    def samples(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            if value is not None:
+                yield f"{self.name}{metric_labels(self.labels, label_values)} {value}"
+
+class MetricsRegistry:
     def __init__(self):
-        super().__init__(command_prefix='!', intents=intents)
-        self.db_path = 'bot_database.db'
+        self.metrics: list = []
+        self._runner = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def collected(self, name: str, help: str, collect: Callable[[], Any], labels: tuple = (), type: str = "gauge") -> Collected:
+        return self.register(Collected(name, help, collect, labels, type))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            try:
+                lines.extend(metric.samples())
+            except Exception as e:
+                print(f"❌ Failed to collect metric {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+    async def start(self, host: str, port: int):
+        from aiohttp import web
+
+        async def handle_metrics(request):
+            return web.Response(body=self.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        print(f"📈 Metrics endpoint listening on http://{host}:{port}/metrics")
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+metrics = MetricsRegistry()
+command_seconds = metrics.histogram("bot_command_seconds", "Slash command latency, from receipt to completion", ("command", "outcome"))
+view_seconds = metrics.histogram("bot_view_callback_seconds", "Button and modal callback latency", ("callback", "outcome"))
+db_seconds = metrics.histogram("bot_db_seconds", "Time a database connection is held per read or write transaction", ("kind",))
+job_seconds = metrics.histogram("bot_job_seconds", "Scheduled job run time", ("kind", "outcome"))
+event_errors = metrics.counter("bot_event_errors_total", "Unhandled exceptions in gateway event handlers", ("event",))
+messages_seen = metrics.counter("bot_messages_total", "Guild messages processed by on_message")
+
+def timed_callback(name: str):
+    """Record a view or modal callback's latency in bot_view_callback_seconds."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                result = await func(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                view_seconds.observe(time.perf_counter() - started, name, outcome)
+        return wrapper
+    return decorator
+
+# Storage configuration
+DB_READER_POOL_SIZE = int(os.getenv("DB_READER_POOL_SIZE", "4"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+SQL_SLOW_MS = float(os.getenv("SQL_SLOW_MS", "25"))  # statements slower than this go into the slow log
+SQL_SLOW_LOG_SIZE = int(os.getenv("SQL_SLOW_LOG_SIZE", "50"))  # slowest statements kept, with their parameter shapes
+SQL_DEBUG = os.getenv("SQL_DEBUG", "0").lower() in ("1", "true", "yes")  # capture EXPLAIN QUERY PLAN per distinct statement
+SQL_PROFILE_PATH = os.getenv("SQL_PROFILE_PATH", "sql_profile.json")  # profile dump written on shutdown in debug mode
+
+def sql_text(sql: str) -> str:
+    return " ".join(sql.split())
+
+def param_shape(params) -> str:
+    return "(" + ", ".join(type(param).__name__ for param in params) + ")"
+
+class QueryProfiler:
+    """Per-statement timings for every SQL statement, a bounded log of the slowest calls, and (with
+    SQL_DEBUG) the query plan of each distinct statement with full table scans and temp sorts flagged.
+    """
+
+    EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+    def __init__(self, debug: bool = SQL_DEBUG):
+        self.debug = debug
+        self.stats: dict[str, list] = {}  # sql -> [calls, total seconds, max seconds]
+        self.slow: list[tuple] = []  # min-heap of (seconds, sequence, sql, shape, unix time)
+        self.plans: dict[str, dict] = {}  # sql -> {"plan": [...], "flags": [...]}
+        self._sequence = itertools.count()
+        self.started_at = time.time()
+
+    def record(self, sql: str, params, elapsed: float, many: bool = False):
+        stats = self.stats.get(sql)
+        if stats is None:
+            stats = self.stats[sql] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += elapsed
+        if elapsed > stats[2]:
+            stats[2] = elapsed
+        if elapsed * 1000 >= SQL_SLOW_MS and (len(self.slow) < SQL_SLOW_LOG_SIZE or elapsed > self.slow[0][0]):
+            if many:
+                shape = f"{len(params)} rows of {param_shape(params[0])}" if isinstance(params, (list, tuple)) and params else "rows"
+            else:
+                shape = param_shape(params)
+            entry = (elapsed, next(self._sequence), sql, shape, time.time())
+            if len(self.slow) < SQL_SLOW_LOG_SIZE:
+                heapq.heappush(self.slow, entry)
+            else:
+                heapq.heapreplace(self.slow, entry)
+
+    async def explain(self, conn: aiosqlite.Connection, sql: str, params):
+        """Capture the plan the first time a statement is seen; EXPLAIN never runs the statement itself."""
+        self.plans[sql] = {"plan": [], "flags": []}
+        if not sql.lstrip().upper().startswith(self.EXPLAINABLE):
+            return
+        try:
+            async with conn.execute(f"EXPLAIN QUERY PLAN {sql}", params) as cursor:
+                plan = [row[3] for row in await cursor.fetchall()]
+        except Exception as e:
+            self.plans[sql]["plan"] = [f"EXPLAIN failed: {e}"]
+            return
+        flags = []
+        for detail in plan:
+            if detail.startswith("SCAN ") and "USING" not in detail and "CONSTANT ROW" not in detail:
+                flags.append(f"full scan: {detail[5:]}")
+            elif detail.startswith("USE TEMP B-TREE"):
+                flags.append(detail.lower())
+        self.plans[sql] = {"plan": plan, "flags": flags}
+        if flags:
+            print(f"⚠️ Query plan: {', '.join(flags)} in {sql_text(sql)}")
+
+    def reset(self):
+        self.stats.clear()
+        self.slow.clear()
+        self.started_at = time.time()
+
+    def report(self, limit: Optional[int] = None) -> dict:
+        """Statements by total time, the slow log (slowest first), and plans in debug mode."""
+        statements = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)
+        return {
+            "since": datetime.datetime.fromtimestamp(self.started_at, datetime.timezone.utc).isoformat(timespec="seconds"),
+            "slow_ms": SQL_SLOW_MS,
+            "debug": self.debug,
+            "statements": [
+                {
+                    "sql": sql_text(sql),
+                    "calls": calls,
+                    "total_ms": round(total * 1000, 3),
+                    "mean_ms": round(total * 1000 / calls, 3),
+                    "max_ms": round(longest * 1000, 3),
+                    **({"plan": self.plans[sql]["plan"], "flags": self.plans[sql]["flags"]} if sql in self.plans else {}),
+                }
+                for sql, (calls, total, longest) in statements[:limit]
+            ],
+            "slowest": [
+                {
+                    "sql": sql_text(sql),
+                    "params": shape,
+                    "ms": round(elapsed * 1000, 3),
+                    "at": datetime.datetime.fromtimestamp(at, datetime.timezone.utc).isoformat(timespec="seconds"),
+                }
+                for elapsed, _, sql, shape, at in sorted(self.slow, reverse=True)
+            ],
+            "flagged": [
+                {"sql": sql_text(sql), "flags": plan["flags"]} for sql, plan in self.plans.items() if plan["flags"]
+            ],
+        }
+
+    def dump(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+class ProfiledStatement:
+    """What ProfiledConnection.execute returns: awaitable for a cursor, or an async context manager like aiosqlite's.
+    Used as a context manager, the timing covers fetching the rows as well."""
+
+    def __init__(self, conn: "ProfiledConnection", sql: str, params, many: bool):
+        self.conn = conn
+        self.sql = sql
+        self.params = params
+        self.many = many
+        self._cursor = None
+        self._started = 0.0
+
+    async def _execute(self):
+        conn, profiler = self.conn.raw, self.conn.profiler
+        if profiler.debug and self.sql not in profiler.plans:
+            params = self.params
+            if self.many:
+                params = params[0] if isinstance(params, (list, tuple)) and params else None
+            if params is not None:
+                await profiler.explain(conn, self.sql, params)
+        self._started = time.perf_counter()
+        if self.many:
+            return await conn.executemany(self.sql, self.params)
+        return await conn.execute(self.sql, self.params)
+
+    async def _run(self):
+        try:
+            return await self._execute()
+        finally:
+            self.conn.profiler.record(self.sql, self.params, time.perf_counter() - self._started, self.many)
+
+    def __await__(self):
+        return self._run().__await__()
+
+    async def __aenter__(self):
+        self._cursor = await self._execute()
+        return self._cursor
+
+    async def __aexit__(self, *exc_info):
+        try:
+            await self._cursor.close()
+        finally:
+            self.conn.profiler.record(self.sql, self.params, time.perf_counter() - self._started, self.many)
+
+class ProfiledConnection:
+    """Wraps an aiosqlite connection so every execute/executemany goes through the profiler."""
+
+    def __init__(self, raw: aiosqlite.Connection, profiler: QueryProfiler):
+        self.raw = raw
+        self.profiler = profiler
+
+    def execute(self, sql: str, params=()) -> ProfiledStatement:
+        return ProfiledStatement(self, sql, params, many=False)
+
+    def executemany(self, sql: str, rows) -> ProfiledStatement:
+        return ProfiledStatement(self, sql, rows, many=True)
+
+    def __getattr__(self, name: str):
+        return getattr(self.raw, name)
+
+class Database:
+    """Long-lived SQLite connections: one writer plus a small pool of read-only readers."""
+
+    WRITER_PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA busy_timeout=5000",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA mmap_size=134217728",
+        "PRAGMA foreign_keys=ON",
+    )
+
+    READER_PRAGMAS = (
+        "PRAGMA query_only=1",
+        "PRAGMA busy_timeout=5000",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-8000",
+        "PRAGMA mmap_size=134217728",
+    )
+
+    def __init__(self, path: str, readers: int = DB_READER_POOL_SIZE):
+        self.path = path
+        self.reader_count = max(1, readers)
+        self.writer: Optional[aiosqlite.Connection] = None
+        self._readers: list[aiosqlite.Connection] = []
+        self._idle_readers: Optional[asyncio.Queue] = None
+        self._write_lock = asyncio.Lock()
+        self.profiler = QueryProfiler()
+        self._profiled_writer: Optional[ProfiledConnection] = None
+        self.contention = {"reads": 0, "read_waits": 0, "read_wait_s": 0.0, "max_read_wait_s": 0.0,
+                           "writes": 0, "write_waits": 0, "write_wait_s": 0.0, "max_write_wait_s": 0.0,
+                           "write_hold_s": 0.0, "max_write_hold_s": 0.0}
+
+    def _record_wait(self, kind: str, waited: bool, started: float):
+        # How often callers queue for a connection, and for how long
+        stats = self.contention
+        stats[kind + "s"] += 1
+        if waited:
+            elapsed = time.perf_counter() - started
+            stats[kind + "_waits"] += 1
+            stats[kind + "_wait_s"] += elapsed
+            stats[f"max_{kind}_wait_s"] = max(stats[f"max_{kind}_wait_s"], elapsed)
+
+    async def connect(self):
+        # The writer creates the file and switches it to WAL before any reader opens it,
+        # so readers never block the writer and always see the last committed state.
+        self.writer = await aiosqlite.connect(self.path, cached_statements=DB_STATEMENT_CACHE_SIZE)
+        for pragma in self.WRITER_PRAGMAS:
+            await self.writer.execute(pragma)
+        await self.writer.commit()
+        self._profiled_writer = ProfiledConnection(self.writer, self.profiler)
+
+        self._idle_readers = asyncio.Queue()
+        reader_uri = f"{pathlib.Path(self.path).resolve().as_uri()}?mode=ro"
+        for _ in range(self.reader_count):
+            reader = await aiosqlite.connect(reader_uri, uri=True, cached_statements=DB_STATEMENT_CACHE_SIZE)
+            for pragma in self.READER_PRAGMAS:
+                await reader.execute(pragma)
+            self._readers.append(reader)
+            self._idle_readers.put_nowait(ProfiledConnection(reader, self.profiler))
+
+    async def close(self):
+        for reader in self._readers:
+            await reader.close()
+        self._readers.clear()
+        if self.writer:
+            await self.writer.close()
+            self.writer = None
+
+    @contextlib.asynccontextmanager
+    async def reader(self):
+        started = time.perf_counter()
+        waited = self._idle_readers.empty()
+        conn = await self._idle_readers.get()
+        self._record_wait("read", waited, started)
+        acquired = time.perf_counter()
+        try:
+            yield conn
+        finally:
+            self._idle_readers.put_nowait(conn)
+            db_seconds.observe(time.perf_counter() - acquired, "read")
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """Serialize writes on the single writer connection and commit (or roll back) as one unit."""
+        started = time.perf_counter()
+        waited = self._write_lock.locked()
+        async with self._write_lock:
+            acquired = time.perf_counter()
+            self._record_wait("write", waited, started)
+            try:
+                yield self._profiled_writer
+            except BaseException:
+                await self.writer.rollback()
+                raise
+            else:
+                await self.writer.commit()
+            finally:
+                held = time.perf_counter() - acquired
+                db_seconds.observe(held, "write")
+                self.contention["write_hold_s"] += held
+                self.contention["max_write_hold_s"] = max(self.contention["max_write_hold_s"], held)
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+
+    async def fetchall(self, sql: str, params: tuple = ()):
+        async with self.reader() as conn:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+
+    async def execute(self, sql: str, params: tuple = ()):
+        async with self.transaction() as conn:
+            return await conn.execute(sql, params)
+
+    async def executemany(self, sql: str, rows):
+        async with self.transaction() as conn:
+            return await conn.executemany(sql, rows)
+
+# Tables keyed per guild; `{name}` lets migrations build a replacement alongside the live table
+USERS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        xp INTEGER DEFAULT 0,
+        level INTEGER DEFAULT 0,
+        messages INTEGER DEFAULT 0,
+        PRIMARY KEY (guild_id, user_id)
+    )
+'''
+
+DIAMONDS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        guild_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        balance INTEGER DEFAULT 0,
+        last_daily TIMESTAMP,
+        daily_streak INTEGER DEFAULT 0,
+        total_earned INTEGER DEFAULT 0,
+        multiplier REAL DEFAULT 1.0,
+        PRIMARY KEY (guild_id, user_id)
+    )
+'''
+
+# Tables still on their pre-migration user_id key, where there is no (guild_id, user_id)
+# constraint for an upsert to target; migrations 1 and 2 remove them once the swap is done
+legacy_keyed_tables: set[str] = set()
+
+async def add_column_if_missing(db: aiosqlite.Connection, table: str, column: str, declaration: str):
+    """Additive schema change for existing databases; ADD COLUMN is a constant-time metadata update."""
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        columns = {row[1] for row in await cursor.fetchall()}
+    if column not in columns:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+class BotCommandTree(discord.app_commands.CommandTree):
+    """Command tree that times every slash command for the usage rollups and the latency histogram."""
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        interaction.extras["started_at"] = time.perf_counter()
+        member_cache.touch(interaction.user)
+        return True
+
+    def record_latency(self, interaction: discord.Interaction, outcome: str):
+        started_at = interaction.extras.get("started_at")
+        if started_at and interaction.command:
+            command_seconds.observe(time.perf_counter() - started_at, interaction.command.qualified_name, outcome)
+
+    async def on_error(self, interaction: discord.Interaction, error: discord.app_commands.AppCommandError):
+        self.record_latency(interaction, "rejected" if isinstance(error, discord.app_commands.CheckFailure) else "error")
+        # Rejected by a check (wrong channel, rate limit): answer privately, not an error
+        if isinstance(error, EmbedCheckFailure):
+            if interaction.response.is_done():
+                await interaction.followup.send(embed=error.embed, ephemeral=True)
+            else:
+                await interaction.response.send_message(embed=error.embed, ephemeral=True)
+            return
+        if interaction.command:
+            event_logger.log_command(interaction, interaction.command.qualified_name, failed=True)
+        await super().on_error(interaction, error)
+
+class DiscordBot(commands.AutoShardedBot):
+    def __init__(self):
+        super().__init__(
+            command_prefix='!', intents=intents, tree_cls=BotCommandTree,
+            shard_count=SHARD_COUNT or None, shard_ids=SHARD_IDS or None,
+            member_cache_flags=discord.MemberCacheFlags.none() if LEAN_MEMBER_CACHE else discord.MemberCacheFlags.from_intents(intents),
+            chunk_guilds_at_startup=not LEAN_MEMBER_CACHE
+        )
+        self.db_path = DB_PATH
+        self.db = Database(self.db_path)
+        self.migration_task: Optional[asyncio.Task] = None
 
     async def setup_hook(self):
+        # Persistent views: buttons on panels posted before a restart keep working
+        for view in (TicketView(), CloseTicketView(), AllFeaturesView(), GiveawayView()):
+            self.add_view(view)
+
+        if METRICS_PORT:
+            await metrics.start(METRICS_HOST, METRICS_PORT)
+        await self.db.connect()
         await self.setup_database()
-        birthday_check.start()
+        # Command sync, migrations and the global jobs belong to the leader (see on_leadership_change);
+        # a single process wins the lease straight away unless a previous one still holds it
+        await leader_lease.acquire()
+        await load_channel_config()
+        await birthday_calendar.load()
+        await xp_policy.load()
+        await schedule_open_giveaways()
+        job_scheduler.start()
+        leader_lease.start()
+        if SHARD_IDS:
+            job_poll_loop.start()
+        xp_flush_loop.start()
+        ledger_flush_loop.start()
+        ledger_reconcile_loop.start()
+        event_logger.start()
+        transcript_index.start()
+
+    async def close(self):
+        await super().close()
+        if self.migration_task:
+            self.migration_task.cancel()
+        job_scheduler.close()
+        job_poll_loop.cancel()
+        # Hand leadership over now rather than when the lease expires
+        await leader_lease.close()
+        xp_flush_loop.cancel()
+        ledger_flush_loop.cancel()
+        ledger_reconcile_loop.cancel()
+        await xp_aggregator.flush()
+        await diamond_ledger.flush()
+        await event_logger.close()
+        await transcript_index.close()
+        rank_cards.close()
+        await metrics.close()
+        if SQL_DEBUG:
+            self.db.profiler.dump(SQL_PROFILE_PATH)
+            print(f"🐢 SQL profile written to {SQL_PROFILE_PATH}")
+        await self.db.close()
 
     async def setup_database(self):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.db.transaction() as db:
             # Users table for leveling
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    guild_id INTEGER,
-                    xp INTEGER DEFAULT 0,
-                    level INTEGER DEFAULT 0,
-                    messages INTEGER DEFAULT 0
-                )
-            ''')
+            await db.execute(USERS_TABLE_SQL.format(name="users"))
 
             # Tickets table
             await db.execute('''
@@ -47,7 +615,55 @@ class DiscordBot(commands.Bot):
                     guild_id INTEGER,
                     channel_id INTEGER,
                     status TEXT DEFAULT 'open',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    channel_name TEXT,
+                    closed_at TIMESTAMP
+                )
+            ''')
+            await add_column_if_missing(db, "tickets", "channel_name", "TEXT")
+            await add_column_if_missing(db, "tickets", "closed_at", "TIMESTAMP")
+
+            # Per-guild XP channel rules (channels or categories); see XPPolicy
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS xp_channel_rules (
+                    guild_id INTEGER NOT NULL,
+                    channel_id INTEGER NOT NULL,
+                    rule TEXT NOT NULL CHECK (rule IN ('allow', 'deny')),
+                    PRIMARY KEY (guild_id, channel_id)
+                )
+            ''')
+
+            # Leader election between cluster processes; see LeaderLease
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+
+            # Startup panels posted per guild, so restarts edit them instead of posting new ones
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS panels (
+                    guild_id INTEGER NOT NULL,
+                    panel TEXT NOT NULL,
+                    channel_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (guild_id, panel)
+                )
+            ''')
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_panels_message ON panels (message_id)")
+
+            # Full-text index over closed-ticket transcripts, one row per history page
+            await db.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS ticket_search USING fts5(
+                    content,
+                    ticket_id UNINDEXED,
+                    guild_id UNINDEXED,
+                    user_id UNINDEXED,
+                    tokenize = 'porter unicode61'
                 )
             ''')
 
@@ -62,7 +678,25 @@ class DiscordBot(commands.Bot):
                     winner_count INTEGER,
                     end_time TIMESTAMP,
                     host_id INTEGER,
-                    participants TEXT DEFAULT '[]'
+                    participants TEXT DEFAULT '[]',
+                    ended INTEGER DEFAULT 0,
+                    winners TEXT
+                )
+            ''')
+            await add_column_if_missing(db, "giveaways", "ended", "INTEGER DEFAULT 0")
+            await add_column_if_missing(db, "giveaways", "winners", "TEXT")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_giveaways_message ON giveaways (message_id)")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_giveaways_due ON giveaways (ended, end_time)")
+
+            # One row per giveaway entrant; entry_no is dense (1..N) per giveaway for indexed sampling
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS giveaway_entries (
+                    giveaway_id INTEGER NOT NULL,
+                    entry_no INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    entered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (giveaway_id, entry_no),
+                    UNIQUE (giveaway_id, user_id)
                 )
             ''')
 
@@ -72,9 +706,11 @@ class DiscordBot(commands.Bot):
                     user_id INTEGER PRIMARY KEY,
                     guild_id INTEGER,
                     birth_date TEXT,
-                    birth_year INTEGER
+                    birth_year INTEGER,
+                    timezone TEXT
                 )
             ''')
+            await add_column_if_missing(db, "birthdays", "timezone", "TEXT")
 
             # Logs table
             await db.execute('''
@@ -90,15 +726,82 @@ class DiscordBot(commands.Bot):
             ''')
 
             # Diamond currency table (for mini games only)
+            await db.execute(DIAMONDS_TABLE_SQL.format(name="diamonds"))
+
+            # Append-only Diamond ledger: one row per balance mutation
             await db.execute('''
-                CREATE TABLE IF NOT EXISTS diamonds (
-                    user_id INTEGER PRIMARY KEY,
+                CREATE TABLE IF NOT EXISTS diamond_ledger (
+                    entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    guild_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    delta INTEGER NOT NULL,
+                    balance_after INTEGER NOT NULL,
+                    reason TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_diamond_ledger_user ON diamond_ledger (guild_id, user_id, entry_id)"
+            )
+            for event in ("UPDATE", "DELETE"):
+                await db.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS diamond_ledger_no_{event.lower()} BEFORE {event} ON diamond_ledger
+                    BEGIN
+                        SELECT RAISE(ABORT, 'diamond_ledger is append-only');
+                    END
+                ''')
+
+            # Last ledger entry verified for each user (reconciliation checkpoints)
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+                    guild_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    entry_id INTEGER NOT NULL,
+                    balance INTEGER NOT NULL,
+                    PRIMARY KEY (guild_id, user_id)
+                )
+            ''')
+
+            # Persistent timed jobs (see JobScheduler); job_key makes scheduling idempotent
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_key TEXT UNIQUE,
+                    kind TEXT NOT NULL,
+                    run_at REAL NOT NULL,
+                    payload TEXT,
                     guild_id INTEGER,
-                    balance INTEGER DEFAULT 0,
-                    last_daily TIMESTAMP,
-                    daily_streak INTEGER DEFAULT 0,
-                    total_earned INTEGER DEFAULT 0,
-                    multiplier REAL DEFAULT 1.0
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Hourly rollups maintained as log events are flushed
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS command_stats (
+                    guild_id INTEGER NOT NULL,
+                    hour TEXT NOT NULL,
+                    command TEXT NOT NULL,
+                    uses INTEGER DEFAULT 0,
+                    errors INTEGER DEFAULT 0,
+                    total_ms REAL DEFAULT 0,
+                    max_ms REAL DEFAULT 0,
+                    PRIMARY KEY (guild_id, hour, command)
+                )
+            ''')
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS activity_stats (
+                    guild_id INTEGER NOT NULL,
+                    hour TEXT NOT NULL,
+                    messages INTEGER DEFAULT 0,
+                    PRIMARY KEY (guild_id, hour)
+                )
+            ''')
+
+            # Small key/value store for bot bookkeeping
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS bot_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
                 )
             ''')
 
@@ -121,10 +824,166 @@ class DiscordBot(commands.Bot):
                 )
             ''')
 
-            await db.commit()
+        # Databases from before migrations 1 and 2 key these tables by user_id alone
+        await refresh_legacy_keyed_tables(self.db)
 
 bot = DiscordBot()
 
+# Schema migrations (tracked with PRAGMA user_version)
+MIGRATION_CHUNK_SIZE = int(os.getenv("MIGRATION_CHUNK_SIZE", "5000"))  # rows copied per write transaction
+MIGRATION_CHUNK_PAUSE = float(os.getenv("MIGRATION_CHUNK_PAUSE", "0.05"))  # seconds yielded between chunks
+
+MIGRATIONS: list[tuple[int, str, Callable]] = []
+
+def migration(version: int, description: str):
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+async def run_migrations():
+    try:
+        version = (await bot.db.fetchone("PRAGMA user_version"))[0]
+        for target, description, apply in sorted(MIGRATIONS, key=lambda m: m[0]):
+            if target <= version:
+                continue
+            print(f"🔧 Applying migration {target}: {description}")
+            await apply(bot.db)
+            await bot.db.execute(f"PRAGMA user_version = {int(target)}")
+            version = target
+            print(f"✅ Migration {target} complete")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"❌ Migration failed: {e}")
+
+async def primary_key_columns(db: Database, table: str) -> list[str]:
+    rows = await db.fetchall(f"PRAGMA table_info({table})")
+    return [name for _, name, _, _, _, pk in sorted(rows, key=lambda row: row[5]) if pk]
+
+async def refresh_legacy_keyed_tables(db: Database):
+    legacy_keyed_tables.clear()
+    for table in ("users", "diamonds"):
+        if await primary_key_columns(db, table) != ["guild_id", "user_id"]:
+            legacy_keyed_tables.add(table)
+
+async def rebuild_table_online(db: Database, table: str, create_sql: str, columns: list[str],
+                               key: tuple[str, ...] = ("guild_id", "user_id")):
+    """Copy `table` into a reshaped replacement in bounded chunks while the bot keeps writing to it.
+
+    Triggers mirror every live insert/update into the replacement, the backfill only fills rows the
+    triggers haven't written yet, and the final swap is one short transaction. Re-running after an
+    interruption simply resumes the idempotent backfill.
+    """
+    new_table = f"{table}_new"
+    column_list = ", ".join(columns)
+    new_values = ", ".join(f"NEW.{column}" for column in columns)
+    key_match = " AND ".join(f"{column} = NEW.{column}" for column in key)
+
+    async with db.transaction() as conn:
+        # sqlite3 only opens a transaction implicitly before DML; without BEGIN each DDL statement
+        # here would commit on its own, and other connections could see the steps half done
+        await conn.execute("BEGIN IMMEDIATE")
+        await conn.execute(create_sql.format(name=new_table))
+        # Delete-then-insert rather than INSERT OR REPLACE: an upsert on the live table runs its
+        # triggers under ABORT, which overrides a conflict clause inside the trigger body.
+        # Recreated on every run so a resumed migration doesn't keep an older trigger body.
+        for event in ("INSERT", "UPDATE"):
+            await conn.execute(f"DROP TRIGGER IF EXISTS {table}_mirror_{event.lower()}")
+            await conn.execute(f'''
+                CREATE TRIGGER {table}_mirror_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    DELETE FROM {new_table} WHERE {key_match};
+                    INSERT INTO {new_table} ({column_list}) VALUES ({new_values});
+                END
+            ''')
+
+    last_rowid = 0
+    copied = 0
+    chunks = 0
+    while True:
+        async with db.transaction() as conn:
+            cursor = await conn.execute(
+                f"SELECT max(rowid), count(*) FROM (SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                (last_rowid, MIGRATION_CHUNK_SIZE)
+            )
+            upper, count = await cursor.fetchone()
+            if not count:
+                break
+            await conn.execute(
+                f"INSERT OR IGNORE INTO {new_table} ({column_list}) "
+                f"SELECT {column_list} FROM {table} WHERE rowid > ? AND rowid <= ?",
+                (last_rowid, upper)
+            )
+        last_rowid = upper
+        copied += count
+        chunks += 1
+        if chunks % 20 == 0:
+            print(f"🔧 {table}: {copied:,} rows backfilled")
+        await asyncio.sleep(MIGRATION_CHUNK_PAUSE)
+
+    async with db.transaction() as conn:
+        await conn.execute("BEGIN IMMEDIATE")  # readers must never see `table` dropped but not yet replaced
+        await conn.execute(f"DROP TRIGGER IF EXISTS {table}_mirror_insert")
+        await conn.execute(f"DROP TRIGGER IF EXISTS {table}_mirror_update")
+        await conn.execute(f"DROP TABLE {table}")
+        await conn.execute(f"ALTER TABLE {new_table} RENAME TO {table}")
+
+@migration(1, "Key users by (guild_id, user_id)")
+async def migrate_users_composite_key(db: Database):
+    if await primary_key_columns(db, "users") == ["guild_id", "user_id"]:
+        return
+    await rebuild_table_online(db, "users", USERS_TABLE_SQL, ["guild_id", "user_id", "xp", "level", "messages"])
+    legacy_keyed_tables.discard("users")
+
+@migration(2, "Key diamonds by (guild_id, user_id)")
+async def migrate_diamonds_composite_key(db: Database):
+    if await primary_key_columns(db, "diamonds") == ["guild_id", "user_id"]:
+        return
+    await rebuild_table_online(db, "diamonds", DIAMONDS_TABLE_SQL, [
+        "guild_id", "user_id", "balance", "last_daily", "daily_streak", "total_earned", "multiplier"
+    ])
+    legacy_keyed_tables.discard("diamonds")
+
+@migration(3, "Covering indexes for leaderboards, tickets and birthdays")
+async def migrate_covering_indexes(db: Database):
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS idx_users_rank ON users (guild_id, level DESC, xp DESC, user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_diamonds_rank ON diamonds (guild_id, balance DESC, user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_tickets_channel ON tickets (channel_id)",
+        "CREATE INDEX IF NOT EXISTS idx_tickets_open ON tickets (guild_id, user_id, status, channel_id)",
+        "CREATE INDEX IF NOT EXISTS idx_birthdays_date ON birthdays (birth_date)",
+    ):
+        # One index per transaction keeps each writer-lock hold short
+        await db.execute(statement)
+
+@migration(4, "Move giveaway participants from JSON into giveaway_entries")
+async def migrate_giveaway_participants(db: Database):
+    last_id = 0
+    while True:
+        rows = await db.fetchall(
+            "SELECT giveaway_id, participants FROM giveaways "
+            "WHERE giveaway_id > ? AND participants IS NOT NULL AND participants != '[]' "
+            "ORDER BY giveaway_id LIMIT 100",
+            (last_id,)
+        )
+        if not rows:
+            break
+        for giveaway_id, participants in rows:
+            user_ids = json.loads(participants)
+            for start in range(0, len(user_ids), MIGRATION_CHUNK_SIZE):
+                async with db.transaction() as conn:
+                    for user_id in user_ids[start:start + MIGRATION_CHUNK_SIZE]:
+                        await conn.execute(GIVEAWAY_ENTRY_SQL, (giveaway_id, int(user_id), giveaway_id))
+                await asyncio.sleep(MIGRATION_CHUNK_PAUSE)
+            await db.execute("UPDATE giveaways SET participants = '[]' WHERE giveaway_id = ?", (giveaway_id,))
+        last_id = rows[-1][0]
+
+@migration(5, "Partial index for non-default XP multipliers")
+async def migrate_multiplier_index(db: Database):
+    # XPPolicy.load reads only the few members with a multiplier; without this it scans all of diamonds
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_diamonds_multiplier ON diamonds (guild_id, user_id, multiplier) WHERE multiplier != 1.0")
+
 # AUTOMATIC CHANNEL CONFIGURATION - Set your channel IDs here
 DEFAULT_CHANNELS = {
     "ticket": int(os.getenv("TICKET_CHANNEL_ID", "0")),
@@ -135,105 +994,1752 @@ DEFAULT_CHANNELS = {
     "transcript": int(os.getenv("TRANSCRIPT_CHANNEL_ID", "0"))
 }
 
-# Helper function to get channel IDs (automatic from environment or database fallback)
+# Environment channel IDs are per-guild defaults; a guild's own /configure values take precedence
+ENV_CHANNEL_DEFAULTS = {
+    channel_type: channel_id for channel_type, channel_id in DEFAULT_CHANNELS.items() if channel_id > 0
+}
+
+# In-memory snapshot of the channel_config table, loaded once at startup and updated on every write
+channel_config_cache: dict[int, dict[str, int]] = {}
+
+async def load_channel_config():
+    rows = await bot.db.fetchall("SELECT guild_id, channel_type, channel_id FROM channel_config")
+    channel_config_cache.clear()
+    for guild_id, channel_type, channel_id in rows:
+        channel_config_cache.setdefault(guild_id, {})[channel_type] = channel_id
+
+# Helper function to get channel IDs (environment defaults overlaid with the guild's cached configuration)
 async def get_channel_config(guild_id: int) -> dict:
-    # First try to use environment variables (automatic configuration)
-    config = {}
-    for channel_type, channel_id in DEFAULT_CHANNELS.items():
-        if channel_id > 0:  # Valid channel ID
-            config[channel_type] = channel_id
-    
-    # If no environment variables set, fall back to database
-    if not config:
-        async with aiosqlite.connect(bot.db_path) as db:
-            async with db.execute(
-                "SELECT channel_type, channel_id FROM channel_config WHERE guild_id = ?",
-                (guild_id,)
-            ) as cursor:
-                results = await cursor.fetchall()
-                config = {channel_type: channel_id for channel_type, channel_id in results}
-    
-    return config
+    guild_config = channel_config_cache.get(guild_id)
+    if not guild_config:
+        return dict(ENV_CHANNEL_DEFAULTS)
+    return {**ENV_CHANNEL_DEFAULTS, **guild_config}
+
+async def set_channel_configs(guild_id: int, channels: dict[str, int]):
+    await bot.db.executemany(
+        "INSERT OR REPLACE INTO channel_config (guild_id, channel_type, channel_id) VALUES (?, ?, ?)",
+        [(guild_id, channel_type, channel_id) for channel_type, channel_id in channels.items()]
+    )
+    # Write-through: only update the snapshot once the rows are committed
+    channel_config_cache.setdefault(guild_id, {}).update(channels)
 
 async def set_channel_config(guild_id: int, channel_type: str, channel_id: int):
-    async with aiosqlite.connect(bot.db_path) as db:
-        await db.execute(
-            "INSERT OR REPLACE INTO channel_config (guild_id, channel_type, channel_id) VALUES (?, ?, ?)",
-            (guild_id, channel_type, channel_id)
+    await set_channel_configs(guild_id, {channel_type: channel_id})
+
+# Job scheduler (durable timed actions)
+JOB_RESUME_BATCH = int(os.getenv("JOB_RESUME_BATCH", "500"))  # pending jobs loaded per query at startup
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "10"))  # jobs allowed to run at the same time
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "15"))  # seconds between checks for jobs other cluster processes scheduled
+
+class JobScheduler:
+    """Timed jobs persisted in the `jobs` table and driven by an in-memory min-heap with one wakeup timer.
+
+    Scheduling is an insert plus a heap push (O(log n)); cancelling drops the job from the live map and
+    its heap entry is skipped when it surfaces, with a rebuild once most of the heap is dead. Jobs survive
+    restarts: pending rows are reloaded in batches on startup and overdue ones run first, at most
+    JOB_CONCURRENCY at a time. A handler that returns a timestamp re-arms the same job (recurring jobs).
+
+    In a cluster, each process only arms the jobs it owns: those of guilds on its shards, plus the
+    guild-less (global) jobs while it is the leader. Jobs scheduled for another process's guilds are
+    picked up by that process's next poll.
+    """
+
+    def __init__(self):
+        self._handlers: dict[str, Callable] = {}
+        self._heap: list[tuple[float, int]] = []  # (run_at, job_id)
+        self._jobs: dict[int, tuple[str, dict, float, Optional[int]]] = {}  # live jobs: job_id -> (kind, payload, run_at, guild_id)
+        self._executing: set[int] = set()  # job IDs currently running
+        self._seen_id = 0  # highest job ID loaded, for polling
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running: set[asyncio.Task] = set()
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def handler(self, kind: str):
+        def decorator(func):
+            self._handlers[kind] = func
+            return func
+        return decorator
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    @staticmethod
+    def owns(guild_id: Optional[int]) -> bool:
+        return leader_lease.is_leader if guild_id is None else owns_guild(guild_id)
+
+    async def schedule(self, kind: str, run_at: float, payload: Optional[dict] = None,
+                       guild_id: Optional[int] = None, key: Optional[str] = None) -> Optional[int]:
+        """Persist and arm a job to run at `run_at` (unix time). With a key, an existing job wins."""
+        payload = payload or {}
+        cursor = await bot.db.execute(
+            "INSERT OR IGNORE INTO jobs (job_key, kind, run_at, payload, guild_id) VALUES (?, ?, ?, ?, ?)",
+            (key, kind, run_at, json.dumps(payload), guild_id)
         )
-        await db.commit()
+        if cursor.rowcount != 1:
+            return None
+        if self.owns(guild_id):
+            self._push(cursor.lastrowid, kind, payload, run_at, guild_id)
+        return cursor.lastrowid
+
+    async def cancel(self, job_id: int):
+        self._jobs.pop(job_id, None)
+        await bot.db.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+        if len(self._heap) > 64 and len(self._jobs) < len(self._heap) // 2:
+            self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        self._heap = [(run_at, job_id) for job_id, (_, _, run_at, _) in self._jobs.items()]
+        heapq.heapify(self._heap)
+
+    def _push(self, job_id: int, kind: str, payload: dict, run_at: float, guild_id: Optional[int]):
+        self._jobs[job_id] = (kind, payload, run_at, guild_id)
+        heapq.heappush(self._heap, (run_at, job_id))
+        if self._heap[0][1] == job_id:
+            self._wakeup.set()  # new earliest job: re-arm the timer
+
+    def start(self):
+        self._slots = asyncio.Semaphore(JOB_CONCURRENCY)
+        self._task = asyncio.create_task(self._run())
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for task in self._running:
+            task.cancel()
+
+    async def _resume(self, last_id: int = 0):
+        while True:
+            rows = await bot.db.fetchall(
+                "SELECT job_id, kind, run_at, payload, guild_id FROM jobs WHERE job_id > ? ORDER BY job_id LIMIT ?",
+                (last_id, JOB_RESUME_BATCH)
+            )
+            for job_id, kind, run_at, payload, guild_id in rows:
+                if job_id not in self._jobs and job_id not in self._executing and self.owns(guild_id):
+                    self._push(job_id, kind, json.loads(payload or "{}"), run_at, guild_id)
+            if rows:
+                self._seen_id = max(self._seen_id, rows[-1][0])
+            if len(rows) < JOB_RESUME_BATCH:
+                break
+            last_id = rows[-1][0]
+
+    async def poll(self):
+        """Arm owned jobs that other processes scheduled since the last look."""
+        await self._resume(self._seen_id)
+
+    async def adopt_global_jobs(self):
+        # Leadership gained after startup: the guild-less jobs may have any ID, so look at them all
+        if self._task:
+            await self._resume()
+
+    def release_global_jobs(self):
+        # Leadership lost: the new leader runs them from now on
+        for job_id in [job_id for job_id, job in self._jobs.items() if job[3] is None]:
+            del self._jobs[job_id]
+        self._rebuild_heap()
+        self._wakeup.set()
+
+    async def _run(self):
+        # Handlers need the guild/channel cache
+        await bot.wait_until_ready()
+        await self._resume()
+
+        while True:
+            self._wakeup.clear()
+            while self._heap and self._heap[0][1] not in self._jobs:
+                heapq.heappop(self._heap)  # cancelled
+
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
 
-# Birthday checker task
-@tasks.loop(hours=24)
-async def birthday_check():
-    today = datetime.datetime.now().strftime("%m-%d")
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
 
-    async with aiosqlite.connect(bot.db_path) as db:
-        async with db.execute(
-            "SELECT user_id, guild_id, birth_year FROM birthdays WHERE birth_date = ?",
-            (today,)
-        ) as cursor:
-            birthdays = await cursor.fetchall()
+            _, job_id = heapq.heappop(self._heap)
+            kind, payload, run_at, guild_id = self._jobs.pop(job_id)
+            self._executing.add(job_id)
+            await self._slots.acquire()
+            task = asyncio.create_task(self._execute(job_id, kind, payload, run_at, guild_id))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _execute(self, job_id: int, kind: str, payload: dict, run_at: float, guild_id: Optional[int]):
+        next_run = None
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            handler = self._handlers.get(kind)
+            if handler:
+                next_run = await handler(run_at=run_at, **payload)
+                outcome = "ok"
+            else:
+                print(f"❌ No handler for job kind: {kind}")
+        except Exception as e:
+            print(f"❌ Job {job_id} ({kind}) failed: {e}")
+        finally:
+            self._slots.release()
+            job_seconds.observe(time.perf_counter() - started, kind, outcome)
 
-    for user_id, guild_id, birth_year in birthdays:
-        guild = bot.get_guild(guild_id)
-        user = guild.get_member(user_id) if guild else None
+        # The row is only touched after running: a crash mid-job means it runs again on the next start
+        try:
+            if next_run is not None:
+                await bot.db.execute("UPDATE jobs SET run_at = ? WHERE job_id = ?", (next_run, job_id))
+                if self.owns(guild_id):
+                    self._push(job_id, kind, payload, next_run, guild_id)
+            else:
+                await bot.db.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+        finally:
+            self._executing.discard(job_id)
 
-        if user and guild:
-            age_text = ""
-            if birth_year:
-                age = datetime.datetime.now().year - birth_year
-                age_text = f" (turning {age})"
+job_scheduler = JobScheduler()
 
-            embed = discord.Embed(
-                title="🎂 Happy Birthday!",
-                description=f"It's {user.mention}'s birthday today{age_text}! 🎉",
-                color=0xff69b4
+@tasks.loop(seconds=JOB_POLL_INTERVAL)
+async def job_poll_loop():
+    try:
+        await job_scheduler.poll()
+    except Exception as e:
+        print(f"❌ Failed to poll for jobs: {e}")
+
+# Cluster coordination (leader election)
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "30"))  # seconds a leader stays leader without renewing
+
+class LeaderLease:
+    """Leadership held as a renewable row in the shared `leases` table.
+
+    Acquiring and renewing is one conditional upsert: it succeeds when the row is ours or has
+    expired, so at most one live process holds the lease. The holder renews every third of the
+    TTL; if it dies, another process takes over once the lease runs out.
+    """
+
+    def __init__(self, name: str = "leader", holder: str = CLUSTER_WORKER_ID, ttl: float = LEADER_LEASE_TTL):
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self.is_leader = False
+        self._expires_at = 0.0
+        self._callbacks: list[Callable] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def on_change(self, func):
+        self._callbacks.append(func)
+        return func
+
+    async def acquire(self) -> bool:
+        now = time.time()
+        try:
+            async with bot.db.transaction() as db:
+                cursor = await db.execute('''
+                    INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+                    ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+                    WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+                    RETURNING expires_at
+                ''', (self.name, self.holder, now + self.ttl, now))
+                won = await cursor.fetchone() is not None
+        except Exception as e:
+            print(f"❌ Failed to renew the {self.name} lease: {e}")
+            won = self.is_leader and time.time() < self._expires_at  # still ours until it runs out
+        else:
+            if won:
+                self._expires_at = now + self.ttl
+        await self._set(won)
+        return won
+
+    async def _set(self, leader: bool):
+        if leader == self.is_leader:
+            return
+        self.is_leader = leader
+        print(f"👑 {self.holder} is now the {self.name}" if leader else f"👑 {self.holder} is no longer the {self.name}")
+        for callback in self._callbacks:
+            try:
+                await callback(leader)
+            except Exception as e:
+                print(f"❌ Leadership change handler {callback.__name__} failed: {e}")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            await self.acquire()
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self.is_leader:
+            self.is_leader = False
+            await bot.db.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (self.name, self.holder))
+
+leader_lease = LeaderLease()
+
+@leader_lease.on_change
+async def on_leadership_change(leader: bool):
+    if not leader:
+        if bot.migration_task:
+            bot.migration_task.cancel()
+            bot.migration_task = None
+        job_scheduler.release_global_jobs()
+        return
+
+    # Only when commands changed since the last sync by any process
+    await sync_commands()
+    # Migrations backfill in small chunks, so they run alongside normal event handling
+    if bot.migration_task is None or bot.migration_task.done():
+        bot.migration_task = asyncio.create_task(run_migrations())
+    # Recurring hourly job; a no-op when it already exists from a previous run
+    await job_scheduler.schedule("birthday_check", (time.time() // 3600 + 1) * 3600, key="birthday_check")
+    await job_scheduler.adopt_global_jobs()
+
+# Member resolution
+class MemberResolver:
+    """Guild members by ID without needing every member of every guild in memory.
+
+    Normally this is just the gateway's member cache. With LEAN_MEMBER_CACHE it is an LRU of
+    recently active and looked-up members (MEMBER_CACHE_SIZE, including "not in this guild"
+    answers); misses are collected per guild and resolved together through query_members, up to
+    MEMBER_QUERY_BATCH user IDs per request, so a leaderboard page costs one gateway round trip.
+    """
+
+    def __init__(self, lean: bool = LEAN_MEMBER_CACHE, size: int = MEMBER_CACHE_SIZE):
+        self.lean = lean
+        self.size = size
+        self._members: OrderedDict[tuple[int, int], Optional[discord.Member]] = OrderedDict()
+        self._pending: dict[int, dict[int, asyncio.Future]] = {}  # guild_id -> user_id -> lookup in flight
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def _put(self, guild_id: int, user_id: int, member: Optional[discord.Member]):
+        self._members[(guild_id, user_id)] = member
+        self._members.move_to_end((guild_id, user_id))
+        if len(self._members) > self.size:
+            self._members.popitem(last=False)
+
+    def touch(self, member):
+        """Remember a member seen in an event (message author, interaction user, new join)."""
+        if self.lean and isinstance(member, discord.Member):
+            self._put(member.guild.id, member.id, member)
+
+    def forget(self, guild_id: int, user_id: int):
+        self._members.pop((guild_id, user_id), None)
+
+    async def get(self, guild: discord.Guild, user_id: int) -> Optional[discord.Member]:
+        return (await self.get_many(guild, [user_id])).get(user_id)
+
+    async def get_many(self, guild: discord.Guild, user_ids) -> dict[int, discord.Member]:
+        if not self.lean:
+            return {user_id: member for user_id in user_ids if (member := guild.get_member(user_id))}
+
+        found: dict[int, discord.Member] = {}
+        lookups: dict[int, asyncio.Future] = {}
+        for user_id in user_ids:
+            key = (guild.id, user_id)
+            if key in self._members:
+                self.hits += 1
+                self._members.move_to_end(key)
+                if self._members[key] is not None:
+                    found[user_id] = self._members[key]
+            elif user_id not in lookups:
+                self.misses += 1
+                lookups[user_id] = self._request(guild, user_id)
+        for user_id, member in zip(lookups, await asyncio.gather(*lookups.values())):
+            if member is not None:
+                found[user_id] = member
+        return found
+
+    def _request(self, guild: discord.Guild, user_id: int) -> asyncio.Future:
+        pending = self._pending.get(guild.id)
+        if pending is None:
+            pending = self._pending[guild.id] = {}
+            asyncio.create_task(self._resolve(guild))
+        if user_id not in pending:
+            pending[user_id] = asyncio.get_running_loop().create_future()
+        return pending[user_id]
+
+    async def _resolve(self, guild: discord.Guild):
+        # Let lookups made in the same loop iteration (other commands, the rest of a page) join the batch
+        await asyncio.sleep(0)
+        pending = self._pending.pop(guild.id)
+        user_ids = list(pending)
+        for start in range(0, len(user_ids), MEMBER_QUERY_BATCH):
+            batch = user_ids[start:start + MEMBER_QUERY_BATCH]
+            self.queries += 1
+            try:
+                members = {member.id: member for member in await guild.query_members(user_ids=batch, limit=len(batch), cache=False)}
+            except discord.ClientException:
+                # No gateway connection for this guild's shard: fall back to fetching over HTTP
+                members = {}
+                for user_id in batch:
+                    try:
+                        members[user_id] = await guild.fetch_member(user_id)
+                    except discord.NotFound:
+                        pass
+                    except discord.HTTPException as e:
+                        print(f"❌ Failed to fetch member {user_id} in {guild.name}: {e}")
+                        members[user_id] = None  # unknown, so not remembered as missing
+            except Exception as e:
+                print(f"❌ Failed to query members in {guild.name}: {e}")
+                for user_id in batch:
+                    if not pending[user_id].done():
+                        pending[user_id].set_result(None)
+                continue
+            for user_id in batch:
+                member = members.get(user_id)
+                if user_id not in members or member is not None:
+                    self._put(guild.id, user_id, member)
+                if not pending[user_id].done():
+                    pending[user_id].set_result(member)
+
+member_cache = MemberResolver()
+
+@bot.event
+async def on_member_join(member: discord.Member):
+    member_cache.touch(member)
+
+@bot.event
+async def on_raw_member_remove(payload: discord.RawMemberRemoveEvent):
+    member_cache.forget(payload.guild_id, payload.user.id)
+
+# Birthday system
+BIRTHDAY_TIMEZONE = os.getenv("BIRTHDAY_TIMEZONE", "UTC")  # used for members who haven't set a timezone
+BIRTHDAY_ANNOUNCE_HOUR = int(os.getenv("BIRTHDAY_ANNOUNCE_HOUR", "0"))  # local hour birthdays are announced
+BIRTHDAY_FANOUT = int(os.getenv("BIRTHDAY_FANOUT", "5"))  # guild announcements sent at the same time
+
+def parse_birthday(date: str) -> str:
+    """Normalize MM-DD input (raises ValueError). Parsed against a leap year so 02-29 is accepted."""
+    return datetime.datetime.strptime(f"2000-{date.strip()}", "%Y-%m-%d").strftime("%m-%d")
+
+def parse_timezone(name: Optional[str]) -> Optional[str]:
+    """Validate an IANA timezone name such as Asia/Kolkata (raises ValueError)."""
+    if not name:
+        return None
+    try:
+        return str(zoneinfo.ZoneInfo(name.strip()))
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown timezone: {name}")
+
+def is_leap_year(year: int) -> bool:
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+class BirthdayCalendar:
+    """In-memory mirror of the birthdays table, indexed by month-day and timezone bucket."""
+
+    def __init__(self):
+        # "MM-DD" -> timezone (None = BIRTHDAY_TIMEZONE) -> user_id -> (guild_id, birth_year)
+        self._days: dict[str, dict[Optional[str], dict[int, tuple[int, Optional[int]]]]] = {}
+        self._users: dict[int, tuple[str, Optional[str]]] = {}  # user_id -> (month_day, timezone)
+        self._timezones: dict[Optional[str], int] = {}  # timezone -> number of birthdays in it
+
+    async def load(self):
+        rows = await bot.db.fetchall("SELECT user_id, guild_id, birth_date, birth_year, timezone FROM birthdays")
+        self._days.clear()
+        self._users.clear()
+        self._timezones.clear()
+        for user_id, guild_id, birth_date, birth_year, timezone in rows:
+            self.set(user_id, guild_id, birth_date, birth_year, timezone)
+
+    def set(self, user_id: int, guild_id: int, month_day: str, birth_year: Optional[int], timezone: Optional[str]):
+        self.remove(user_id)
+        self._days.setdefault(month_day, {}).setdefault(timezone, {})[user_id] = (guild_id, birth_year)
+        self._users[user_id] = (month_day, timezone)
+        self._timezones[timezone] = self._timezones.get(timezone, 0) + 1
+
+    def remove(self, user_id: int):
+        previous = self._users.pop(user_id, None)
+        if previous is None:
+            return
+        month_day, timezone = previous
+        bucket = self._days[month_day][timezone]
+        del bucket[user_id]
+        if not bucket:
+            del self._days[month_day][timezone]
+        self._timezones[timezone] -= 1
+        if not self._timezones[timezone]:
+            del self._timezones[timezone]
+
+    @property
+    def timezones(self) -> list[Optional[str]]:
+        return list(self._timezones)
+
+    def on(self, day: datetime.date, timezone: Optional[str] = None) -> list[tuple[int, int, Optional[int]]]:
+        """(user_id, guild_id, birth_year) celebrating on `day` in one timezone bucket."""
+        month_days = [day.strftime("%m-%d")]
+        if month_days[0] == "02-28" and not is_leap_year(day.year):
+            month_days.append("02-29")  # Leap-day birthdays are celebrated on Feb 28 in other years
+
+        return [
+            (user_id, guild_id, birth_year)
+            for month_day in month_days
+            for user_id, (guild_id, birth_year) in self._days.get(month_day, {}).get(timezone, {}).items()
+        ]
+
+    def upcoming(self, guild_id: int, start: datetime.date, days: int) -> list[tuple[datetime.date, int, Optional[int]]]:
+        """(date, user_id, birth_year) for a guild's birthdays in the next `days` days, in date order."""
+        results = []
+        for offset in range(days):
+            day = start + datetime.timedelta(days=offset)
+            for timezone in self.timezones:
+                results.extend(
+                    (day, user_id, birth_year)
+                    for user_id, member_guild, birth_year in self.on(day, timezone)
+                    if member_guild == guild_id
+                )
+        return results
+
+birthday_calendar = BirthdayCalendar()
+
+async def save_birthday(user_id: int, guild_id: int, month_day: str, birth_year: Optional[int], timezone: Optional[str]):
+    await bot.db.execute(
+        "INSERT OR REPLACE INTO birthdays (user_id, guild_id, birth_date, birth_year, timezone) VALUES (?, ?, ?, ?, ?)",
+        (user_id, guild_id, month_day, birth_year, timezone)
+    )
+    birthday_calendar.set(user_id, guild_id, month_day, birth_year, timezone)
+
+def birthday_embeds(lines: list[str]) -> list[discord.Embed]:
+    descriptions = [""]
+    for line in lines:
+        if len(descriptions[-1]) + len(line) + 1 > 4000:
+            descriptions.append("")
+        descriptions[-1] += line + "\n"
+
+    return [
+        discord.Embed(
+            title="🎂 Happy Birthday!" if i == 0 else "🎂 Happy Birthday! (continued)",
+            description=description,
+            color=0xff69b4
+        )
+        for i, description in enumerate(descriptions)
+    ]
+
+async def announce_birthdays(guild: discord.Guild, celebrants: list[tuple[int, Optional[int]]], year: int):
+    """Send one birthday message for every member of `guild` celebrating this hour."""
+    lines = []
+    members = await member_cache.get_many(guild, [user_id for user_id, _ in celebrants])
+    for user_id, birth_year in celebrants:
+        user = members.get(user_id)
+        if not user:
+            continue
+        age_text = f" (turning {year - birth_year})" if birth_year else ""
+        lines.append(f"It's {user.mention}'s birthday today{age_text}! 🎉")
+    if not lines:
+        return
+
+    # Send to designated general channel
+    config = await get_channel_config(guild.id)
+    general_channel_id = config.get("general")
+    channel = guild.get_channel(general_channel_id) if general_channel_id else None
+    if not channel:
+        channel = discord.utils.get(guild.text_channels, name="general")
+        if not channel:
+            channel = guild.text_channels[0] if guild.text_channels else None
+
+    if channel:
+        embeds = birthday_embeds(lines)
+        for i in range(0, len(embeds), 10):
+            await channel.send(embeds=embeds[i:i + 10])
+
+# Birthday checker job: runs at the top of every hour and announces for each timezone bucket
+# whose local time has just reached BIRTHDAY_ANNOUNCE_HOUR
+async def birthday_check(now: datetime.datetime):
+    by_guild: dict[int, list[tuple[int, Optional[int]]]] = {}
+
+    for timezone in birthday_calendar.timezones:
+        local_now = now.astimezone(zoneinfo.ZoneInfo(timezone or BIRTHDAY_TIMEZONE))
+        if local_now.hour != BIRTHDAY_ANNOUNCE_HOUR:
+            continue
+        for user_id, guild_id, birth_year in birthday_calendar.on(local_now.date(), timezone):
+            by_guild.setdefault(guild_id, []).append((user_id, birth_year))
+
+    semaphore = asyncio.Semaphore(BIRTHDAY_FANOUT)
+
+    async def announce(guild_id: int, celebrants: list[tuple[int, Optional[int]]]):
+        if not owns_guild(guild_id):
+            # Another cluster process has this guild's members and channels; hand the announcement over
+            await job_scheduler.schedule(
+                "birthday_announce", time.time(), {"guild_id": guild_id, "celebrants": celebrants, "year": now.year},
+                guild_id=guild_id, key=f"birthday:{guild_id}:{int(now.timestamp()) // 3600}"
             )
+            return
+        guild = bot.get_guild(guild_id)
+        if not guild:
+            return
+        async with semaphore:
+            try:
+                await announce_birthdays(guild, celebrants, now.year)
+            except Exception as e:
+                print(f"❌ Failed to announce birthdays in {guild.name}: {e}")
+
+    await asyncio.gather(*(announce(guild_id, celebrants) for guild_id, celebrants in by_guild.items()))
+
+@job_scheduler.handler("birthday_check")
+async def run_birthday_check(run_at: float) -> float:
+    if SHARD_IDS:
+        # Birthdays are set through whichever process owns the member's guild
+        await birthday_calendar.load()
+    # Evaluate the hour the job was due for, so a late run still announces the right people
+    await birthday_check(datetime.datetime.fromtimestamp(run_at, datetime.timezone.utc))
+
+    # Recurring: catch up hour by hour after downtime, but never replay more than a day
+    return max(run_at + 3600, (time.time() // 3600 - 23) * 3600)
+
+@job_scheduler.handler("birthday_announce")
+async def run_birthday_announce(run_at: float, guild_id: int, celebrants: list, year: int):
+    guild = bot.get_guild(guild_id)
+    if guild:
+        await announce_birthdays(guild, [tuple(celebrant) for celebrant in celebrants], year)
+
+# Activity logging (batched writes to the logs table)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # events buffered before new ones are dropped
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "500"))  # rows per executemany
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "2"))  # seconds to gather a batch
+LOG_SAMPLE_WATERMARK = float(os.getenv("LOG_SAMPLE_WATERMARK", "0.5"))  # queue fill where sampling kicks in
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))  # share of sampled events kept above the watermark
+
+class EventLogger:
+    """Non-blocking activity log: events go on a bounded in-process queue and are written in batches.
+
+    Hourly command and message rollups are counted in memory for every event (even sampled or
+    dropped ones) and upserted in the same transaction as each batch.
+    """
+
+    # High-volume event types that are sampled once the queue passes the watermark;
+    # everything else is only dropped when the queue is completely full
+    SAMPLED_TYPES = {"message"}
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.dropped = 0
+        self.sampled_out = 0
+        self._task: Optional[asyncio.Task] = None
+        self._command_rollup: dict[tuple[int, str, str], list] = {}  # (guild, hour, command) -> [uses, errors, total_ms, max_ms]
+        self._activity_rollup: dict[tuple[int, str], int] = {}  # (guild, hour) -> messages
+
+    def log(self, log_type: str, guild_id: Optional[int], user_id: Optional[int] = None,
+            channel_id: Optional[int] = None, **details):
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        if log_type == "message":
+            key = (guild_id or 0, timestamp[:13])
+            self._activity_rollup[key] = self._activity_rollup.get(key, 0) + 1
+
+        if (
+            log_type in self.SAMPLED_TYPES
+            and self.queue.qsize() >= LOG_QUEUE_SIZE * LOG_SAMPLE_WATERMARK
+            and random.random() >= LOG_SAMPLE_RATE
+        ):
+            self.sampled_out += 1
+            return
 
-            # Send to designated general channel
-            config = await get_channel_config(guild_id)
-            general_channel_id = config.get("general")
-            channel = guild.get_channel(general_channel_id) if general_channel_id else None
-            if not channel:
-                channel = discord.utils.get(guild.text_channels, name="general")
-                if not channel:
-                    channel = guild.text_channels[0] if guild.text_channels else None
+        content = json.dumps(details, separators=(",", ":")) if details else None
+        try:
+            self.queue.put_nowait((guild_id, log_type, user_id, channel_id, content, timestamp))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def log_command(self, interaction: discord.Interaction, command: str, failed: bool = False):
+        started_at = interaction.extras.get("started_at")
+        latency_ms = (time.perf_counter() - started_at) * 1000 if started_at else 0.0
+        guild_id = interaction.guild.id if interaction.guild else None
+        hour = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H")
+
+        stats = self._command_rollup.setdefault((guild_id or 0, hour, command), [0, 0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += failed
+        stats[2] += latency_ms
+        stats[3] = max(stats[3], latency_ms)
+
+        details = {"command": command, "latency_ms": round(latency_ms, 1)}
+        if failed:
+            details["failed"] = True
+        self.log(
+            "command", guild_id, interaction.user.id,
+            interaction.channel.id if interaction.channel else None,
+            **details
+        )
 
-            if channel:
-                await channel.send(embed=embed)
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        while not self.queue.empty():
+            await self._write(self._drain())
+        await self._write([])
+
+    def _drain(self) -> list[tuple]:
+        batch = []
+        while len(batch) < LOG_BATCH_SIZE and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while True:
+            first = await self.queue.get()
+            if self.queue.qsize() < LOG_BATCH_SIZE:
+                # Let a batch build up instead of writing one row at a time
+                await asyncio.sleep(LOG_FLUSH_INTERVAL)
+            batch = [first, *self._drain()]
+            try:
+                await self._write(batch)
+            except Exception as e:
+                print(f"❌ Failed to write {len(batch)} log events: {e}")
+
+    async def _write(self, batch: list[tuple]):
+        commands, self._command_rollup = self._command_rollup, {}
+        activity, self._activity_rollup = self._activity_rollup, {}
+        if not (batch or commands or activity):
+            return
+
+        committed = False
+        try:
+            async with bot.db.transaction() as db:
+                await db.executemany(
+                    "INSERT INTO logs (guild_id, log_type, user_id, channel_id, content, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                    batch
+                )
+                await db.executemany('''
+                    INSERT INTO command_stats (guild_id, hour, command, uses, errors, total_ms, max_ms)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (guild_id, hour, command) DO UPDATE SET
+                        uses = uses + excluded.uses,
+                        errors = errors + excluded.errors,
+                        total_ms = total_ms + excluded.total_ms,
+                        max_ms = max(max_ms, excluded.max_ms)
+                ''', [(*key, *stats) for key, stats in commands.items()])
+                await db.executemany('''
+                    INSERT INTO activity_stats (guild_id, hour, messages) VALUES (?, ?, ?)
+                    ON CONFLICT (guild_id, hour) DO UPDATE SET messages = messages + excluded.messages
+                ''', [(*key, messages) for key, messages in activity.items()])
+            committed = True
+        finally:
+            if not committed:
+                # Failed or cancelled (shutdown cancels the writer mid-batch): keep the counts
+                # for the next batch, or for close()'s final write, rather than losing them
+                for key, stats in commands.items():
+                    merged = self._command_rollup.setdefault(key, [0, 0, 0.0, 0.0])
+                    merged[0] += stats[0]
+                    merged[1] += stats[1]
+                    merged[2] += stats[2]
+                    merged[3] = max(merged[3], stats[3])
+                for key, messages in activity.items():
+                    self._activity_rollup[key] = self._activity_rollup.get(key, 0) + messages
+
+event_logger = EventLogger()
 
 # Helper functions for Diamond system (mini games only)
+LEDGER_FLUSH_INTERVAL = int(os.getenv("LEDGER_FLUSH_INTERVAL", "5"))  # seconds between ledger batches
+LEDGER_FLUSH_THRESHOLD = int(os.getenv("LEDGER_FLUSH_THRESHOLD", "200"))  # buffered entries that force a flush
+LEDGER_RECONCILE_INTERVAL = int(os.getenv("LEDGER_RECONCILE_INTERVAL", "10"))  # minutes between reconciliation runs
+LEDGER_RECONCILE_BATCH = int(os.getenv("LEDGER_RECONCILE_BATCH", "1000"))  # ledger entries verified per run of reconcile_ledger_batch
+LEDGER_RECONCILE_CHUNK = int(os.getenv("LEDGER_RECONCILE_CHUNK", "100"))  # users compared against live balances per write transaction
+BALANCE_CACHE_SIZE = int(os.getenv("BALANCE_CACHE_SIZE", "50000"))  # Diamond balances kept in memory (LRU)
+
+class DiamondLedger:
+    """Buffers one entry per balance mutation and appends them to diamond_ledger in batches."""
+
+    def __init__(self):
+        self._pending: list[tuple] = []
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def record(self, guild_id: int, user_id: int, delta: int, balance_after: int, reason: str):
+        # Called while the writer lock is held, so buffer order matches the order balances changed
+        created_at = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        self._pending.append((guild_id, user_id, delta, balance_after, reason, created_at))
+        if len(self._pending) >= LEDGER_FLUSH_THRESHOLD and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    async def write_pending(self, db: aiosqlite.Connection):
+        """Append buffered entries using a connection that already holds the writer lock."""
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        try:
+            await db.executemany(
+                "INSERT INTO diamond_ledger (guild_id, user_id, delta, balance_after, reason, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+        except Exception:
+            self._pending[:0] = rows
+            raise
+
+    async def flush(self):
+        if self._pending:
+            async with bot.db.transaction() as db:
+                await self.write_pending(db)
+
+diamond_ledger = DiamondLedger()
+
+@tasks.loop(seconds=LEDGER_FLUSH_INTERVAL)
+async def ledger_flush_loop():
+    try:
+        await diamond_ledger.flush()
+    except Exception as e:
+        print(f"❌ Failed to flush Diamond ledger: {e}")
+
+class BalanceCache:
+    """Bounded LRU of Diamond balances, written through by add_diamonds/remove_diamonds.
+
+    Every balance change goes through those two functions, so a cached value is always current.
+    A miss reads the table once; the result is only cached if no write landed meanwhile.
+    """
+
+    def __init__(self, maxsize: int = BALANCE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._balances: OrderedDict[tuple[int, int], int] = OrderedDict()
+        self._writes = 0
+
+    def __len__(self) -> int:
+        return len(self._balances)
+
+    def set(self, guild_id: int, user_id: int, balance: int):
+        self._writes += 1
+        self._balances[(guild_id, user_id)] = balance
+        self._balances.move_to_end((guild_id, user_id))
+        if len(self._balances) > self.maxsize:
+            self._balances.popitem(last=False)
+
+    def invalidate(self, guild_id: int, user_id: int):
+        self._writes += 1
+        self._balances.pop((guild_id, user_id), None)
+
+    async def get(self, guild_id: int, user_id: int) -> int:
+        key = (guild_id, user_id)
+        balance = self._balances.get(key)
+        if balance is not None:
+            self._balances.move_to_end(key)
+            self.hits += 1
+            return balance
+
+        self.misses += 1
+        writes = self._writes
+        result = await bot.db.fetchone(
+            "SELECT balance FROM diamonds WHERE guild_id = ? AND user_id = ?",
+            (guild_id, user_id)
+        )
+        balance = result[0] if result else 0
+        if writes == self._writes:
+            self.set(guild_id, user_id, balance)
+        return balance
+
+balance_cache = BalanceCache()
+
 async def get_user_diamonds(user_id: int, guild_id: int) -> int:
-    async with aiosqlite.connect(bot.db_path) as db:
-        async with db.execute(
-            "SELECT balance FROM diamonds WHERE user_id = ? AND guild_id = ?",
+    return await balance_cache.get(guild_id, user_id)
+
+DIAMOND_COLUMNS = ("balance", "last_daily", "daily_streak", "total_earned", "multiplier")
+
+async def upsert_diamonds(db: aiosqlite.Connection, guild_id: int, user_id: int,
+                          values: dict[str, Any], updates: dict[str, str]) -> tuple[int, Optional[int]]:
+    """Insert a member's diamonds row or apply `updates` (column -> SQL over the old row and `excluded`).
+
+    Returns (balance, displaced guild). Until migration 2 swaps the table a member has one row across
+    all guilds, so a write for another guild takes that row over with fresh values, as the old INSERT
+    OR REPLACE did; the guild whose row was taken is returned so its cached state can be dropped.
+    """
+    columns = ", ".join(("guild_id", "user_id", *values))
+    placeholders = ", ".join("?" for _ in range(len(values) + 2))
+    params = (guild_id, user_id, *values.values())
+    displaced = None
+    if "diamonds" in legacy_keyed_tables:
+        row = await (await db.execute("SELECT guild_id FROM diamonds WHERE user_id = ?", (user_id,))).fetchone()
+        if row and row[0] != guild_id:
+            displaced = row[0]
+        assignments = ", ".join(
+            f"{column} = CASE WHEN guild_id = excluded.guild_id THEN {updates.get(column, column)} ELSE excluded.{column} END"
+            for column in DIAMOND_COLUMNS
+        )
+        conflict = f"(user_id) DO UPDATE SET {assignments}, guild_id = excluded.guild_id"
+    else:
+        conflict = f"(guild_id, user_id) DO UPDATE SET {', '.join(f'{column} = {sql}' for column, sql in updates.items())}"
+    cursor = await db.execute(
+        f"INSERT INTO diamonds ({columns}) VALUES ({placeholders}) ON CONFLICT {conflict} RETURNING balance", params
+    )
+    (balance,) = await cursor.fetchone()
+    return balance, displaced
+
+def forget_displaced_diamonds(guild_id: Optional[int], user_id: int):
+    if guild_id is not None:
+        balance_cache.invalidate(guild_id, user_id)
+        diamond_rankings.remove(guild_id, user_id)
+        xp_policy.forget_multiplier(guild_id, user_id)
+
+async def add_diamonds(user_id: int, guild_id: int, amount: int, reason: str = "credit") -> int:
+    """Credit Diamonds in one statement and return the new balance."""
+    async with bot.db.transaction() as db:
+        balance, displaced = await upsert_diamonds(
+            db, guild_id, user_id, {"balance": amount, "total_earned": amount},
+            {"balance": "balance + excluded.balance", "total_earned": "total_earned + excluded.total_earned"}
+        )
+        diamond_ledger.record(guild_id, user_id, amount, balance, reason)
+
+    forget_displaced_diamonds(displaced, user_id)
+    balance_cache.set(guild_id, user_id, balance)
+    diamond_rankings.update(guild_id, user_id, balance)
+    event_logger.log("economy", guild_id, user_id, delta=amount, balance=balance, reason=reason)
+    return balance
+
+async def remove_diamonds(user_id: int, guild_id: int, amount: int, reason: str = "debit") -> Optional[int]:
+    """Debit Diamonds only if the balance covers it; returns the new balance, or None if it didn't."""
+    async with bot.db.transaction() as db:
+        cursor = await db.execute(
+            "UPDATE diamonds SET balance = balance - ? WHERE guild_id = ? AND user_id = ? AND balance >= ? RETURNING balance",
+            (amount, guild_id, user_id, amount)
+        )
+        result = await cursor.fetchone()
+        if result:
+            diamond_ledger.record(guild_id, user_id, -amount, result[0], reason)
+
+    if not result:
+        return None
+    balance_cache.set(guild_id, user_id, result[0])
+    diamond_rankings.update(guild_id, user_id, result[0])
+    event_logger.log("economy", guild_id, user_id, delta=-amount, balance=result[0], reason=reason)
+    return result[0]
+
+def user_key_filter(keys: list[tuple[int, int]]) -> tuple[str, tuple]:
+    """A `(guild_id, user_id) IN (...)` condition and its parameters, for one query per chunk of users."""
+    return f"(guild_id, user_id) IN (VALUES {', '.join('(?, ?)' for _ in keys)})", tuple(itertools.chain.from_iterable(keys))
+
+async def reconcile_ledger_batch() -> tuple[int, list[str]]:
+    """Verify the next batch of ledger entries; returns (entries checked, mismatch descriptions).
+
+    Each user's entries must chain (previous balance + delta == balance_after) from their last
+    checkpoint, and a user's newest entry must equal their live balance. Only new entries and the
+    users they touch are read, so a run never scans the whole ledger or diamonds table.
+
+    The chains are checked on a reader connection. The writer lock is only held per
+    LEDGER_RECONCILE_CHUNK users, to compare live balances and advance their checkpoints, so
+    credits and XP flushes queue behind a few short transactions rather than the whole batch.
+    """
+    mismatches = []
+    await diamond_ledger.flush()
+
+    row = await bot.db.fetchone("SELECT value FROM bot_state WHERE key = 'ledger_reconciled_through'")
+    reconciled_through = int(row[0]) if row else 0
+    entries = await bot.db.fetchall(
+        "SELECT entry_id, guild_id, user_id, delta, balance_after FROM diamond_ledger "
+        "WHERE entry_id > ? ORDER BY entry_id LIMIT ?",
+        (reconciled_through, LEDGER_RECONCILE_BATCH)
+    )
+    if not entries:
+        return 0, mismatches
+
+    touched = list(dict.fromkeys((entry[1], entry[2]) for entry in entries))
+    chunks = [touched[start:start + LEDGER_RECONCILE_CHUNK] for start in range(0, len(touched), LEDGER_RECONCILE_CHUNK)]
+    checkpoints = {}
+    for chunk in chunks:
+        condition, params = user_key_filter(chunk)
+        for guild_id, user_id, entry_id, balance in await bot.db.fetchall(
+            f"SELECT guild_id, user_id, entry_id, balance FROM ledger_checkpoints WHERE {condition}", params
+        ):
+            checkpoints[(guild_id, user_id)] = (entry_id, balance)
+
+    for entry_id, guild_id, user_id, delta, balance_after in entries:
+        previous = checkpoints.get((guild_id, user_id))
+        if previous and entry_id <= previous[0]:
+            continue  # already verified by an interrupted run that got this far
+        # A user's first entry establishes their opening balance
+        if previous and previous[1] + delta != balance_after:
+            mismatches.append(
+                f"entry {entry_id} (guild {guild_id}, user {user_id}): "
+                f"{previous[1]} {delta:+} != {balance_after}"
+            )
+        checkpoints[(guild_id, user_id)] = (entry_id, balance_after)
+
+    for index, chunk in enumerate(chunks):
+        condition, params = user_key_filter(chunk)
+        # Balances only change under the writer lock, and the buffer is written first, so a user's
+        # live balance must match the ledger whenever their newest entry is the one just verified
+        async with bot.db.transaction() as db:
+            await diamond_ledger.write_pending(db)
+            async with db.execute(
+                f"SELECT guild_id, user_id, max(entry_id) FROM diamond_ledger WHERE {condition} GROUP BY guild_id, user_id", params
+            ) as cursor:
+                latest = {(guild_id, user_id): entry_id for guild_id, user_id, entry_id in await cursor.fetchall()}
+            async with db.execute(f"SELECT guild_id, user_id, balance FROM diamonds WHERE {condition}", params) as cursor:
+                live = {(guild_id, user_id): balance for guild_id, user_id, balance in await cursor.fetchall()}
+
+            for guild_id, user_id in chunk:
+                entry_id, balance = checkpoints[(guild_id, user_id)]
+                if latest.get((guild_id, user_id)) != entry_id:
+                    continue  # newer entries will be checked by a later batch
+                if not owns_guild(guild_id):
+                    continue  # the owning process may still have entries for this balance in its buffer
+                actual = live.get((guild_id, user_id), 0)
+                if actual != balance:
+                    mismatches.append(f"guild {guild_id}, user {user_id}: balance {actual} but ledger says {balance}")
+
+            await db.executemany(
+                "INSERT OR REPLACE INTO ledger_checkpoints (guild_id, user_id, entry_id, balance) VALUES (?, ?, ?, ?)",
+                [(guild_id, user_id, *checkpoints[(guild_id, user_id)]) for guild_id, user_id in chunk]
+            )
+            if index == len(chunks) - 1:
+                await db.execute(
+                    "INSERT OR REPLACE INTO bot_state (key, value) VALUES ('ledger_reconciled_through', ?)",
+                    (str(entries[-1][0]),)
+                )
+
+    return len(entries), mismatches
+
+@tasks.loop(minutes=LEDGER_RECONCILE_INTERVAL)
+async def ledger_reconcile_loop():
+    # One process reconciles for the whole cluster
+    if not leader_lease.is_leader:
+        return
+    try:
+        while True:
+            checked, mismatches = await reconcile_ledger_batch()
+            for mismatch in mismatches:
+                print(f"⚠️ Diamond ledger mismatch: {mismatch}")
+            if checked < LEDGER_RECONCILE_BATCH:
+                break
+            await asyncio.sleep(0)
+    except Exception as e:
+        print(f"❌ Diamond ledger reconciliation failed: {e}")
+
+# XP System (write-behind aggregation)
+XP_FLUSH_INTERVAL = int(os.getenv("XP_FLUSH_INTERVAL", "30"))  # seconds between batched writes
+XP_FLUSH_THRESHOLD = int(os.getenv("XP_FLUSH_THRESHOLD", "500"))  # dirty users that force an early flush
+XP_CACHE_SIZE = int(os.getenv("XP_CACHE_SIZE", "50000"))  # clean users kept in memory after a flush
+
+XP_UPSERT_SQL = "INSERT INTO users (guild_id, user_id, xp, level, messages) VALUES (?, ?, ?, ?, ?)"
+XP_UPSERT_SET = "xp = excluded.xp, level = excluded.level, messages = excluded.messages"
+
+class XPAggregator:
+    """In-memory XP state per (guild, user); message gains are merged here and written to `users` in batches."""
+
+    def __init__(self):
+        self._state: OrderedDict[tuple[int, int], list[int]] = OrderedDict()  # key -> [xp, level, messages]
+        self._dirty: set[tuple[int, int]] = set()
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def _load(self, guild_id: int, user_id: int) -> list[int]:
+        key = (guild_id, user_id)
+        state = self._state.get(key)
+        if state is None:
+            row = await bot.db.fetchone(
+                "SELECT xp, level, messages FROM users WHERE user_id = ? AND guild_id = ?",
+                (user_id, guild_id)
+            )
+            # Another message from the same user may have loaded the row while we awaited
+            state = self._state.get(key)
+            if state is None:
+                state = list(row) if row else [0, 0, 0]
+                self._state[key] = state
+        self._state.move_to_end(key)
+        return state
+
+    async def add_xp(self, guild_id: int, user_id: int, amount: int) -> tuple[int, bool]:
+        """Apply one message worth of XP and return (level, leveled_up) from the in-memory state."""
+        state = await self._load(guild_id, user_id)
+        state[0] += amount
+        state[2] += 1
+
+        leveled_up = False
+        if state[0] >= (state[1] + 1) * 100:
+            state[1] += 1
+            leveled_up = True
+
+        self._dirty.add((guild_id, user_id))
+        xp_rankings.update(guild_id, user_id, state[1], state[0])
+        if len(self._dirty) >= XP_FLUSH_THRESHOLD and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+        return state[1], leveled_up
+
+    async def get_stats(self, guild_id: int, user_id: int) -> Optional[tuple[int, int, int]]:
+        """Return (xp, level, messages) including any unflushed gains."""
+        state = self._state.get((guild_id, user_id))
+        if state is not None:
+            return tuple(state)
+        return await bot.db.fetchone(
+            "SELECT xp, level, messages FROM users WHERE user_id = ? AND guild_id = ?",
             (user_id, guild_id)
-        ) as cursor:
-            result = await cursor.fetchone()
-            return result[0] if result else 0
-
-async def add_diamonds(user_id: int, guild_id: int, amount: int):
-    async with aiosqlite.connect(bot.db_path) as db:
-        await db.execute('''
-            INSERT OR REPLACE INTO diamonds (user_id, guild_id, balance, total_earned)
-            VALUES (?, ?, 
-                COALESCE((SELECT balance FROM diamonds WHERE user_id = ? AND guild_id = ?), 0) + ?,
-                COALESCE((SELECT total_earned FROM diamonds WHERE user_id = ? AND guild_id = ?), 0) + ?)
-        ''', (user_id, guild_id, user_id, guild_id, amount, user_id, guild_id, amount))
-        await db.commit()
-
-async def remove_diamonds(user_id: int, guild_id: int, amount: int) -> bool:
-    current_balance = await get_user_diamonds(user_id, guild_id)
-    if current_balance >= amount:
-        async with aiosqlite.connect(bot.db_path) as db:
-            await db.execute(
-                "UPDATE diamonds SET balance = balance - ? WHERE user_id = ? AND guild_id = ?",
-                (amount, user_id, guild_id)
+        )
+
+    def pending(self, guild_id: int) -> list[tuple[int, int, int]]:
+        """(user_id, level, xp) for users in this guild whose latest state is not yet on disk."""
+        return [
+            (user_id, self._state[(g, user_id)][1], self._state[(g, user_id)][0])
+            for g, user_id in self._dirty if g == guild_id
+        ]
+
+    @property
+    def dirty_count(self) -> int:
+        return len(self._dirty)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if legacy_keyed_tables:
+                # Another cluster process may have run the migrations since this one last looked
+                await refresh_legacy_keyed_tables(bot.db)
+            if self._dirty:
+                keys = list(self._dirty)
+                self._dirty.clear()
+                try:
+                    deferred = await self._write(keys)
+                except Exception:
+                    self._dirty.update(keys)
+                    raise
+                self._dirty.update(deferred)
+            self._evict()
+
+    async def _write(self, keys: list[tuple[int, int]]) -> list[tuple[int, int]]:
+        """Store these users' state; returns the keys that have to wait for migration 1."""
+        rows = [(guild_id, user_id, *self._state[(guild_id, user_id)]) for guild_id, user_id in keys]
+        if "users" not in legacy_keyed_tables:
+            await bot.db.executemany(f"{XP_UPSERT_SQL} ON CONFLICT (guild_id, user_id) DO UPDATE SET {XP_UPSERT_SET}", rows)
+            return []
+
+        # On the user_id key a member has one row for all guilds, and writing one guild's XP over
+        # another's would lose it; those members stay dirty until migration 1 swaps the table
+        deferred = []
+        async with bot.db.transaction() as db:
+            for row in rows:
+                cursor = await db.execute(
+                    f"{XP_UPSERT_SQL} ON CONFLICT (user_id) DO UPDATE SET {XP_UPSERT_SET} "
+                    "WHERE guild_id = excluded.guild_id RETURNING 1", row
+                )
+                if await cursor.fetchone() is None:
+                    deferred.append((row[0], row[1]))
+        return deferred
+
+    def _evict(self):
+        excess = len(self._state) - XP_CACHE_SIZE
+        if excess <= 0:
+            return
+        # Oldest entries first; dirty ones must stay until they are written
+        for key in list(self._state):
+            if excess <= 0:
+                break
+            if key not in self._dirty:
+                del self._state[key]
+                excess -= 1
+
+xp_aggregator = XPAggregator()
+
+@tasks.loop(seconds=XP_FLUSH_INTERVAL)
+async def xp_flush_loop():
+    try:
+        await xp_aggregator.flush()
+    except Exception as e:
+        print(f"❌ Failed to flush XP: {e}")
+
+# Ranking indexes (leaderboard / rich-list)
+LEADERBOARD_PAGE_SIZE = 10
+
+class RankIndex:
+    """Order-statistic index over unique sortable keys, best first.
+
+    Keys live in sorted buckets so an update is a bisect + small list insert, a rank lookup is two
+    bisects, and slicing a page only touches the buckets it spans.
+    """
+
+    BUCKET_SIZE = 1000
+
+    def __init__(self):
+        self._buckets: list[list[tuple]] = []
+        self._maxes: list[tuple] = []
+        self._keys: dict[int, tuple] = {}  # member -> current key
+        self._offsets: Optional[list[int]] = None  # keys before each bucket, rebuilt lazily
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, member: int) -> bool:
+        return member in self._keys
+
+    def _insert(self, key: tuple):
+        self._offsets = None
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            return
+
+        i = min(bisect.bisect_left(self._maxes, key), len(self._buckets) - 1)
+        bucket = self._buckets[i]
+        bisect.insort(bucket, key)
+        self._maxes[i] = bucket[-1]
+
+        if len(bucket) > 2 * self.BUCKET_SIZE:
+            half = len(bucket) // 2
+            self._buckets[i:i + 1] = [bucket[:half], bucket[half:]]
+            self._maxes[i:i + 1] = [bucket[half - 1], bucket[-1]]
+
+    def _delete(self, key: tuple):
+        self._offsets = None
+        i = bisect.bisect_left(self._maxes, key)
+        bucket = self._buckets[i]
+        del bucket[bisect.bisect_left(bucket, key)]
+        if bucket:
+            self._maxes[i] = bucket[-1]
+        else:
+            del self._buckets[i]
+            del self._maxes[i]
+
+    def update(self, member: int, key: tuple):
+        old = self._keys.get(member)
+        if old == key:
+            return
+        if old is not None:
+            self._delete(old)
+        self._keys[member] = key
+        self._insert(key)
+
+    def setdefault(self, member: int, key: tuple):
+        if member not in self._keys:
+            self.update(member, key)
+
+    def remove(self, member: int):
+        old = self._keys.pop(member, None)
+        if old is not None:
+            self._delete(old)
+
+    def _bucket_offsets(self) -> list[int]:
+        if self._offsets is None:
+            self._offsets = [0, *itertools.accumulate(len(bucket) for bucket in self._buckets)]
+        return self._offsets
+
+    def rank(self, member: int) -> Optional[int]:
+        """1-based rank of a member, or None if they are not ranked."""
+        key = self._keys.get(member)
+        if key is None:
+            return None
+        i = bisect.bisect_left(self._maxes, key)
+        return self._bucket_offsets()[i] + bisect.bisect_left(self._buckets[i], key) + 1
+
+    def slice(self, start: int, count: int) -> list[tuple]:
+        """Up to `count` keys starting at 0-based position `start`."""
+        offsets = self._bucket_offsets()
+        if start < 0 or start >= len(self._keys):
+            return []
+        i = bisect.bisect_right(offsets, start) - 1
+        j = start - offsets[i]
+        keys: list[tuple] = []
+        while i < len(self._buckets) and len(keys) < count:
+            keys.extend(self._buckets[i][j:j + count - len(keys)])
+            i += 1
+            j = 0
+        return keys
+
+class GuildRankings:
+    """Per-guild RankIndex, loaded from the database on first use and then kept in sync by the write paths."""
+
+    def __init__(self, query: str, key: Callable[..., tuple], overlay: Optional[Callable[[int], list]] = None):
+        self.query = query  # selects (user_id, *values) for one guild
+        self.key = key
+        self.overlay = overlay  # newer-than-disk rows to apply after loading
+        self._indexes: dict[int, RankIndex] = {}
+        self._loading: dict[int, RankIndex] = {}
+        self._load_tasks: dict[int, asyncio.Task] = {}
+
+    async def get(self, guild_id: int) -> RankIndex:
+        index = self._indexes.get(guild_id)
+        if index is not None:
+            return index
+        task = self._load_tasks.get(guild_id)
+        if task is None:
+            task = asyncio.create_task(self._load(guild_id))
+            self._load_tasks[guild_id] = task
+        return await task
+
+    async def _load(self, guild_id: int) -> RankIndex:
+        index = RankIndex()
+        # Updates that arrive while the rows are being read land in the index first and win over them
+        self._loading[guild_id] = index
+        try:
+            rows = await bot.db.fetchall(self.query, (guild_id,))
+            for row in rows:
+                index.setdefault(row[0], self.key(*row))
+            if self.overlay:
+                for row in self.overlay(guild_id):
+                    index.update(row[0], self.key(*row))
+            self._indexes[guild_id] = index
+            return index
+        finally:
+            del self._loading[guild_id]
+            del self._load_tasks[guild_id]
+
+    @property
+    def loaded_count(self) -> int:
+        return len(self._indexes)
+
+    def is_tracking(self, guild_id: int) -> bool:
+        return guild_id in self._indexes or guild_id in self._loading
+
+    def update(self, guild_id: int, user_id: int, *values):
+        index = self._indexes.get(guild_id) or self._loading.get(guild_id)
+        if index is not None:
+            index.update(user_id, self.key(user_id, *values))
+
+    def remove(self, guild_id: int, user_id: int):
+        index = self._indexes.get(guild_id) or self._loading.get(guild_id)
+        if index is not None:
+            index.remove(user_id)
+
+xp_rankings = GuildRankings(
+    "SELECT user_id, level, xp FROM users WHERE guild_id = ?",
+    key=lambda user_id, level, xp: (-level, -xp, user_id),
+    overlay=lambda guild_id: xp_aggregator.pending(guild_id)
+)
+
+diamond_rankings = GuildRankings(
+    "SELECT user_id, balance FROM diamonds WHERE guild_id = ?",
+    key=lambda user_id, balance: (-balance, user_id)
+)
+
+async def get_top_users(guild_id: int, limit: int = LEADERBOARD_PAGE_SIZE, start: int = 0) -> list[tuple[int, int, int]]:
+    """(user_id, level, xp) rows for a guild's leaderboard, including unflushed XP."""
+    index = await xp_rankings.get(guild_id)
+    return [(user_id, -level, -xp) for level, xp, user_id in index.slice(start, limit)]
+
+async def get_richest_users(guild_id: int, limit: int = LEADERBOARD_PAGE_SIZE, start: int = 0) -> list[tuple[int, int]]:
+    """(user_id, balance) rows for a guild's Diamond rich-list."""
+    index = await diamond_rankings.get(guild_id)
+    return [(user_id, -balance) for balance, user_id in index.slice(start, limit)]
+
+def page_start(page: Optional[int], total: int, rank: Optional[int] = None) -> int:
+    """0-based offset of a leaderboard page, or of the page centred on `rank` when one is given."""
+    if rank is not None:
+        return max(0, min(rank - 1 - LEADERBOARD_PAGE_SIZE // 2, total - LEADERBOARD_PAGE_SIZE))
+    last_page = max(1, -(-total // LEADERBOARD_PAGE_SIZE))
+    return (min(max(page or 1, 1), last_page) - 1) * LEADERBOARD_PAGE_SIZE
+
+async def leaderboard_embed(guild: discord.Guild, title: str, color: int, rows: list[tuple[int, str]], start: int, total: int,
+                            highlight: Optional[int] = None) -> discord.Embed:
+    embed = discord.Embed(title=title, color=color)
+
+    medals = ["🥇", "🥈", "🥉"]
+    members = await member_cache.get_many(guild, [user_id for user_id, _ in rows])
+
+    for rank, (user_id, value) in enumerate(rows, start + 1):
+        user = members.get(user_id)
+        name = user.display_name if user else "Unknown User"
+        medal = medals[rank - 1] if rank <= len(medals) else "🏅"
+        marker = " ⬅️" if user_id == highlight else ""
+        embed.add_field(
+            name=f"{medal} #{rank} {name}{marker}",
+            value=value,
+            inline=False
+        )
+
+    pages = max(1, -(-total // LEADERBOARD_PAGE_SIZE))
+    embed.set_footer(text=f"Page {start // LEADERBOARD_PAGE_SIZE + 1}/{pages} • {total:,} ranked members")
+    return embed
+
+# Rank cards
+RANK_CARD_CACHE_SIZE = int(os.getenv("RANK_CARD_CACHE_SIZE", "512"))  # rendered PNGs kept in memory
+RANK_CARD_WORKERS = int(os.getenv("RANK_CARD_WORKERS", "2"))  # threads rendering cards off the event loop
+RANK_CARD_FONT = os.getenv("RANK_CARD_FONT", "DejaVuSans-Bold.ttf")  # TrueType font file or name
+RANK_CARD_PROGRESS_STEPS = 50  # progress bar resolution; XP within one step reuses the cached card
+RANK_CARD_SIZE = (800, 200)
+
+@functools.lru_cache(maxsize=1)
+def rank_card_assets() -> tuple[Image.Image, dict[str, ImageFont.ImageFont]]:
+    """Background and fonts, built once per process and shared by all render threads (read-only)."""
+    width, height = RANK_CARD_SIZE
+    background = Image.new("RGBA", RANK_CARD_SIZE)
+    draw = ImageDraw.Draw(background)
+    for x in range(width):
+        shade = x / width
+        draw.line([(x, 0), (x, height)], fill=(int(35 + 20 * shade), int(39 + 10 * shade), int(47 + 40 * shade), 255))
+
+    def font(size: int):
+        try:
+            return ImageFont.truetype(RANK_CARD_FONT, size)
+        except OSError:
+            return ImageFont.load_default(size)
+
+    return background, {"name": font(34), "level": font(26), "small": font(20)}
+
+def draw_rank_card(name: str, level: int, progress_step: int, avatar: Optional[bytes]) -> bytes:
+    """Render a rank card PNG. Pure function, safe to run in worker threads."""
+    background, fonts = rank_card_assets()
+    card = background.copy()
+    draw = ImageDraw.Draw(card)
+    width, height = RANK_CARD_SIZE
+
+    # Round avatar
+    size = 140
+    top = (height - size) // 2
+    if avatar:
+        picture = Image.open(io.BytesIO(avatar)).convert("RGBA").resize((size, size))
+        mask = Image.new("L", (size, size), 0)
+        ImageDraw.Draw(mask).ellipse((0, 0, size, size), fill=255)
+        card.paste(picture, (30, top), mask)
+    else:
+        draw.ellipse((30, top, 30 + size, top + size), fill=(88, 101, 242, 255))
+
+    left = 30 + size + 30
+    draw.text((left, 35), name[:24], font=fonts["name"], fill=(255, 255, 255, 255))
+    draw.text((left, 85), f"Level {level}", font=fonts["level"], fill=(46, 204, 113, 255))
+
+    # Progress bar
+    progress = progress_step / RANK_CARD_PROGRESS_STEPS
+    bar = (left, 135, width - 40, 165)
+    draw.rounded_rectangle(bar, radius=15, fill=(72, 75, 84, 255))
+    if progress > 0:
+        filled = bar[0] + max(30, int((bar[2] - bar[0]) * progress))
+        draw.rounded_rectangle((bar[0], bar[1], filled, bar[3]), radius=15, fill=(46, 204, 113, 255))
+    draw.text((width - 40, 120), f"{progress:.0%}", font=fonts["small"], fill=(220, 221, 222, 255), anchor="rb")
+
+    output = io.BytesIO()
+    card.convert("RGB").save(output, format="PNG", optimize=False)
+    return output.getvalue()
+
+class RankCardRenderer:
+    """LRU cache of rendered rank cards in front of a small rendering thread pool.
+
+    Cards are keyed by (user, level, progress step, avatar, name), so repeated /level calls skip both
+    the avatar download and the render until something visible changes.
+    """
+
+    def __init__(self, maxsize: int = RANK_CARD_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[tuple, bytes] = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=RANK_CARD_WORKERS, thread_name_prefix="rank-card")
+
+    async def render(self, member: discord.abc.User, level: int, progress: float) -> bytes:
+        step = int(min(max(progress, 0.0), 1.0) * RANK_CARD_PROGRESS_STEPS)
+        key = (member.id, level, step, member.display_avatar.key, member.display_name)
+
+        card = self._cache.get(key)
+        if card is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return card
+
+        self.misses += 1
+        try:
+            avatar = await member.display_avatar.replace(size=256, static_format="png").read()
+        except discord.HTTPException:
+            avatar = None
+        card = await asyncio.get_running_loop().run_in_executor(
+            self._executor, draw_rank_card, member.display_name, level, step, avatar
+        )
+
+        self._cache[key] = card
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return card
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+rank_cards = RankCardRenderer()
+
+async def attach_rank_card(embed: discord.Embed, member: discord.abc.User, level: int, progress: float) -> Optional[discord.File]:
+    """Render the member's rank card into the embed; the embed keeps its text fields if rendering fails."""
+    try:
+        card = await rank_cards.render(member, level, progress)
+    except Exception as e:
+        print(f"❌ Failed to render rank card for {member}: {e}")
+        return None
+    embed.set_image(url="attachment://rank.png")
+    return discord.File(io.BytesIO(card), filename="rank.png")
+
+# Giveaway system
+# Idempotent entry: the UNIQUE (giveaway_id, user_id) index turns repeat clicks into no-ops,
+# and MAX(entry_no) is a single index probe
+GIVEAWAY_ENTRY_SQL = '''
+    INSERT OR IGNORE INTO giveaway_entries (giveaway_id, entry_no, user_id)
+    SELECT ?, COALESCE(MAX(entry_no), 0) + 1, ? FROM giveaway_entries WHERE giveaway_id = ?
+'''
+
+giveaway_random = random.SystemRandom()
+GIVEAWAY_RETRY_DELAY = 60  # seconds before a giveaway whose draw failed is tried again
+
+async def enter_giveaway(giveaway_id: int, user_id: int) -> bool:
+    """Record an entry; returns False if the user had already entered."""
+    cursor = await bot.db.execute(GIVEAWAY_ENTRY_SQL, (giveaway_id, user_id, giveaway_id))
+    return cursor.rowcount == 1
+
+async def count_entries(giveaway_id: int) -> int:
+    result = await bot.db.fetchone("SELECT MAX(entry_no) FROM giveaway_entries WHERE giveaway_id = ?", (giveaway_id,))
+    return result[0] or 0
+
+async def draw_winners(giveaway_id: int, count: int) -> list[int]:
+    """Pick distinct winners by sampling entry numbers, so only the winning rows are ever read."""
+    total = await count_entries(giveaway_id)
+    picks = giveaway_random.sample(range(1, total + 1), min(count, total))
+    if not picks:
+        return []
+
+    rows = await bot.db.fetchall(
+        f"SELECT entry_no, user_id FROM giveaway_entries WHERE giveaway_id = ? AND entry_no IN ({', '.join('?' * len(picks))})",
+        (giveaway_id, *picks)
+    )
+    winners = dict(rows)
+    return [winners[entry_no] for entry_no in picks]
+
+async def end_giveaway(giveaway_id: int):
+    row = await bot.db.fetchone("SELECT winner_count FROM giveaways WHERE giveaway_id = ? AND ended = 0", (giveaway_id,))
+    if not row:
+        return  # already ended
+
+    # Draw first, then mark it ended together with its winners: a failed draw leaves it open to retry
+    winners = await draw_winners(giveaway_id, row[0] or 1)
+    async with bot.db.transaction() as db:
+        cursor = await db.execute(
+            "UPDATE giveaways SET ended = 1, winners = ? WHERE giveaway_id = ? AND ended = 0 "
+            "RETURNING channel_id, message_id, prize, host_id",
+            (json.dumps(winners), giveaway_id)
+        )
+        giveaway_info = await cursor.fetchone()
+    if not giveaway_info:
+        return  # another run ended it first
+
+    channel_id, message_id, prize, host_id = giveaway_info
+    entrants = await count_entries(giveaway_id)
+
+    channel = bot.get_channel(channel_id)
+    if not channel:
+        return
+
+    winner_text = ", ".join(f"<@{user_id}>" for user_id in winners) if winners else "No valid entries 😔"
+    embed = discord.Embed(
+        title="🎉 GIVEAWAY ENDED! 🎉",
+        description=f"**Prize:** {prize}\n**Winners:** {winner_text}\n**Entries:** {entrants:,}",
+        color=0x95a5a6
+    )
+    host = await member_cache.get(channel.guild, host_id)
+    embed.set_footer(text=f"Hosted by {host or 'Unknown'}")
+
+    try:
+        await channel.get_partial_message(message_id).edit(embed=embed, view=None)
+    except discord.HTTPException:
+        pass
+    if winners:
+        await channel.send(f"🎊 Congratulations {winner_text}! You won **{prize}**!")
+
+@job_scheduler.handler("end_giveaway")
+async def run_end_giveaway(run_at: float, giveaway_id: int) -> Optional[float]:
+    try:
+        await end_giveaway(giveaway_id)
+    except Exception as e:
+        # Once the winners are stored the retry is a no-op, so this only re-runs a failed draw
+        print(f"❌ Failed to end giveaway {giveaway_id}, retrying in {GIVEAWAY_RETRY_DELAY}s: {e}")
+        return time.time() + GIVEAWAY_RETRY_DELAY
+    return None
+
+async def schedule_open_giveaways():
+    """Make sure every open giveaway (including ones created before jobs existed) has an end job."""
+    last_id = 0
+    while True:
+        rows = await bot.db.fetchall(
+            "SELECT giveaway_id, guild_id, end_time FROM giveaways WHERE ended = 0 AND giveaway_id > ? "
+            "ORDER BY giveaway_id LIMIT ?",
+            (last_id, JOB_RESUME_BATCH)
+        )
+        for giveaway_id, guild_id, end_time in rows:
+            # Runs during startup: one legacy row without a usable end time must not stop the bot
+            try:
+                run_at = datetime.datetime.fromisoformat(end_time).timestamp()
+            except (TypeError, ValueError):
+                print(f"⚠️ Giveaway {giveaway_id} has no valid end time ({end_time!r}); not scheduling it")
+                continue
+            await job_scheduler.schedule(
+                "end_giveaway", run_at, {"giveaway_id": giveaway_id}, guild_id=guild_id, key=f"giveaway:{giveaway_id}"
             )
-            await db.commit()
-        return True
-    return False
+        if len(rows) < JOB_RESUME_BATCH:
+            break
+        last_id = rows[-1][0]
+
+# Ticket transcripts
+TRANSCRIPT_FORMAT = os.getenv("TRANSCRIPT_FORMAT", "txt").lower()  # "txt" or "html" for exported transcript files
+TRANSCRIPT_INLINE_LIMIT = 2000  # transcripts up to this many characters are posted inside the embed
+TRANSCRIPT_PAGE_SIZE = 100  # messages compressed per step (one channel.history API page)
+TRANSCRIPT_INDEX_QUEUE_SIZE = int(os.getenv("TRANSCRIPT_INDEX_QUEUE_SIZE", "1000"))  # transcript pages waiting to be indexed
+TICKET_SEARCH_LIMIT = 10  # tickets shown per /ticket_search
+
+class TranscriptWriter:
+    """Streams a ticket transcript into a gzip-compressed temp file, one history page at a time.
+
+    Short transcripts stay in memory so they can still be posted inline. Once the text grows past
+    TRANSCRIPT_INLINE_LIMIT it spills to disk, and each later page is escaped, encoded and compressed
+    in a worker thread, so memory stays bounded by a single page however long the ticket is.
+    """
+
+    def __init__(self, name: str, header: list[str], fmt: str = TRANSCRIPT_FORMAT):
+        self.name = name
+        self.html = fmt == "html"
+        self._lines: list[str] = list(header)
+        self._size = sum(len(line) + 1 for line in header)
+        self._file = None
+        self._gzip: Optional[gzip.GzipFile] = None
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    @property
+    def text(self) -> str:
+        """Plain-text transcript; only complete while the transcript has not spilled to disk."""
+        return "\n".join(self._lines)
+
+    def _render(self, lines: list[str]) -> bytes:
+        if self.html:
+            lines = [html.escape(line) for line in lines]
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def _open(self):
+        self._file = tempfile.TemporaryFile()
+        self._gzip = gzip.GzipFile(fileobj=self._file, mode="wb")
+        if self.html:
+            title = html.escape(f"Ticket transcript - {self.name}")
+            self._gzip.write(f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{title}</title></head>\n<body><pre>\n'.encode("utf-8"))
+
+    def _write(self, lines: list[str]):
+        if self._gzip is None:
+            self._open()
+        self._gzip.write(self._render(lines))
+
+    def _close(self):
+        if self.html:
+            self._gzip.write(b"</pre></body></html>\n")
+        self._gzip.close()
+        self._file.seek(0)
+
+    async def add(self, line: str):
+        self._lines.append(line)
+        self._size += len(line) + 1
+        if (self.spilled and len(self._lines) >= TRANSCRIPT_PAGE_SIZE) or (not self.spilled and self._size > TRANSCRIPT_INLINE_LIMIT):
+            lines, self._lines = self._lines, []
+            await asyncio.to_thread(self._write, lines)
+
+    async def finish(self) -> Optional[discord.File]:
+        """Flush the last page and return the compressed file, or None for a short transcript."""
+        if not self.spilled:
+            return None
+        lines, self._lines = self._lines, []
+        if lines:
+            await asyncio.to_thread(self._write, lines)
+        await asyncio.to_thread(self._close)
+        extension = "html" if self.html else "txt"
+        filename = f"transcript-{self.name}-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.{extension}.gz"
+        return discord.File(self._file, filename=filename)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+def fts_query(text: str) -> str:
+    """Turn free text into an FTS5 query that matches all words, without exposing FTS5 syntax."""
+    return " ".join('"' + term.replace('"', '""') + '"' for term in text.split())
+
+class TranscriptIndex:
+    """Background full-text indexing of closed-ticket transcripts into the ticket_search FTS5 table.
+
+    Closing a ticket only queues its transcript pages; a worker writes them in batched transactions,
+    so indexing never holds up the close and memory stays bounded by the queue. When the worker
+    falls that far behind, new pages are dropped (and counted) rather than making the close wait.
+    """
+
+    BATCH_SIZE = 50  # pages per write transaction
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=TRANSCRIPT_INDEX_QUEUE_SIZE)
+        self._task: Optional[asyncio.Task] = None
+        self.dropped = 0
+        self._attempts: dict[int, int] = {}  # ticket_id -> discarded close attempts
+
+    def add(self, ticket_id: int, guild_id: int, user_id: int, lines: list[str]):
+        if not lines:
+            return
+        try:
+            self.queue.put_nowait(("\n".join(lines), ticket_id, guild_id, user_id, self._attempts.get(ticket_id, 0)))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            print(f"⚠️ Transcript index queue full; ticket {ticket_id} page not indexed")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        while not self.queue.empty():
+            await self._write(self._drain())
+
+    def _drain(self) -> list[tuple]:
+        batch = []
+        while len(batch) < self.BATCH_SIZE and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while True:
+            first = await self.queue.get()
+            batch = [first] + self._drain()
+            try:
+                await self._write(batch)
+            except Exception as e:
+                print(f"❌ Failed to index {len(batch)} transcript page(s): {e}")
+
+    async def discard(self, ticket_id: int):
+        """Drop everything a failed close indexed or queued, so the next close doesn't index it twice."""
+        self._attempts[ticket_id] = self._attempts.get(ticket_id, 0) + 1
+        await bot.db.execute("DELETE FROM ticket_search WHERE ticket_id = ?", (ticket_id,))
+
+    async def _write(self, batch: list[tuple]):
+        if not batch:
+            return
+        async with bot.db.transaction() as db:
+            # Checked under the writer lock: a batch drained before discard() either commits ahead of
+            # its DELETE or is filtered out here
+            rows = [page[:4] for page in batch if page[4] == self._attempts.get(page[1], 0)]
+            if rows:
+                await db.executemany(
+                    "INSERT INTO ticket_search (content, ticket_id, guild_id, user_id) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+
+    async def search(self, guild_id: int, query: str, user_id: Optional[int] = None,
+                     limit: int = TICKET_SEARCH_LIMIT) -> list[tuple]:
+        """Best-matching tickets as (ticket_id, user_id, channel_name, closed_at, snippet), best first."""
+        match = fts_query(query)
+        if not match:
+            return []
+        user_filter = "AND user_id = ?" if user_id else ""
+        params = (match, guild_id) + ((user_id,) if user_id else ()) + (limit * 5,)
+        # Rank pages with bm25 first (cheap, index-only), then keep the best page per ticket
+        return await bot.db.fetchall(f'''
+            SELECT hits.ticket_id, hits.user_id, t.channel_name, t.closed_at, hits.excerpt, MIN(hits.score)
+            FROM (
+                SELECT ticket_id, user_id, snippet(ticket_search, 0, '**', '**', '…', 16) AS excerpt, rank AS score
+                FROM ticket_search
+                WHERE ticket_search MATCH ? AND guild_id = ? {user_filter}
+                ORDER BY rank LIMIT ?
+            ) AS hits
+            LEFT JOIN tickets t ON t.ticket_id = hits.ticket_id
+            GROUP BY hits.ticket_id
+            ORDER BY MIN(hits.score)
+            LIMIT ?
+        ''', params + (limit,))
+
+transcript_index = TranscriptIndex()
 
 # Button View Classes
 class Button3DView(discord.ui.View):
@@ -242,6 +2748,7 @@ class Button3DView(discord.ui.View):
 
 class TicketView(Button3DView):
     @discord.ui.button(label="🎫 Open Support Ticket", style=discord.ButtonStyle.primary, emoji="📨", custom_id="create_ticket")
+    @timed_callback("ticket.create")
     async def create_ticket(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.response.defer(ephemeral=True)
 
@@ -249,12 +2756,10 @@ class TicketView(Button3DView):
         user = interaction.user
 
         # Check if user already has an open ticket
-        async with aiosqlite.connect(bot.db_path) as db:
-            async with db.execute(
-                "SELECT channel_id FROM tickets WHERE user_id = ? AND guild_id = ? AND status = 'open'",
-                (user.id, guild.id)
-            ) as cursor:
-                existing = await cursor.fetchone()
+        existing = await bot.db.fetchone(
+            "SELECT channel_id FROM tickets WHERE user_id = ? AND guild_id = ? AND status = 'open'",
+            (user.id, guild.id)
+        )
 
         if existing:
             channel = guild.get_channel(existing[0])
@@ -281,12 +2786,11 @@ class TicketView(Button3DView):
         )
 
         # Save to database
-        async with aiosqlite.connect(bot.db_path) as db:
-            await db.execute(
-                "INSERT INTO tickets (user_id, guild_id, channel_id) VALUES (?, ?, ?)",
-                (user.id, guild.id, channel.id)
-            )
-            await db.commit()
+        await bot.db.execute(
+            "INSERT INTO tickets (user_id, guild_id, channel_id) VALUES (?, ?, ?)",
+            (user.id, guild.id, channel.id)
+        )
+        event_logger.log("ticket_open", guild.id, user.id, channel.id)
 
         embed = discord.Embed(
             title="🎉 Support Ticket Created!",
@@ -310,45 +2814,79 @@ class TicketView(Button3DView):
 
 class CloseTicketView(Button3DView):
     @discord.ui.button(label="🔒 Close Ticket", style=discord.ButtonStyle.danger, custom_id="close_ticket")
+    @timed_callback("ticket.close")
     async def close_ticket(self, interaction: discord.Interaction, button: discord.ui.Button):
         channel = interaction.channel
         guild = interaction.guild
+        # Exporting a long ticket can outlast the 3 second interaction window
+        await interaction.response.defer()
+
+        # Claim the ticket first: of several concurrent Close presses, only one gets the row back
+        async with bot.db.transaction() as db:
+            cursor = await db.execute(
+                "UPDATE tickets SET status = 'closed', channel_name = ?, closed_at = CURRENT_TIMESTAMP "
+                "WHERE channel_id = ? AND status = 'open' RETURNING user_id, created_at, ticket_id",
+                (channel.name, channel.id)
+            )
+            ticket_info = await cursor.fetchone()
+        if not ticket_info:
+            await interaction.followup.send("❌ This ticket is already closed.", ephemeral=True)
+            return
+        user_id, created_at, ticket_id = ticket_info
+
+        try:
+            await self.save_transcript(interaction, user_id, created_at, ticket_id)
+        except Exception:
+            # Let the next press try again, starting the search index over
+            await transcript_index.discard(ticket_id)
+            await bot.db.execute(
+                "UPDATE tickets SET status = 'open', closed_at = NULL WHERE ticket_id = ?", (ticket_id,)
+            )
+            raise
+
+        event_logger.log("ticket_close", guild.id, interaction.user.id, channel.id)
 
-        # Create transcript before closing
+        await interaction.followup.send("📝 Transcript saved! Ticket will be deleted in 10 seconds...")
+        # Durable delayed delete instead of holding this handler open for 10 seconds
+        await job_scheduler.schedule(
+            "delete_ticket_channel", time.time() + 10, {"channel_id": channel.id},
+            guild_id=guild.id, key=f"ticket_delete:{channel.id}"
+        )
+
+    async def save_transcript(self, interaction: discord.Interaction, user_id: int, created_at: str, ticket_id: int):
+        """Post the transcript (if a transcript channel is set) and queue the ticket for search indexing."""
+        channel = interaction.channel
+        guild = interaction.guild
         config = await get_channel_config(guild.id)
         transcript_channel_id = config.get("transcript")
         transcript_channel = guild.get_channel(transcript_channel_id) if transcript_channel_id else None
 
-        if transcript_channel:
-            # Get ticket info from database
-            async with aiosqlite.connect(bot.db_path) as db:
-                async with db.execute(
-                    "SELECT user_id, created_at FROM tickets WHERE channel_id = ?",
-                    (channel.id,)
-                ) as cursor:
-                    ticket_info = await cursor.fetchone()
-
-            # Collect messages for transcript
-            messages = []
-            async for message in channel.history(limit=None, oldest_first=True):
-                if not message.author.bot or message.embeds or message.attachments:
-                    timestamp = message.created_at.strftime("%Y-%m-%d %H:%M:%S")
-                    content = message.content or "[Embed/Attachment]"
-                    messages.append(f"[{timestamp}] {message.author}: {content}")
-
-            # Create transcript content
-            transcript_content = f"""
-TICKET TRANSCRIPT - {channel.name}
-=============================================
-User: <@{ticket_info[0] if ticket_info else 'Unknown'}>
-Created: {ticket_info[1] if ticket_info else 'Unknown'}
-Closed: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-Channel: #{channel.name}
-=============================================
-
-{chr(10).join(messages)}
-"""
-
+        # Stream messages page by page into the transcript file and the search index
+        writer = TranscriptWriter(channel.name, [
+            f"TICKET TRANSCRIPT - {channel.name}",
+            "=============================================",
+            f"User: <@{user_id}>",
+            f"Created: {created_at}",
+            f"Closed: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+            f"Channel: #{channel.name}",
+            "=============================================",
+            "",
+        ]) if transcript_channel else None
+        page = []
+        async for message in channel.history(limit=None, oldest_first=True):
+            if not message.author.bot or message.embeds or message.attachments:
+                timestamp = message.created_at.strftime("%Y-%m-%d %H:%M:%S")
+                content = message.content or "[Embed/Attachment]"
+                line = f"[{timestamp}] {message.author}: {content}"
+                if writer:
+                    await writer.add(line)
+                page.append(line)
+                if len(page) >= TRANSCRIPT_PAGE_SIZE:
+                    transcript_index.add(ticket_id, guild.id, user_id, page)
+                    page = []
+        transcript_index.add(ticket_id, guild.id, user_id, page)
+
+        if writer:
             # Send transcript to transcript channel
             transcript_embed = discord.Embed(
                 title="🎫 Ticket Transcript",
@@ -357,56 +2895,46 @@ Channel: #{channel.name}
                 timestamp=datetime.datetime.now()
             )
             
-            if ticket_info:
-                user = guild.get_member(ticket_info[0])
-                if user:
-                    transcript_embed.add_field(name="👤 User", value=user.mention, inline=True)
-                    transcript_embed.add_field(name="📅 Created", value=ticket_info[1], inline=True)
+            user = await member_cache.get(guild, user_id)
+            if user:
+                transcript_embed.add_field(name="👤 User", value=user.mention, inline=True)
+                transcript_embed.add_field(name="📅 Created", value=created_at, inline=True)
             
             transcript_embed.add_field(name="🔒 Closed By", value=interaction.user.mention, inline=True)
 
-            # Save transcript as text file if too long
-            if len(transcript_content) > 2000:
-                transcript_file = discord.File(
-                    io.StringIO(transcript_content),
-                    filename=f"transcript-{channel.name}-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.txt"
-                )
-                await transcript_channel.send(embed=transcript_embed, file=transcript_file)
-            else:
-                transcript_embed.add_field(
-                    name="📝 Messages",
-                    value=f"```{transcript_content[-1000:]}```",
-                    inline=False
-                )
-                await transcript_channel.send(embed=transcript_embed)
-
-        # Update database
-        async with aiosqlite.connect(bot.db_path) as db:
-            await db.execute(
-                "UPDATE tickets SET status = 'closed' WHERE channel_id = ?",
-                (channel.id,)
-            )
-            await db.commit()
-
-        await interaction.response.send_message("📝 Transcript saved! Ticket will be deleted in 10 seconds...")
-        await asyncio.sleep(10)
+            # Attach long transcripts as a compressed file, post short ones inline
+            try:
+                transcript_file = await writer.finish()
+                if transcript_file:
+                    await transcript_channel.send(embed=transcript_embed, file=transcript_file)
+                else:
+                    transcript_embed.add_field(
+                        name="📝 Messages",
+                        value=f"```{writer.text[-1000:]}```",
+                        inline=False
+                    )
+                    await transcript_channel.send(embed=transcript_embed)
+            finally:
+                writer.close()
+
+@job_scheduler.handler("delete_ticket_channel")
+async def run_delete_ticket_channel(run_at: float, channel_id: int):
+    channel = bot.get_channel(channel_id)
+    if channel:
         await channel.delete()
 
 class AllFeaturesView(Button3DView):
     @discord.ui.button(label="🎂 Set Birthday", style=discord.ButtonStyle.secondary, emoji="🎂", custom_id="set_birthday")
+    @timed_callback("panel.set_birthday")
     async def set_birthday(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.response.send_modal(BirthdayModal())
 
     @discord.ui.button(label="📈 Check Level", style=discord.ButtonStyle.primary, emoji="📊", custom_id="check_level")
+    @timed_callback("panel.check_level")
     async def check_level(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.response.defer(ephemeral=True)
 
-        async with aiosqlite.connect(bot.db_path) as db:
-            async with db.execute(
-                "SELECT xp, level, messages FROM users WHERE user_id = ? AND guild_id = ?",
-                (interaction.user.id, interaction.guild.id)
-            ) as cursor:
-                result = await cursor.fetchone()
+        result = await xp_aggregator.get_stats(interaction.guild.id, interaction.user.id)
 
         if not result:
             embed = discord.Embed(
@@ -428,41 +2956,58 @@ class AllFeaturesView(Button3DView):
         progress = min(xp / xp_needed, 1.0) * 100
         embed.add_field(name="📈 Progress", value=f"```{progress:.1f}% to next level```", inline=False)
 
-        await interaction.followup.send(embed=embed, ephemeral=True)
+        card = await attach_rank_card(embed, interaction.user, level, progress / 100)
+        await interaction.followup.send(embed=embed, file=card or discord.utils.MISSING, ephemeral=True)
 
     @discord.ui.button(label="🏆 Leaderboard", style=discord.ButtonStyle.success, emoji="🏆", custom_id="leaderboard")
+    @timed_callback("panel.leaderboard")
     async def show_leaderboard(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.response.defer(ephemeral=True)
 
-        async with aiosqlite.connect(bot.db_path) as db:
-            async with db.execute(
-                "SELECT user_id, level, xp FROM users WHERE guild_id = ? ORDER BY level DESC, xp DESC LIMIT 10",
-                (interaction.guild.id,)
-            ) as cursor:
-                results = await cursor.fetchall()
+        index = await xp_rankings.get(interaction.guild.id)
+        results = await get_top_users(interaction.guild.id)
 
         if not results:
             await interaction.followup.send("No data found!", ephemeral=True)
             return
 
-        embed = discord.Embed(title="🏆 Server Leaderboard", color=0xffd700)
-
-        medals = ["🥇", "🥈", "🥉"] + ["🏅"] * 7
+        embed = await leaderboard_embed(
+            interaction.guild, "🏆 Server Leaderboard", 0xffd700,
+            [(user_id, f"Level {level} • {xp} XP") for user_id, level, xp in results],
+            0, len(index), highlight=interaction.user.id
+        )
 
-        for i, (user_id, level, xp) in enumerate(results, 1):
-            user = bot.get_user(user_id)
-            name = user.display_name if user else "Unknown User"
-            embed.add_field(
-                name=f"{medals[i-1]} #{i} {name}",
-                value=f"Level {level} • {xp} XP",
-                inline=False
-            )
+        rank = index.rank(interaction.user.id)
+        if rank:
+            embed.add_field(name="📍 Your Rank", value=f"```#{rank:,} of {len(index):,}```", inline=False)
 
         await interaction.followup.send(embed=embed, ephemeral=True)
 
 class GiveawayView(Button3DView):
     @discord.ui.button(label="🎉 Enter Giveaway", style=discord.ButtonStyle.success, custom_id="enter_giveaway")
+    @timed_callback("giveaway.enter")
     async def enter_giveaway(self, interaction: discord.Interaction, button: discord.ui.Button):
+        giveaway_info = await bot.db.fetchone(
+            "SELECT giveaway_id, end_time, ended FROM giveaways WHERE message_id = ?",
+            (interaction.message.id,)
+        )
+        if not giveaway_info:
+            await interaction.response.send_message("❌ This giveaway no longer exists.", ephemeral=True)
+            return
+
+        giveaway_id, end_time, ended = giveaway_info
+        try:
+            ended = ended or datetime.datetime.fromisoformat(end_time) <= datetime.datetime.now()
+        except (TypeError, ValueError):
+            ended = True  # no usable end time, so it was never scheduled to end either
+        if ended:
+            await interaction.response.send_message("⌛ This giveaway has already ended.", ephemeral=True)
+            return
+
+        if not await enter_giveaway(giveaway_id, interaction.user.id):
+            await interaction.response.send_message("You're already entered in this giveaway! 🍀", ephemeral=True)
+            return
+
         await interaction.response.send_message("You've entered the giveaway! Good luck! 🍀", ephemeral=True)
 
 class BirthdayModal(discord.ui.Modal, title="🎂 Set Your Birthday"):
@@ -483,10 +3028,24 @@ class BirthdayModal(discord.ui.Modal, title="🎂 Set Your Birthday"):
         max_length=4
     )
 
+    timezone = discord.ui.TextInput(
+        label="Timezone (Optional)",
+        placeholder="e.g., Asia/Kolkata",
+        required=False,
+        max_length=64
+    )
+
+    @timed_callback("modal.birthday")
     async def on_submit(self, interaction: discord.Interaction):
+        try:
+            timezone = parse_timezone(self.timezone.value)
+        except ValueError:
+            await interaction.response.send_message("❌ Unknown timezone! Use a name like Asia/Kolkata", ephemeral=True)
+            return
+
         try:
             # Validate date format
-            datetime.datetime.strptime(self.birthday_date.value, "%m-%d")
+            birth_date = parse_birthday(self.birthday_date.value)
 
             year = None
             if self.birth_year.value:
@@ -495,20 +3054,17 @@ class BirthdayModal(discord.ui.Modal, title="🎂 Set Your Birthday"):
                     await interaction.response.send_message("❌ Invalid birth year!", ephemeral=True)
                     return
 
-            async with aiosqlite.connect(bot.db_path) as db:
-                await db.execute(
-                    "INSERT OR REPLACE INTO birthdays (user_id, guild_id, birth_date, birth_year) VALUES (?, ?, ?, ?)",
-                    (interaction.user.id, interaction.guild.id, self.birthday_date.value, year)
-                )
-                await db.commit()
+            await save_birthday(interaction.user.id, interaction.guild.id, birth_date, year, timezone)
 
             success_embed = discord.Embed(
                 title="🎂 Birthday Set Successfully!",
-                description=f"Your birthday has been set to {self.birthday_date.value}",
+                description=f"Your birthday has been set to {birth_date}",
                 color=0x00ff88
             )
             if year:
                 success_embed.add_field(name="Birth Year", value=year, inline=True)
+            if timezone:
+                success_embed.add_field(name="Timezone", value=timezone, inline=True)
 
             await interaction.response.send_message(embed=success_embed, ephemeral=True)
 
@@ -551,6 +3107,7 @@ class ChannelConfigModal(discord.ui.Modal, title="⚙️ Configure Bot Channels"
         required=True
     )
 
+    @timed_callback("modal.configure")
     async def on_submit(self, interaction: discord.Interaction):
         try:
             guild = interaction.guild
@@ -580,9 +3137,8 @@ class ChannelConfigModal(discord.ui.Modal, title="⚙️ Configure Bot Channels"
             # Auto-set convert channel to same as general channel
             validated_channels["convert"] = validated_channels["general"]
 
-            # Save to database
-            for channel_type, channel_id in validated_channels.items():
-                await set_channel_config(guild.id, channel_type, channel_id)
+            # Save to database and the in-memory config snapshot
+            await set_channel_configs(guild.id, validated_channels)
 
             success_embed = discord.Embed(
                 title="✅ Channels Configured Successfully!",
@@ -603,6 +3159,86 @@ class ChannelConfigModal(discord.ui.Modal, title="⚙️ Configure Bot Channels"
         except Exception as e:
             await interaction.response.send_message(f"❌ Error configuring channels: {str(e)}", ephemeral=True)
 
+# Command checks
+MINIGAME_RATE = float(os.getenv("MINIGAME_RATE", "0.2"))  # minigame plays regained per second, per user and command
+MINIGAME_BURST = int(os.getenv("MINIGAME_BURST", "3"))  # minigame plays allowed back to back
+RATE_LIMIT_TTL = 600  # seconds before an idle bucket is forgotten
+
+class EmbedCheckFailure(discord.app_commands.CheckFailure):
+    """Check failure answered with an ephemeral embed by BotCommandTree.on_error."""
+
+    def __init__(self, title: str, description: str):
+        super().__init__(description)
+        self.embed = discord.Embed(title=title, description=description, color=0xe74c3c)
+
+class MinigameChannelError(EmbedCheckFailure):
+    pass
+
+class RateLimited(EmbedCheckFailure):
+    def __init__(self, retry_after: float):
+        super().__init__("⏳ Slow Down!", f"You can play again in **{retry_after:.1f}s**.")
+        self.retry_after = retry_after
+
+class TokenBucketLimiter:
+    """In-memory token buckets with TTL eviction.
+
+    Buckets are kept in last-used order, so expired ones are always at the front and
+    eviction is amortised O(1) per call. An evicted bucket would have been full again anyway.
+    """
+
+    def __init__(self, rate: float, burst: int, ttl: float = RATE_LIMIT_TTL):
+        self.rate = rate
+        self.burst = burst
+        self.ttl = max(ttl, burst / rate)
+        self._buckets: OrderedDict[Any, list[float]] = OrderedDict()  # key -> [tokens, updated_at]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def acquire(self, key) -> float:
+        """Take one token. Returns 0 if allowed, otherwise the seconds until a token is available."""
+        now = time.monotonic()
+        while self._buckets:
+            oldest = next(iter(self._buckets.values()))
+            if now - oldest[1] < self.ttl:
+                break
+            self._buckets.popitem(last=False)
+
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            bucket = [float(self.burst), now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        self._buckets[key] = bucket  # most recently used goes to the back
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / self.rate
+
+minigame_limiter = TokenBucketLimiter(MINIGAME_RATE, MINIGAME_BURST)
+
+def minigame_check():
+    """Minigames run only in the configured minigames channel and are rate limited per user and command.
+
+    Both checks work from memory, so rejected calls never touch the database.
+    """
+    async def predicate(interaction: discord.Interaction) -> bool:
+        config = await get_channel_config(interaction.guild.id)
+        minigames_channel_id = config.get("minigames")
+        if not minigames_channel_id:
+            raise MinigameChannelError("❌ Bot Not Configured!", "Please use `/configure` to set up bot channels first!")
+        if interaction.channel.id != minigames_channel_id:
+            raise MinigameChannelError("❌ Wrong Channel!", f"This command can only be used in <#{minigames_channel_id}>")
+
+        retry_after = minigame_limiter.acquire((interaction.user.id, interaction.command.qualified_name))
+        if retry_after:
+            raise RateLimited(retry_after)
+        return True
+
+    return discord.app_commands.check(predicate)
+
 # MINI GAMES WITH DIAMOND SYSTEM (RESTRICTED TO MINIGAMES CHANNEL)
 @bot.tree.command(name="coinflip", description="🪙 Play coin toss - Guess Heads or Tails to win 100 Diamonds!")
 @discord.app_commands.describe(choice="Choose Heads or Tails")
@@ -610,29 +3246,8 @@ class ChannelConfigModal(discord.ui.Modal, title="⚙️ Configure Bot Channels"
     discord.app_commands.Choice(name="Heads", value="heads"),
     discord.app_commands.Choice(name="Tails", value="tails")
 ])
+@minigame_check()
 async def coinflip(interaction: discord.Interaction, choice: discord.app_commands.Choice[str]):
-    # Check channel restriction
-    config = await get_channel_config(interaction.guild.id)
-    minigames_channel_id = config.get("minigames")
-    
-    if not minigames_channel_id:
-        embed = discord.Embed(
-            title="❌ Bot Not Configured!",
-            description="Please use `/configure` to set up bot channels first!",
-            color=0xe74c3c
-        )
-        await interaction.response.send_message(embed=embed, ephemeral=True)
-        return
-    
-    if interaction.channel.id != minigames_channel_id:
-        embed = discord.Embed(
-            title="❌ Wrong Channel!",
-            description=f"This command can only be used in <#{minigames_channel_id}>",
-            color=0xe74c3c
-        )
-        await interaction.response.send_message(embed=embed, ephemeral=True)
-        return
-
     result = random.choice(["heads", "tails"])
     won = choice.value == result
 
@@ -645,11 +3260,9 @@ async def coinflip(interaction: discord.Interaction, choice: discord.app_command
     embed.add_field(name="🪙 Result", value=f"```{result.title()}```", inline=True)
 
     if won:
-        await add_diamonds(interaction.user.id, interaction.guild.id, 100)
+        new_balance = await add_diamonds(interaction.user.id, interaction.guild.id, 100, reason="coinflip")
         embed.add_field(name="🎉 Result", value="```🎉 YOU WON! 🎉```", inline=False)
         embed.add_field(name="💎 Reward", value="```+100 Diamonds```", inline=True)
-
-        new_balance = await get_user_diamonds(interaction.user.id, interaction.guild.id)
         embed.add_field(name="💰 New Balance", value=f"```{new_balance:,}```", inline=True)
     else:
         embed.add_field(name="😔 Result", value="```❌ You Lost!```", inline=False)
@@ -668,29 +3281,8 @@ async def coinflip(interaction: discord.Interaction, choice: discord.app_command
     discord.app_commands.Choice(name="5", value=5),
     discord.app_commands.Choice(name="6", value=6)
 ])
+@minigame_check()
 async def dice(interaction: discord.Interaction, guess: discord.app_commands.Choice[int]):
-    # Check channel restriction
-    config = await get_channel_config(interaction.guild.id)
-    minigames_channel_id = config.get("minigames")
-    
-    if not minigames_channel_id:
-        embed = discord.Embed(
-            title="❌ Bot Not Configured!",
-            description="Please use `/configure` to set up bot channels first!",
-            color=0xe74c3c
-        )
-        await interaction.response.send_message(embed=embed, ephemeral=True)
-        return
-    
-    if interaction.channel.id != minigames_channel_id:
-        embed = discord.Embed(
-            title="❌ Wrong Channel!",
-            description=f"This command can only be used in <#{minigames_channel_id}>",
-            color=0xe74c3c
-        )
-        await interaction.response.send_message(embed=embed, ephemeral=True)
-        return
-
     result = random.randint(1, 6)
     won = guess.value == result
 
@@ -703,11 +3295,9 @@ async def dice(interaction: discord.Interaction, guess: discord.app_commands.Cho
     embed.add_field(name="🎲 Dice Result", value=f"```{result}```", inline=True)
 
     if won:
-        await add_diamonds(interaction.user.id, interaction.guild.id, 100)
+        new_balance = await add_diamonds(interaction.user.id, interaction.guild.id, 100, reason="dice")
         embed.add_field(name="🎉 Result", value="```🎉 PERFECT GUESS! 🎉```", inline=False)
         embed.add_field(name="💎 Reward", value="```+100 Diamonds```", inline=True)
-
-        new_balance = await get_user_diamonds(interaction.user.id, interaction.guild.id)
         embed.add_field(name="💰 New Balance", value=f"```{new_balance:,}```", inline=True)
     else:
         embed.add_field(name="😔 Result", value="```❌ Wrong Guess!```", inline=False)
@@ -725,36 +3315,20 @@ async def dice(interaction: discord.Interaction, guess: discord.app_commands.Cho
     discord.app_commands.Choice(name="Head", value="head"),
     discord.app_commands.Choice(name="Tail", value="tail")
 ])
+@minigame_check()
 async def tos_coin(interaction: discord.Interaction, choice: discord.app_commands.Choice[str], bet: int = 100):
-    # Check channel restriction
-    config = await get_channel_config(interaction.guild.id)
-    minigames_channel_id = config.get("minigames")
-    
-    if not minigames_channel_id:
-        embed = discord.Embed(
-            title="❌ Bot Not Configured!",
-            description="Please use `/configure` to set up bot channels first!",
-            color=0xe74c3c
-        )
-        await interaction.response.send_message(embed=embed, ephemeral=True)
-        return
-    
-    if interaction.channel.id != minigames_channel_id:
-        embed = discord.Embed(
-            title="❌ Wrong Channel!",
-            description=f"This command can only be used in <#{minigames_channel_id}>",
-            color=0xe74c3c
-        )
-        await interaction.response.send_message(embed=embed, ephemeral=True)
-        return
-
     if bet < 100:
         await interaction.response.send_message("❌ Minimum bet is 100 Diamonds!", ephemeral=True)
         return
 
+    # Bets the cached balance can't cover are refused without touching the database;
+    # otherwise deduct first, and the conditional debit can't overdraw even under concurrent bets
     user_balance = await get_user_diamonds(interaction.user.id, interaction.guild.id)
+    balance_after_bet = None
+    if user_balance >= bet:
+        balance_after_bet = await remove_diamonds(interaction.user.id, interaction.guild.id, bet, reason="tos_coin_bet")
 
-    if user_balance < bet:
+    if balance_after_bet is None:
         embed = discord.Embed(
             title="❌ Insufficient Diamonds",
             description=f"You need at least {bet:,} Diamonds to place this bet!",
@@ -765,9 +3339,6 @@ async def tos_coin(interaction: discord.Interaction, choice: discord.app_command
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
 
-    # Deduct bet amount first
-    await remove_diamonds(interaction.user.id, interaction.guild.id, bet)
-
     result = random.choice(["head", "tail"])
     won = choice.value == result
 
@@ -783,18 +3354,14 @@ async def tos_coin(interaction: discord.Interaction, choice: discord.app_command
 
     if won:
         winnings = bet * 2
-        await add_diamonds(interaction.user.id, interaction.guild.id, winnings)
+        new_balance = await add_diamonds(interaction.user.id, interaction.guild.id, winnings, reason="tos_coin_win")
         embed.add_field(name="🎉 Result", value="```🎉 WINNER! 🎉```", inline=False)
         embed.add_field(name="💎 You Won", value=f"```+{winnings:,} Diamonds```", inline=True)
-
-        new_balance = await get_user_diamonds(interaction.user.id, interaction.guild.id)
         embed.add_field(name="💰 New Balance", value=f"```{new_balance:,}```", inline=True)
     else:
         embed.add_field(name="😔 Result", value="```❌ You Lost!```", inline=False)
         embed.add_field(name="💎 Lost", value=f"```-{bet:,} Diamonds```", inline=True)
-
-        new_balance = await get_user_diamonds(interaction.user.id, interaction.guild.id)
-        embed.add_field(name="💰 New Balance", value=f"```{new_balance:,}```", inline=True)
+        embed.add_field(name="💰 New Balance", value=f"```{balance_after_bet:,}```", inline=True)
 
     embed.set_footer(text="🧩 Win = Double your bet, Lose = Lose your bet!")
     await interaction.response.send_message(embed=embed)
@@ -816,37 +3383,110 @@ async def diamond_balance(interaction: discord.Interaction):
 
     await interaction.response.send_message(embed=embed)
 
+# XP policy
+XP_COOLDOWN = float(os.getenv("XP_COOLDOWN", "60"))  # seconds between XP awards per member (0 = every message)
+XP_MIN = 15  # XP range per rewarded message, before multipliers
+XP_MAX = 25
+
+class XPPolicy:
+    """Decides whether a message earns XP, and how much, using only in-memory state.
+
+    Checked in order: channel rules (a guild with any "allow" entries only rewards those channels or
+    categories; "deny" entries never reward), the per-member cooldown, then the member's multiplier
+    from diamonds.multiplier. Rules and multipliers are loaded once and written through by the admin commands.
+    """
+
+    def __init__(self, cooldown: float = XP_COOLDOWN):
+        self.cooldown = TokenBucketLimiter(1 / cooldown, 1, ttl=cooldown) if cooldown > 0 else None
+        self._allowed: dict[int, set[int]] = {}
+        self._denied: dict[int, set[int]] = {}
+        self._multipliers: dict[tuple[int, int], float] = {}  # only members whose multiplier isn't 1.0
+
+    async def load(self):
+        self._allowed.clear()
+        self._denied.clear()
+        for guild_id, channel_id, rule in await bot.db.fetchall("SELECT guild_id, channel_id, rule FROM xp_channel_rules"):
+            rules = self._allowed if rule == "allow" else self._denied
+            rules.setdefault(guild_id, set()).add(channel_id)
+
+        rows = await bot.db.fetchall("SELECT guild_id, user_id, multiplier FROM diamonds WHERE multiplier != 1.0")
+        self._multipliers = {(guild_id, user_id): multiplier for guild_id, user_id, multiplier in rows}
+        print(f"✅ Loaded XP policy: {len(self._multipliers)} multiplier(s)")
+
+    def rules(self, guild_id: int) -> tuple[set[int], set[int]]:
+        return self._allowed.get(guild_id, set()), self._denied.get(guild_id, set())
+
+    async def set_channel_rule(self, guild_id: int, channel_id: int, rule: Optional[str]):
+        """Set a channel or category to "allow" or "deny", or clear it with None."""
+        if rule:
+            await bot.db.execute(
+                "INSERT OR REPLACE INTO xp_channel_rules (guild_id, channel_id, rule) VALUES (?, ?, ?)",
+                (guild_id, channel_id, rule)
+            )
+        else:
+            await bot.db.execute(
+                "DELETE FROM xp_channel_rules WHERE guild_id = ? AND channel_id = ?",
+                (guild_id, channel_id)
+            )
+        for rules in (self._allowed, self._denied):
+            rules.get(guild_id, set()).discard(channel_id)
+        if rule:
+            (self._allowed if rule == "allow" else self._denied).setdefault(guild_id, set()).add(channel_id)
+
+    def forget_multiplier(self, guild_id: int, user_id: int):
+        self._multipliers.pop((guild_id, user_id), None)
+
+    async def set_multiplier(self, guild_id: int, user_id: int, multiplier: float):
+        async with bot.db.transaction() as db:
+            balance, displaced = await upsert_diamonds(
+                db, guild_id, user_id, {"multiplier": multiplier}, {"multiplier": "excluded.multiplier"}
+            )
+
+        forget_displaced_diamonds(displaced, user_id)
+        balance_cache.set(guild_id, user_id, balance)
+        diamond_rankings.update(guild_id, user_id, balance)
+        if multiplier == 1.0:
+            self.forget_multiplier(guild_id, user_id)
+        else:
+            self._multipliers[(guild_id, user_id)] = multiplier
+
+    def evaluate(self, message: discord.Message) -> int:
+        """XP this message earns; 0 means skip it without touching storage."""
+        guild_id = message.guild.id
+        channel = message.channel
+        scopes = (channel.id, getattr(channel, "parent_id", None), getattr(channel, "category_id", None))
+
+        denied = self._denied.get(guild_id)
+        if denied and any(scope in denied for scope in scopes):
+            return 0
+        allowed = self._allowed.get(guild_id)
+        if allowed and not any(scope in allowed for scope in scopes):
+            return 0
+
+        if self.cooldown is not None and self.cooldown.acquire((guild_id, message.author.id)):
+            return 0
+
+        multiplier = self._multipliers.get((guild_id, message.author.id), 1.0)
+        return round(random.randint(XP_MIN, XP_MAX) * multiplier)
+
+xp_policy = XPPolicy()
+
 # XP System (Message Handler)
 @bot.event
 async def on_message(message):
-    if message.author.bot:
+    if message.author.bot or message.guild is None:
         return
 
-    # Add XP for messages
-    xp_gain = random.randint(15, 25)
-
-    async with aiosqlite.connect(bot.db_path) as db:
-        # Get current user data
-        async with db.execute(
-            "SELECT xp, level, messages FROM users WHERE user_id = ? AND guild_id = ?",
-            (message.author.id, message.guild.id)
-        ) as cursor:
-            result = await cursor.fetchone()
-
-        if result:
-            current_xp, current_level, messages = result
-        else:
-            current_xp, current_level, messages = 0, 0, 0
-
-        new_xp = current_xp + xp_gain
-        new_messages = messages + 1
-        new_level = current_level
+    messages_seen.inc()
+    member_cache.touch(message.author)
+    event_logger.log("message", message.guild.id, message.author.id, message.channel.id, message_id=message.id)
 
-        # Check for level up
-        xp_needed = (current_level + 1) * 100
-        if new_xp >= xp_needed:
-            new_level = current_level + 1
+    # Add XP for messages; the policy runs in memory, so messages that earn nothing stop here
+    xp_gain = xp_policy.evaluate(message)
+    if xp_gain:
+        new_level, leveled_up = await xp_aggregator.add_xp(message.guild.id, message.author.id, xp_gain)
 
+        if leveled_up:
             # Level up notification
             embed = discord.Embed(
                 title="🎉 Level Up!",
@@ -855,13 +3495,6 @@ async def on_message(message):
             )
             await message.channel.send(embed=embed, delete_after=5)
 
-        # Update database
-        await db.execute('''
-            INSERT OR REPLACE INTO users (user_id, guild_id, xp, level, messages)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (message.author.id, message.guild.id, new_xp, new_level, new_messages))
-        await db.commit()
-
     await bot.process_commands(message)
 
 # Slash Commands
@@ -869,17 +3502,15 @@ async def on_message(message):
 async def level(interaction: discord.Interaction, member: Optional[discord.Member] = None):
     target = member or interaction.user
 
-    async with aiosqlite.connect(bot.db_path) as db:
-        async with db.execute(
-            "SELECT xp, level, messages FROM users WHERE user_id = ? AND guild_id = ?",
-            (target.id, interaction.guild.id)
-        ) as cursor:
-            result = await cursor.fetchone()
+    result = await xp_aggregator.get_stats(interaction.guild.id, target.id)
 
     if not result:
         await interaction.response.send_message("No data found for this user!", ephemeral=True)
         return
 
+    # Rank card rendering may need an avatar download
+    await interaction.response.defer()
+
     xp, level, messages = result
     xp_needed = (level + 1) * 100
 
@@ -890,53 +3521,93 @@ async def level(interaction: discord.Interaction, member: Optional[discord.Membe
 
     progress = min(xp / xp_needed, 1.0) * 100
     embed.add_field(name="📈 Progress", value=f"```{progress:.1f}% to next level```", inline=False)
-    embed.set_thumbnail(url=target.display_avatar.url)
 
-    await interaction.response.send_message(embed=embed)
+    index = await xp_rankings.get(interaction.guild.id)
+    rank = index.rank(target.id)
+    if rank:
+        embed.add_field(name="🏅 Rank", value=f"```#{rank:,} of {len(index):,}```", inline=True)
+
+    card = await attach_rank_card(embed, target, level, progress / 100)
+    if not card:
+        embed.set_thumbnail(url=target.display_avatar.url)
+    await interaction.followup.send(embed=embed, file=card or discord.utils.MISSING)
 
 @bot.tree.command(name="leaderboard", description="Show server leaderboard")
-async def leaderboard(interaction: discord.Interaction):
-    async with aiosqlite.connect(bot.db_path) as db:
-        async with db.execute(
-            "SELECT user_id, level, xp FROM users WHERE guild_id = ? ORDER BY level DESC, xp DESC LIMIT 10",
-            (interaction.guild.id,)
-        ) as cursor:
-            results = await cursor.fetchall()
+@discord.app_commands.describe(
+    page="Page to show (10 members per page)",
+    around_me="Show the page around your own rank instead"
+)
+async def leaderboard(interaction: discord.Interaction, page: Optional[int] = None, around_me: bool = False):
+    index = await xp_rankings.get(interaction.guild.id)
+    total = len(index)
 
-    if not results:
+    if not total:
         await interaction.response.send_message("No data found!", ephemeral=True)
         return
 
-    embed = discord.Embed(title="🏆 Server Leaderboard", color=0xffd700)
+    rank = index.rank(interaction.user.id) if around_me else None
+    if around_me and not rank:
+        await interaction.response.send_message("You're not ranked yet! Start chatting to gain XP!", ephemeral=True)
+        return
 
-    medals = ["🥇", "🥈", "🥉"] + ["🏅"] * 7
+    start = page_start(page, total, rank)
+    results = await get_top_users(interaction.guild.id, start=start)
 
-    for i, (user_id, level, xp) in enumerate(results, 1):
-        user = bot.get_user(user_id)
-        name = user.display_name if user else "Unknown User"
-        embed.add_field(
-            name=f"{medals[i-1]} #{i} {name}",
-            value=f"Level {level} • {xp} XP",
-            inline=False
-        )
+    embed = await leaderboard_embed(
+        interaction.guild, "🏆 Server Leaderboard", 0xffd700,
+        [(user_id, f"Level {level} • {xp} XP") for user_id, level, xp in results],
+        start, total, highlight=interaction.user.id if around_me else None
+    )
+
+    await interaction.response.send_message(embed=embed)
+
+@bot.tree.command(name="richlist", description="Show the server's Diamond rich-list")
+@discord.app_commands.describe(
+    page="Page to show (10 members per page)",
+    around_me="Show the page around your own rank instead"
+)
+async def richlist(interaction: discord.Interaction, page: Optional[int] = None, around_me: bool = False):
+    index = await diamond_rankings.get(interaction.guild.id)
+    total = len(index)
+
+    if not total:
+        await interaction.response.send_message("No one has earned Diamonds yet!", ephemeral=True)
+        return
+
+    rank = index.rank(interaction.user.id) if around_me else None
+    if around_me and not rank:
+        await interaction.response.send_message("You don't have any Diamonds yet! Try `/coinflip`!", ephemeral=True)
+        return
+
+    start = page_start(page, total, rank)
+    results = await get_richest_users(interaction.guild.id, start=start)
+
+    embed = await leaderboard_embed(
+        interaction.guild, "💎 Diamond Rich-List", 0x9932cc,
+        [(user_id, f"{balance:,} Diamonds") for user_id, balance in results],
+        start, total, highlight=interaction.user.id if around_me else None
+    )
 
     await interaction.response.send_message(embed=embed)
 
 @bot.tree.command(name="birthday", description="Set your birthday")
 @discord.app_commands.describe(
     date="Your birthday (MM-DD format)",
-    year="Birth year (optional)"
+    year="Birth year (optional)",
+    timezone="Your timezone, e.g. Asia/Kolkata (optional)"
 )
-async def set_birthday(interaction: discord.Interaction, date: str, year: Optional[int] = None):
+async def set_birthday(interaction: discord.Interaction, date: str, year: Optional[int] = None,
+                       timezone: Optional[str] = None):
     try:
-        datetime.datetime.strptime(date, "%m-%d")
+        timezone = parse_timezone(timezone)
+    except ValueError:
+        await interaction.response.send_message("Unknown timezone! Use a name like Asia/Kolkata", ephemeral=True)
+        return
 
-        async with aiosqlite.connect(bot.db_path) as db:
-            await db.execute(
-                "INSERT OR REPLACE INTO birthdays (user_id, guild_id, birth_date, birth_year) VALUES (?, ?, ?, ?)",
-                (interaction.user.id, interaction.guild.id, date, year)
-            )
-            await db.commit()
+    try:
+        date = parse_birthday(date)
+
+        await save_birthday(interaction.user.id, interaction.guild.id, date, year, timezone)
 
         embed = discord.Embed(
             title="🎂 Birthday Set!",
@@ -945,12 +3616,33 @@ async def set_birthday(interaction: discord.Interaction, date: str, year: Option
         )
         if year:
             embed.add_field(name="Birth Year", value=year, inline=True)
+        if timezone:
+            embed.add_field(name="Timezone", value=timezone, inline=True)
 
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
     except ValueError:
         await interaction.response.send_message("Invalid date format! Use MM-DD (e.g., 12-25)", ephemeral=True)
 
+@bot.tree.command(name="upcoming_birthdays", description="Show upcoming birthdays in this server")
+@discord.app_commands.describe(days="How many days ahead to look (default 7)")
+async def upcoming_birthdays(interaction: discord.Interaction, days: discord.app_commands.Range[int, 1, 60] = 7):
+    today = datetime.datetime.now(zoneinfo.ZoneInfo(BIRTHDAY_TIMEZONE)).date()
+    upcoming = birthday_calendar.upcoming(interaction.guild.id, today, days)
+
+    embed = discord.Embed(title="🎂 Upcoming Birthdays", color=0xff69b4)
+    lines = []
+    for day, user_id, birth_year in upcoming[:25]:
+        when = "Today" if day == today else day.strftime("%b %d")
+        age_text = f" (turning {day.year - birth_year})" if birth_year else ""
+        lines.append(f"{when} • <@{user_id}>{age_text}")
+
+    embed.description = "\n".join(lines) if lines else f"No birthdays in the next {days} day(s)."
+    if len(upcoming) > 25:
+        embed.set_footer(text=f"…and {len(upcoming) - 25} more")
+
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 @bot.tree.command(name="giveaway", description="Create a giveaway")
 @discord.app_commands.describe(
     prize="What are you giving away?",
@@ -972,12 +3664,14 @@ async def giveaway(interaction: discord.Interaction, prize: str, duration: int,
 
     message = await interaction.original_response()
 
-    async with aiosqlite.connect(bot.db_path) as db:
-        await db.execute(
-            "INSERT INTO giveaways (guild_id, channel_id, message_id, prize, winner_count, end_time, host_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (interaction.guild.id, interaction.channel.id, message.id, prize, winners, end_time, interaction.user.id)
-        )
-        await db.commit()
+    cursor = await bot.db.execute(
+        "INSERT INTO giveaways (guild_id, channel_id, message_id, prize, winner_count, end_time, host_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (interaction.guild.id, interaction.channel.id, message.id, prize, winners, end_time, interaction.user.id)
+    )
+    await job_scheduler.schedule(
+        "end_giveaway", end_time.timestamp(), {"giveaway_id": cursor.lastrowid},
+        guild_id=interaction.guild.id, key=f"giveaway:{cursor.lastrowid}"
+    )
 
 # SETUP COMMANDS
 @bot.tree.command(name="configure", description="Configure bot channels for your server")
@@ -1063,34 +3757,285 @@ async def ticket_setup(interaction: discord.Interaction, channel: discord.TextCh
     await channel.send(embed=embed, view=view)
     await interaction.response.send_message("✅ Ticket system set up!", ephemeral=True)
 
+@bot.tree.command(name="stats", description="Show command usage and activity for this server (admin)")
+@discord.app_commands.describe(hours="How many hours back to report (default 24)")
+async def stats(interaction: discord.Interaction, hours: discord.app_commands.Range[int, 1, 720] = 24):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ You need Administrator permissions to view bot stats!", ephemeral=True)
+        return
+
+    # Only the hourly rollups are read, so the cost depends on the window, not on history size
+    since = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=hours - 1)).strftime("%Y-%m-%d %H")
+    command_rows = await bot.db.fetchall('''
+        SELECT command, SUM(uses), SUM(errors), SUM(total_ms) / SUM(uses), MAX(max_ms)
+        FROM command_stats WHERE guild_id = ? AND hour >= ?
+        GROUP BY command ORDER BY SUM(uses) DESC LIMIT 10
+    ''', (interaction.guild.id, since))
+    activity = await bot.db.fetchone('''
+        SELECT SUM(messages), MAX(messages) FROM activity_stats WHERE guild_id = ? AND hour >= ?
+    ''', (interaction.guild.id, since))
+    busiest = await bot.db.fetchone('''
+        SELECT hour, messages FROM activity_stats WHERE guild_id = ? AND hour >= ?
+        ORDER BY messages DESC LIMIT 1
+    ''', (interaction.guild.id, since))
+
+    embed = discord.Embed(
+        title="📊 Server Activity",
+        description=f"Last {hours} hour(s)",
+        color=0x3498db
+    )
+    embed.add_field(name="💬 Messages", value=f"```{activity[0] or 0:,}```", inline=True)
+    if busiest:
+        embed.add_field(name="🔥 Busiest Hour (UTC)", value=f"```{busiest[0]}:00 • {busiest[1]:,}```", inline=True)
+
+    if command_rows:
+        lines = [
+            f"/{command:<14} {uses:>6,} uses  avg {avg_ms:>6.0f}ms  max {max_ms:>6.0f}ms" + (f"  {errors} err" if errors else "")
+            for command, uses, errors, avg_ms, max_ms in command_rows
+        ]
+        embed.add_field(name="⚡ Top Commands", value="```" + "\n".join(lines) + "```", inline=False)
+    else:
+        embed.add_field(name="⚡ Top Commands", value="```No commands used yet```", inline=False)
+
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+def short_sql(sql: str, width: int = 60) -> str:
+    return sql if len(sql) <= width else sql[:width - 1] + "…"
+
+@bot.tree.command(name="sql_profile", description="Show the slowest and most expensive SQL statements (admin)")
+@discord.app_commands.describe(reset="Clear the collected timings after reporting them")
+async def sql_profile(interaction: discord.Interaction, reset: bool = False):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ You need Administrator permissions to view the SQL profile!", ephemeral=True)
+        return
+
+    report = bot.db.profiler.report()
+    embed = discord.Embed(
+        title="🐢 SQL Profile",
+        description=f"Since {report['since']} • slow threshold {SQL_SLOW_MS:g}ms" + (" • query plans on" if report["debug"] else ""),
+        color=0x3498db
+    )
+    if report["statements"]:
+        lines = [
+            f"{statement['total_ms']:>9,.0f}ms {statement['calls']:>7,}x  {short_sql(statement['sql'], 48)}"
+            for statement in report["statements"][:8]
+        ]
+        embed.add_field(name="⏱️ Most Time Spent", value="```" + "\n".join(lines) + "```", inline=False)
+    else:
+        embed.add_field(name="⏱️ Most Time Spent", value="```No statements recorded yet```", inline=False)
+    if report["slowest"]:
+        lines = [f"{entry['ms']:>8,.1f}ms  {short_sql(entry['sql'], 40)} {entry['params']}"[:110] for entry in report["slowest"][:8]]
+        embed.add_field(name="🐢 Slowest Calls", value="```" + "\n".join(lines) + "```", inline=False)
+    if report["flagged"]:
+        lines = [f"{'; '.join(entry['flags'])[:40]}  {short_sql(entry['sql'], 50)}" for entry in report["flagged"][:8]]
+        embed.add_field(name="⚠️ Plan Warnings", value="```" + "\n".join(lines) + "```", inline=False)
+    elif not report["debug"]:
+        embed.set_footer(text="Set SQL_DEBUG=1 to capture query plans and flag full scans")
+
+    # The full report, with every statement and plan, as an attachment
+    file = discord.File(io.BytesIO(json.dumps(report, indent=2).encode()), filename="sql_profile.json")
+    if reset:
+        bot.db.profiler.reset()
+    await interaction.response.send_message(embed=embed, file=file, ephemeral=True)
+
+@bot.tree.command(name="ticket_search", description="Search closed ticket transcripts (admin)")
+@discord.app_commands.describe(query="Words to search for", member="Only search tickets opened by this member")
+async def ticket_search(interaction: discord.Interaction, query: str, member: Optional[discord.Member] = None):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ You need Administrator permissions to search tickets!", ephemeral=True)
+        return
+
+    results = await transcript_index.search(interaction.guild.id, query, member.id if member else None)
+
+    embed = discord.Embed(
+        title="🔎 Ticket Search",
+        description=f"Results for **{discord.utils.escape_markdown(query)}**",
+        color=0x3498db
+    )
+    if not results:
+        embed.add_field(name="📭 No Matches", value="```No closed tickets match this search```", inline=False)
+    for ticket_id, user_id, channel_name, closed_at, excerpt, _ in results:
+        embed.add_field(
+            name=f"🎫 #{ticket_id} • {channel_name or 'ticket'}",
+            value=f"<@{user_id}> • closed {closed_at or 'unknown'}\n{excerpt[:900]}",
+            inline=False
+        )
+
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="xp_channel", description="Allow or deny XP in a channel or category (admin)")
+@discord.app_commands.describe(
+    channel="Channel or category",
+    rule="Allow: only allowed channels earn XP. Deny: this channel never earns XP. Clear: remove the rule"
+)
+@discord.app_commands.choices(rule=[
+    discord.app_commands.Choice(name="Allow", value="allow"),
+    discord.app_commands.Choice(name="Deny", value="deny"),
+    discord.app_commands.Choice(name="Clear", value="clear")
+])
+async def xp_channel(interaction: discord.Interaction, channel: discord.abc.GuildChannel, rule: discord.app_commands.Choice[str]):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ You need Administrator permissions to change XP rules!", ephemeral=True)
+        return
+
+    await xp_policy.set_channel_rule(interaction.guild.id, channel.id, None if rule.value == "clear" else rule.value)
+    allowed, denied = xp_policy.rules(interaction.guild.id)
+
+    embed = discord.Embed(title="⚡ XP Channel Rules", color=0x2ECC71)
+    embed.add_field(name="✅ Allowed", value=" ".join(f"<#{channel_id}>" for channel_id in allowed) or "All channels", inline=False)
+    embed.add_field(name="🚫 Denied", value=" ".join(f"<#{channel_id}>" for channel_id in denied) or "None", inline=False)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="xp_multiplier", description="Set a member's XP multiplier (admin)")
+@discord.app_commands.describe(member="Member to boost", multiplier="XP multiplier (1.0 = normal)")
+async def xp_multiplier(interaction: discord.Interaction, member: discord.Member,
+                        multiplier: discord.app_commands.Range[float, 0.0, 10.0]):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ You need Administrator permissions to change XP multipliers!", ephemeral=True)
+        return
+
+    await xp_policy.set_multiplier(interaction.guild.id, member.id, multiplier)
+    await interaction.response.send_message(f"✅ {member.mention} now earns **{multiplier:g}x** XP.", ephemeral=True)
+
+# Command sync
+COMMAND_SYNC_GUILD = int(os.getenv("COMMAND_SYNC_GUILD", "0"))  # development: sync to this guild only, updates show instantly
+
+def command_tree_hash(guild: Optional[discord.abc.Snowflake] = None) -> str:
+    """Stable fingerprint of the app command payload Discord would receive (names, descriptions, options, choices)."""
+    payload = sorted(
+        (command.to_dict(bot.tree) for command in bot.tree.get_commands(guild=guild)),
+        key=lambda command: (command.get("type", 1), command["name"])
+    )
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+async def sync_commands():
+    """Sync the command tree only when it differs from what was last synced for this application."""
+    guild = discord.Object(id=COMMAND_SYNC_GUILD) if COMMAND_SYNC_GUILD else None
+    if guild:
+        bot.tree.copy_global_to(guild=guild)
+
+    state_key = f"command_tree_hash:{bot.application_id}:{COMMAND_SYNC_GUILD or 'global'}"
+    digest = command_tree_hash(guild)
+    row = await bot.db.fetchone("SELECT value FROM bot_state WHERE key = ?", (state_key,))
+    if row and row[0] == digest:
+        print("Commands unchanged, skipping sync")
+        return
+
+    try:
+        synced = await bot.tree.sync(guild=guild)
+    except Exception as e:
+        print(f"Failed to sync commands: {e}")
+        return
+    await bot.db.execute("INSERT OR REPLACE INTO bot_state (key, value) VALUES (?, ?)", (state_key, digest))
+    print(f"Synced {len(synced)} command(s)" + (f" to guild {COMMAND_SYNC_GUILD}" if guild else ""))
+
+# Metrics read from the bot's own structures at scrape time
+metrics.collected("bot_gateway_latency_seconds", "Heartbeat round trip to the Discord gateway",
+                  lambda: bot.latency if math.isfinite(bot.latency) else None)
+metrics.collected("bot_guilds", "Guilds the bot is in", lambda: len(bot.guilds))
+metrics.collected("bot_cluster_leader", "1 while this process holds the cluster leader lease", lambda: int(leader_lease.is_leader))
+metrics.collected("bot_db_waits_total", "Database calls that had to queue for a connection",
+                  lambda: {("read",): bot.db.contention["read_waits"], ("write",): bot.db.contention["write_waits"]},
+                  labels=("kind",), type="counter")
+metrics.collected("bot_db_wait_seconds_total", "Time spent queueing for a database connection",
+                  lambda: {("read",): bot.db.contention["read_wait_s"], ("write",): bot.db.contention["write_wait_s"]},
+                  labels=("kind",), type="counter")
+metrics.collected("bot_cache_hits_total", "Cache lookups answered from memory",
+                  lambda: {("balance",): balance_cache.hits, ("rank_card",): rank_cards.hits, ("member",): member_cache.hits}, labels=("cache",), type="counter")
+metrics.collected("bot_cache_misses_total", "Cache lookups that went to the database, renderer or gateway",
+                  lambda: {("balance",): balance_cache.misses, ("rank_card",): rank_cards.misses, ("member",): member_cache.misses}, labels=("cache",), type="counter")
+metrics.collected("bot_ranking_guilds_loaded", "Guilds with an in-memory ranking index",
+                  lambda: {("xp",): xp_rankings.loaded_count, ("diamonds",): diamond_rankings.loaded_count}, labels=("ranking",))
+metrics.collected("bot_queue_depth", "Items waiting in background queues and write-behind buffers", lambda: {
+    ("event_log",): event_logger.queue.qsize(),
+    ("transcript_index",): transcript_index.queue.qsize(),
+    ("xp_dirty",): xp_aggregator.dirty_count,
+    ("ledger_pending",): diamond_ledger.pending_count,
+    ("jobs",): len(job_scheduler),
+}, labels=("queue",))
+metrics.collected("bot_event_log_discarded_total", "Event log entries dropped on a full queue or sampled out under load",
+                  lambda: {("dropped",): event_logger.dropped, ("sampled_out",): event_logger.sampled_out}, labels=("reason",), type="counter")
+metrics.collected("bot_transcript_pages_dropped_total", "Transcript pages not indexed because the index queue was full",
+                  lambda: transcript_index.dropped, type="counter")
+metrics.collected("bot_member_cache_size", "Members held by the lean member cache", lambda: len(member_cache))
+metrics.collected("bot_member_queries_total", "query_members batches sent to resolve uncached members", lambda: member_cache.queries, type="counter")
+metrics.collected("bot_minigame_buckets", "Live minigame rate-limit buckets", lambda: len(minigame_limiter))
+
 # Bot Events
 @bot.event
 async def on_ready():
     print(f'{bot.user} has connected to Discord!')
     try:
-        synced = await bot.tree.sync()
-        print(f"Synced {len(synced)} command(s)")
-        
         # Send startup messages to all configured servers
         await send_startup_messages()
-        
+
     except Exception as e:
-        print(f"Failed to sync commands: {e}")
+        print(f"Failed to send startup messages: {e}")
+
+# Panel registry
+STARTUP_FANOUT = int(os.getenv("STARTUP_FANOUT", "10"))  # guilds whose startup panels are published at the same time
+panel_messages: set[int] = set()  # message IDs of registered panels, so deletes elsewhere cost nothing
+
+def panel_hash(channel_id: int, embed: discord.Embed, view: discord.ui.View) -> str:
+    """Fingerprint of what a panel shows; the embed timestamp is left out so restarts alone don't count as changes."""
+    content = embed.to_dict()
+    content.pop("timestamp", None)
+    content["channel_id"] = channel_id
+    content["view"] = type(view).__name__
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+async def publish_panel(guild: discord.Guild, panel: str, channel: discord.TextChannel, embed: discord.Embed,
+                        view: discord.ui.View, existing: Optional[tuple[int, int, str]]) -> str:
+    """Post a panel once, then keep it up to date in place. Returns "skipped", "edited" or "sent"."""
+    content_hash = panel_hash(channel.id, embed, view)
+
+    if existing and existing[0] == channel.id:
+        _, message_id, old_hash = existing
+        if old_hash == content_hash:
+            return "skipped"
+        try:
+            await channel.get_partial_message(message_id).edit(embed=embed, view=view)
+            await bot.db.execute(
+                "UPDATE panels SET content_hash = ?, updated_at = CURRENT_TIMESTAMP WHERE guild_id = ? AND panel = ?",
+                (content_hash, guild.id, panel)
+            )
+            return "edited"
+        except discord.NotFound:
+            pass  # panel was deleted, post a fresh one
+
+    message = await channel.send(embed=embed, view=view)
+    panel_messages.add(message.id)
+    await bot.db.execute(
+        "INSERT OR REPLACE INTO panels (guild_id, panel, channel_id, message_id, content_hash) VALUES (?, ?, ?, ?, ?)",
+        (guild.id, panel, channel.id, message.id, content_hash)
+    )
+    return "sent"
 
 async def send_startup_messages():
-    """Send startup messages with feature buttons to configured channels"""
-    for guild in bot.guilds:
-        try:
-            config = await get_channel_config(guild.id)
-            
-            if not config:
-                print(f"No configuration found for guild: {guild.name}")
-                continue
-            
-            # Create main features embed
-            main_embed = discord.Embed(
-                title="🤖 Bot Online & Ready!",
-                description=f"""
+    """Publish the feature and ticket panels in every configured guild, a few guilds at a time"""
+    rows = await bot.db.fetchall("SELECT guild_id, panel, channel_id, message_id, content_hash FROM panels")
+    registry = {(guild_id, panel): (channel_id, message_id, content_hash) for guild_id, panel, channel_id, message_id, content_hash in rows}
+    panel_messages.update(message_id for _, message_id, _ in registry.values())
+    semaphore = asyncio.Semaphore(STARTUP_FANOUT)
+
+    async def publish(guild: discord.Guild):
+        async with semaphore:
+            await send_guild_panels(guild, registry)
+
+    await asyncio.gather(*(publish(guild) for guild in bot.guilds))
+
+async def send_guild_panels(guild: discord.Guild, registry: dict[tuple[int, str], tuple[int, int, str]]):
+    try:
+        config = await get_channel_config(guild.id)
+        
+        if not config:
+            print(f"No configuration found for guild: {guild.name}")
+            return
+        
+        # Create main features embed
+        main_embed = discord.Embed(
+            title="🤖 Bot Online & Ready!",
+            description=f"""
 **🎉 All Features Active in {guild.name}!**
 
 **🎫 Support System** - Create tickets for help
@@ -1105,50 +4050,63 @@ async def send_startup_messages():
 🎮 Mini Games: <#{config.get('minigames', 'Not Set')}>
 📝 Transcripts: <#{config.get('transcript', 'Not Set')}>
 🎁 Daily: <#{config.get('daily', 'Not Set')}>
-                """,
-                color=0x00ff88,
-                timestamp=datetime.datetime.now()
-            )
-            main_embed.set_footer(text="✨ PCRP Bot Ready for Action!")
-            
-            # Create ticket embed
-            ticket_embed = discord.Embed(
-                title="🎫 Support Ticket System",
-                description="Need help? Click the button below to create a private support ticket!",
-                color=0x2ECC71
-            )
-            ticket_embed.set_footer(text="✨ PCRP Support Team")
-            
-            # Send to General Channel with full feature buttons
-            general_channel_id = config.get("general")
-            if general_channel_id:
-                general_channel = guild.get_channel(general_channel_id)
-                if general_channel:
-                    try:
-                        view = AllFeaturesView()
-                        await general_channel.send(embed=main_embed, view=view)
-                        print(f"✅ Sent startup message to General channel in {guild.name}")
-                    except Exception as e:
-                        print(f"❌ Failed to send to General channel in {guild.name}: {e}")
-            
-            # Send to Ticket Channel with ticket creation button
-            ticket_channel_id = config.get("ticket")
-            if ticket_channel_id:
-                ticket_channel = guild.get_channel(ticket_channel_id)
-                if ticket_channel:
-                    try:
-                        view = TicketView()
-                        await ticket_channel.send(embed=ticket_embed, view=view)
-                        print(f"✅ Sent ticket panel to Ticket channel in {guild.name}")
-                    except Exception as e:
-                        print(f"❌ Failed to send to Ticket channel in {guild.name}: {e}")
-                        
-        except Exception as e:
-            print(f"❌ Error sending startup messages to {guild.name}: {e}")
+            """,
+            color=0x00ff88,
+            timestamp=datetime.datetime.now()
+        )
+        main_embed.set_footer(text="✨ PCRP Bot Ready for Action!")
+        
+        # Create ticket embed
+        ticket_embed = discord.Embed(
+            title="🎫 Support Ticket System",
+            description="Need help? Click the button below to create a private support ticket!",
+            color=0x2ECC71
+        )
+        ticket_embed.set_footer(text="✨ PCRP Support Team")
+        
+        # Send to General Channel with full feature buttons
+        general_channel_id = config.get("general")
+        if general_channel_id:
+            general_channel = guild.get_channel(general_channel_id)
+            if general_channel:
+                try:
+                    result = await publish_panel(guild, "features", general_channel, main_embed, AllFeaturesView(), registry.get((guild.id, "features")))
+                    if result != "skipped":
+                        print(f"✅ Startup message {result} in General channel in {guild.name}")
+                except Exception as e:
+                    print(f"❌ Failed to send to General channel in {guild.name}: {e}")
+        
+        # Send to Ticket Channel with ticket creation button
+        ticket_channel_id = config.get("ticket")
+        if ticket_channel_id:
+            ticket_channel = guild.get_channel(ticket_channel_id)
+            if ticket_channel:
+                try:
+                    result = await publish_panel(guild, "ticket", ticket_channel, ticket_embed, TicketView(), registry.get((guild.id, "ticket")))
+                    if result != "skipped":
+                        print(f"✅ Ticket panel {result} in Ticket channel in {guild.name}")
+                except Exception as e:
+                    print(f"❌ Failed to send to Ticket channel in {guild.name}: {e}")
+                    
+    except Exception as e:
+        print(f"❌ Error sending startup messages to {guild.name}: {e}")
+
+@bot.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    # A deleted panel gets posted again on the next startup
+    if payload.message_id in panel_messages:
+        panel_messages.discard(payload.message_id)
+        await bot.db.execute("DELETE FROM panels WHERE message_id = ?", (payload.message_id,))
+
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    bot.tree.record_latency(interaction, "ok")
+    event_logger.log_command(interaction, command.qualified_name)
 
 # Error handling
 @bot.event
 async def on_error(event, *args, **kwargs):
+    event_errors.inc(event)
     print(f'An error occurred in {event}: {args}, {kwargs}')
 
 # Run the bot with your token
@@ -0,0 +1,64 @@
+"""Shared fixtures.
+
+`async def` tests run on the per-test `loop` fixture (no pytest-asyncio needed), and `db` gives each
+test a fresh, migrated SQLite file installed as `bot.db` with fresh in-memory caches around it.
+"""
+import asyncio
+import inspect
+
+import pytest
+
+import main
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    loop = pyfuncitem.funcargs["loop"]
+    kwargs = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+    loop.run_until_complete(pyfuncitem.obj(**kwargs))
+    return True
+
+def pytest_collection_modifyitems(items):
+    # Every coroutine test needs an event loop, whether or not it asks for the database
+    for item in items:
+        if inspect.iscoroutinefunction(getattr(item, "obj", None)) and "loop" not in item.fixturenames:
+            item.fixturenames.append("loop")
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+def reset_state(monkeypatch):
+    """Replace the module-level caches so no state leaks between tests."""
+    for name, factory in (
+        ("balance_cache", main.BalanceCache),
+        ("xp_aggregator", main.XPAggregator),
+        ("diamond_ledger", main.DiamondLedger),
+        ("event_logger", main.EventLogger),
+        ("transcript_index", main.TranscriptIndex),
+        ("xp_policy", main.XPPolicy),
+    ):
+        monkeypatch.setattr(main, name, factory())
+    monkeypatch.setattr(main, "xp_rankings", main.GuildRankings(main.xp_rankings.query, main.xp_rankings.key, main.xp_rankings.overlay))
+    monkeypatch.setattr(main, "diamond_rankings", main.GuildRankings(main.diamond_rankings.query, main.diamond_rankings.key))
+
+async def open_database(path: str, migrate: bool = True) -> main.Database:
+    main.bot.db = main.Database(path)
+    await main.bot.db.connect()
+    await main.bot.setup_database()
+    if migrate:
+        await main.run_migrations()
+    return main.bot.db
+
+@pytest.fixture
+def db(loop, tmp_path, monkeypatch):
+    reset_state(monkeypatch)
+    monkeypatch.setattr(main.bot, "db", None)
+    database = loop.run_until_complete(open_database(str(tmp_path / "test.db")))
+    yield database
+    loop.run_until_complete(database.close())
@@ -0,0 +1,82 @@
+"""Diamond ledger reconciliation: chained entries against live balances."""
+import pytest
+
+import main
+
+GUILD_ID = 1
+
+async def credit_users(user_ids):
+    for user_id in user_ids:
+        await main.add_diamonds(user_id, GUILD_ID, 100)
+        await main.add_diamonds(user_id, GUILD_ID, 50)
+        assert await main.remove_diamonds(user_id, GUILD_ID, 30) == 120
+
+async def reconcile_all() -> list[str]:
+    mismatches = []
+    while True:
+        checked, found = await main.reconcile_ledger_batch()
+        mismatches += found
+        if checked < main.LEDGER_RECONCILE_BATCH:
+            return mismatches
+
+@pytest.fixture(autouse=True)
+def small_batches(monkeypatch):
+    monkeypatch.setattr(main, "LEDGER_RECONCILE_BATCH", 25)
+    monkeypatch.setattr(main, "LEDGER_RECONCILE_CHUNK", 4)
+
+async def test_consistent_history_has_no_mismatches(db):
+    await credit_users(range(1, 21))
+    assert await reconcile_all() == []
+    assert await main.reconcile_ledger_batch() == (0, [])
+    row = await db.fetchone("SELECT count(*) FROM ledger_checkpoints")
+    assert row[0] == 20
+
+async def test_drifted_live_balance_is_reported(db):
+    await credit_users(range(1, 6))
+    # A balance changed behind the ledger's back
+    await db.execute("UPDATE diamonds SET balance = balance + 7 WHERE guild_id = ? AND user_id = 3", (GUILD_ID,))
+    assert await reconcile_all() == [f"guild {GUILD_ID}, user 3: balance 127 but ledger says 120"]
+
+async def test_drift_shows_up_as_a_broken_chain_on_the_next_entry(db):
+    await credit_users(range(1, 6))
+    assert await reconcile_all() == []
+    await db.execute("UPDATE diamonds SET balance = balance - 20 WHERE guild_id = ? AND user_id = 2", (GUILD_ID,))
+    await main.add_diamonds(2, GUILD_ID, 5)  # balance_after is now 105, but the chain expects 125
+    assert await reconcile_all() == [f"entry 16 (guild {GUILD_ID}, user 2): 120 +5 != 105"]
+
+async def test_users_with_newer_entries_wait_for_the_next_batch(db, monkeypatch):
+    monkeypatch.setattr(main, "LEDGER_RECONCILE_BATCH", 2)
+    await credit_users([1])
+    await db.execute("UPDATE diamonds SET balance = 0 WHERE guild_id = ? AND user_id = 1", (GUILD_ID,))
+    # The first two entries aren't the user's newest, so only the last batch compares the live balance
+    assert await main.reconcile_ledger_batch() == (2, [])
+    assert await main.reconcile_ledger_batch() == (1, [f"guild {GUILD_ID}, user 1: balance 0 but ledger says 120"])
+
+async def test_interrupted_run_resumes_without_false_mismatches(db, monkeypatch):
+    await credit_users(range(1, 9))  # 24 entries, two chunks of four users
+    await main.diamond_ledger.flush()  # so write_pending is only called once per chunk
+    write_pending = main.diamond_ledger.write_pending
+    calls = 0
+
+    async def fail_second_chunk(conn):
+        nonlocal calls
+        calls += 1
+        if calls == 2:
+            raise RuntimeError("interrupted")
+        await write_pending(conn)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(main.diamond_ledger, "write_pending", fail_second_chunk)
+        with pytest.raises(RuntimeError):
+            await main.reconcile_ledger_batch()
+
+    # The first chunk's checkpoints were committed but the batch marker wasn't
+    assert (await db.fetchone("SELECT count(*) FROM ledger_checkpoints"))[0] == 4
+    assert await db.fetchone("SELECT value FROM bot_state WHERE key = 'ledger_reconciled_through'") is None
+    assert await reconcile_all() == []
+
+async def test_buffered_entries_are_flushed_before_checking(db):
+    await credit_users(range(1, 4))
+    assert main.diamond_ledger.pending_count > 0
+    assert await reconcile_all() == []
+    assert main.diamond_ledger.pending_count == 0
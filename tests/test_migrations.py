@@ -0,0 +1,209 @@
+"""Online rebuild of the legacy user_id-keyed tables while the real write paths keep running."""
+import asyncio
+import random
+import sqlite3
+
+import main
+from tests.conftest import open_database, reset_state
+
+GUILD_ID = 1
+LEGACY_USERS = 3000
+
+def create_legacy_database(path: str):
+    """The pre-migration schema: users and diamonds keyed by user_id alone."""
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE users (user_id INTEGER PRIMARY KEY, guild_id INTEGER, "
+        "xp INTEGER DEFAULT 0, level INTEGER DEFAULT 0, messages INTEGER DEFAULT 0)"
+    )
+    conn.execute(
+        "CREATE TABLE diamonds (user_id INTEGER PRIMARY KEY, guild_id INTEGER, balance INTEGER DEFAULT 0, "
+        "last_daily TIMESTAMP, daily_streak INTEGER DEFAULT 0, total_earned INTEGER DEFAULT 0, multiplier REAL DEFAULT 1.0)"
+    )
+    conn.executemany(
+        "INSERT INTO users (user_id, guild_id, xp, level, messages) VALUES (?, ?, ?, 0, 1)",
+        [(user_id, GUILD_ID, user_id % 90) for user_id in range(1, LEGACY_USERS + 1)]
+    )
+    conn.executemany(
+        "INSERT INTO diamonds (user_id, guild_id, balance, total_earned) VALUES (?, ?, 100, 100)",
+        [(user_id, GUILD_ID) for user_id in range(1, LEGACY_USERS + 1)]
+    )
+    conn.commit()
+    conn.close()
+
+async def backfilling(db: main.Database) -> bool:
+    row = await db.fetchone("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name IN ('users_new', 'diamonds_new')")
+    return row[0] > 0
+
+async def test_rebuild_under_concurrent_writes(loop, tmp_path, monkeypatch):
+    reset_state(monkeypatch)
+    monkeypatch.setattr(main, "MIGRATION_CHUNK_SIZE", 200)
+    monkeypatch.setattr(main, "MIGRATION_CHUNK_PAUSE", 0)
+    path = str(tmp_path / "legacy.db")
+    create_legacy_database(path)
+    db = await open_database(path, migrate=False)
+    try:
+        assert main.legacy_keyed_tables == {"users", "diamonds"}
+
+        # What each table must hold afterwards: user_id -> (xp, level, messages) / (balance, total_earned, multiplier)
+        users = {user_id: [user_id % 90, 0, 1] for user_id in range(1, LEGACY_USERS + 1)}
+        diamonds = {user_id: [100, 100, 1.0] for user_id in range(1, LEGACY_USERS + 1)}
+        rng = random.Random(7)
+        writes_during_backfill = 0
+
+        migration = asyncio.create_task(main.run_migrations())
+        await asyncio.sleep(0)
+        step = 0
+        while not migration.done():
+            during = await backfilling(db)
+            user_id = rng.randint(1, LEGACY_USERS + 100)  # mostly existing rows, some new members
+            operation = step % 4
+            step += 1
+
+            if operation == 0:
+                balance = await main.add_diamonds(user_id, GUILD_ID, 5)
+                row = diamonds.setdefault(user_id, [0, 0, 1.0])
+                row[0] += 5
+                row[1] += 5
+                assert balance == row[0]
+            elif operation == 1:
+                balance = await main.remove_diamonds(user_id, GUILD_ID, 3)
+                row = diamonds.get(user_id)
+                if row and row[0] >= 3:
+                    row[0] -= 3
+                    assert balance == row[0]
+                else:
+                    assert balance is None
+            elif operation == 2:
+                await main.xp_policy.set_multiplier(GUILD_ID, user_id, 2.0)
+                diamonds.setdefault(user_id, [0, 0, 1.0])[2] = 2.0
+            else:
+                await main.xp_aggregator.add_xp(GUILD_ID, user_id, 10)
+                row = users.setdefault(user_id, [0, 0, 0])
+                row[0] += 10
+                row[2] += 1
+                if row[0] >= (row[1] + 1) * 100:
+                    row[1] += 1
+                if step % 20 == 3:
+                    await main.xp_aggregator.flush()
+
+            writes_during_backfill += during
+            await asyncio.sleep(0)
+        await migration
+        await main.xp_aggregator.flush()
+
+        assert writes_during_backfill > 20
+        assert (await db.fetchone("PRAGMA user_version"))[0] == max(version for version, _, _ in main.MIGRATIONS)
+        assert await main.primary_key_columns(db, "users") == ["guild_id", "user_id"]
+        assert await main.primary_key_columns(db, "diamonds") == ["guild_id", "user_id"]
+        assert await db.fetchall("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE '%mirror%'") == []
+        assert main.legacy_keyed_tables == set()
+
+        rows = await db.fetchall("SELECT user_id, xp, level, messages FROM users WHERE guild_id = ?", (GUILD_ID,))
+        assert {user_id: list(values) for user_id, *values in rows} == users
+        rows = await db.fetchall("SELECT user_id, balance, total_earned, multiplier FROM diamonds WHERE guild_id = ?", (GUILD_ID,))
+        assert {user_id: list(values) for user_id, *values in rows} == diamonds
+
+        # With the composite key in place, the same member in another guild gets their own row
+        assert await main.add_diamonds(1, GUILD_ID + 1, 7) == 7
+        assert await main.get_user_diamonds(1, GUILD_ID) == diamonds[1][0]
+    finally:
+        await db.close()
+
+async def test_member_in_another_guild_on_the_legacy_key(loop, tmp_path, monkeypatch):
+    reset_state(monkeypatch)
+    path = str(tmp_path / "legacy.db")
+    create_legacy_database(path)
+    db = await open_database(path, migrate=False)
+    try:
+        assert await main.get_user_diamonds(42, GUILD_ID) == 100
+        # One row per member until the swap: crediting guild 2 takes it over, as INSERT OR REPLACE did
+        assert await main.add_diamonds(42, GUILD_ID + 1, 100) == 100
+        assert await main.add_diamonds(42, GUILD_ID + 1, 5) == 105
+        assert await main.get_user_diamonds(42, GUILD_ID) == 0
+        assert await db.fetchall("SELECT guild_id, balance, total_earned FROM diamonds WHERE user_id = 42") == [(GUILD_ID + 1, 105, 105)]
+
+        await main.run_migrations()
+        assert await main.add_diamonds(43, GUILD_ID + 1, 100) == 100
+        assert await main.get_user_diamonds(43, GUILD_ID) == 100
+    finally:
+        await db.close()
+
+async def test_crediting_another_guild_during_rebuild(loop, tmp_path, monkeypatch):
+    reset_state(monkeypatch)
+    monkeypatch.setattr(main, "MIGRATION_CHUNK_SIZE", 200)
+    monkeypatch.setattr(main, "MIGRATION_CHUNK_PAUSE", 0)
+    path = str(tmp_path / "legacy.db")
+    create_legacy_database(path)
+    db = await open_database(path, migrate=False)
+    try:
+        other_guild = {}
+        rng = random.Random(11)
+        migration = asyncio.create_task(main.run_migrations())
+        await asyncio.sleep(0)
+        while not migration.done():
+            user_id = rng.randint(1, LEGACY_USERS)
+            other_guild[user_id] = other_guild.get(user_id, 0) + 5
+            assert await main.add_diamonds(user_id, GUILD_ID + 1, 5) == other_guild[user_id]
+            await asyncio.sleep(0)
+        await migration
+
+        assert await main.primary_key_columns(db, "diamonds") == ["guild_id", "user_id"]
+        rows = await db.fetchall("SELECT user_id, balance FROM diamonds WHERE guild_id = ?", (GUILD_ID + 1,))
+        assert dict(rows) == other_guild
+    finally:
+        await db.close()
+
+async def test_multiplier_for_a_member_in_another_guild_on_the_legacy_key(loop, tmp_path, monkeypatch):
+    reset_state(monkeypatch)
+    path = str(tmp_path / "legacy.db")
+    create_legacy_database(path)
+    db = await open_database(path, migrate=False)
+    try:
+        await main.xp_policy.set_multiplier(GUILD_ID, 42, 2.0)
+        await main.xp_policy.set_multiplier(GUILD_ID + 1, 42, 3.0)
+        assert await db.fetchall("SELECT guild_id, balance, multiplier FROM diamonds WHERE user_id = 42") == [(GUILD_ID + 1, 0, 3.0)]
+        assert main.xp_policy._multipliers == {(GUILD_ID + 1, 42): 3.0}
+        assert await main.get_user_diamonds(42, GUILD_ID) == 0
+
+        await main.run_migrations()
+        await main.xp_policy.set_multiplier(GUILD_ID + 1, 43, 1.5)
+        assert await db.fetchall("SELECT guild_id, multiplier FROM diamonds WHERE user_id = 43 ORDER BY guild_id") == [
+            (GUILD_ID, 1.0), (GUILD_ID + 1, 1.5)
+        ]
+    finally:
+        await db.close()
+
+async def test_xp_for_a_member_in_another_guild_waits_for_the_composite_key(loop, tmp_path, monkeypatch):
+    reset_state(monkeypatch)
+    path = str(tmp_path / "legacy.db")
+    create_legacy_database(path)
+    db = await open_database(path, migrate=False)
+    try:
+        aggregator = main.xp_aggregator
+        await aggregator.add_xp(GUILD_ID, 41, 10)
+        await aggregator.add_xp(GUILD_ID + 1, 42, 10)
+        await aggregator.flush()
+        # Guild 1's row for member 42 must survive; guild 2's gain stays in memory instead
+        assert await db.fetchall("SELECT guild_id, xp, messages FROM users WHERE user_id IN (41, 42) ORDER BY user_id") == [
+            (GUILD_ID, 51, 2), (GUILD_ID, 42, 1)
+        ]
+        assert aggregator.pending(GUILD_ID + 1) == [(42, 0, 10)]
+        assert await aggregator.get_stats(GUILD_ID + 1, 42) == (10, 0, 1)
+
+        await main.run_migrations()
+        await aggregator.flush()
+        assert aggregator.dirty_count == 0
+        assert await db.fetchall("SELECT guild_id, xp, messages FROM users WHERE user_id = 42 ORDER BY guild_id") == [
+            (GUILD_ID, 42, 1), (GUILD_ID + 1, 10, 1)
+        ]
+    finally:
+        await db.close()
+
+async def test_stale_legacy_flag_is_refreshed_before_flushing(db):
+    # Another process migrated the table after this one started
+    main.legacy_keyed_tables.add("users")
+    await main.xp_aggregator.add_xp(GUILD_ID, 1, 10)
+    await main.xp_aggregator.flush()
+    assert main.legacy_keyed_tables == set()
+    assert await db.fetchone("SELECT xp FROM users WHERE guild_id = ? AND user_id = 1", (GUILD_ID,)) == (10,)
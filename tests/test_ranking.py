@@ -0,0 +1,63 @@
+"""RankIndex against a plain sorted list of the same keys."""
+import random
+
+import pytest
+
+import main
+
+@pytest.fixture(autouse=True)
+def small_buckets(monkeypatch):
+    # Tiny buckets so splits, empty buckets and page boundaries all happen with a few hundred keys
+    monkeypatch.setattr(main.RankIndex, "BUCKET_SIZE", 4)
+
+def xp_key(user_id: int, level: int, xp: int) -> tuple:
+    return (-level, -xp, user_id)
+
+def check(index: main.RankIndex, keys: dict[int, tuple]):
+    oracle = sorted(keys.values())
+    assert len(index) == len(oracle)
+    for member, key in keys.items():
+        assert member in index
+        assert index.rank(member) == oracle.index(key) + 1
+    for start in range(0, len(oracle) + 3, 7):
+        assert index.slice(start, main.LEADERBOARD_PAGE_SIZE) == oracle[start:start + main.LEADERBOARD_PAGE_SIZE]
+
+def test_insert_update_remove_match_sorted_list():
+    rng = random.Random(20)
+    index = main.RankIndex()
+    keys: dict[int, tuple] = {}
+    for step in range(3000):
+        member = rng.randint(1, 300)
+        if rng.random() < 0.1:
+            index.remove(member)
+            keys.pop(member, None)
+        else:
+            key = xp_key(member, rng.randint(0, 20), rng.randint(0, 99))
+            index.update(member, key)
+            keys[member] = key
+        if step % 250 == 0:
+            check(index, keys)
+    check(index, keys)
+
+def test_ties_are_broken_by_member_id():
+    index = main.RankIndex()
+    for member in (30, 10, 20):
+        index.update(member, xp_key(member, 5, 50))
+    assert [index.rank(member) for member in (10, 20, 30)] == [1, 2, 3]
+
+def test_setdefault_keeps_newer_key():
+    index = main.RankIndex()
+    index.update(1, xp_key(1, 9, 0))
+    index.setdefault(1, xp_key(1, 1, 0))  # a stale row loaded from disk
+    index.setdefault(2, xp_key(2, 3, 0))
+    assert index.rank(1) == 1 and index.rank(2) == 2
+
+def test_missing_members_and_out_of_range_pages():
+    index = main.RankIndex()
+    assert index.rank(1) is None
+    assert index.slice(0, 10) == []
+    index.update(1, xp_key(1, 0, 10))
+    index.remove(2)  # not ranked: no-op
+    assert index.slice(-1, 10) == []
+    assert index.slice(1, 10) == []
+    assert index.slice(0, 10) == [xp_key(1, 0, 10)]
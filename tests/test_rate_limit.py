@@ -0,0 +1,58 @@
+"""TokenBucketLimiter burst, refill and eviction on a controlled clock."""
+import pytest
+
+import main
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    return clock
+
+def test_burst_then_retry_after(clock):
+    limiter = main.TokenBucketLimiter(rate=0.5, burst=3)
+    assert [limiter.acquire("a") for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.acquire("a") == pytest.approx(2.0)  # one token takes 1 / rate seconds
+    clock.now += 1.0
+    assert limiter.acquire("a") == pytest.approx(1.0)
+
+def test_refill_is_gradual_and_capped_at_burst(clock):
+    limiter = main.TokenBucketLimiter(rate=0.5, burst=3)
+    for _ in range(3):
+        limiter.acquire("a")
+    clock.now += 2.0
+    assert limiter.acquire("a") == 0.0
+    assert limiter.acquire("a") > 0
+
+    clock.now += 1000.0  # far longer than a full refill
+    assert [limiter.acquire("a") for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.acquire("a") > 0
+
+def test_keys_are_independent(clock):
+    limiter = main.TokenBucketLimiter(rate=0.5, burst=1)
+    assert limiter.acquire(("user", 1)) == 0.0
+    assert limiter.acquire(("user", 1)) > 0
+    assert limiter.acquire(("user", 2)) == 0.0
+
+def test_idle_buckets_are_evicted(clock):
+    limiter = main.TokenBucketLimiter(rate=1.0, burst=2, ttl=60)
+    for key in range(5):
+        limiter.acquire(key)
+    clock.now += 30
+    limiter.acquire(0)  # refreshed, so it survives
+    clock.now += 31
+    limiter.acquire("new")
+    assert len(limiter) == 2
+    # An evicted bucket comes back full
+    assert [limiter.acquire(1), limiter.acquire(1)] == [0.0, 0.0]
+
+def test_ttl_never_shorter_than_a_full_refill():
+    limiter = main.TokenBucketLimiter(rate=0.1, burst=5, ttl=1)
+    assert limiter.ttl == 50
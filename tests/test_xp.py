@@ -0,0 +1,81 @@
+"""XPAggregator write-behind semantics."""
+import asyncio
+
+import pytest
+
+import main
+
+GUILD_ID = 1
+
+async def stored(user_id: int):
+    return await main.bot.db.fetchone(
+        "SELECT xp, level, messages FROM users WHERE guild_id = ? AND user_id = ?", (GUILD_ID, user_id)
+    )
+
+async def test_gains_stay_in_memory_until_flush(db):
+    aggregator = main.xp_aggregator
+    assert await aggregator.add_xp(GUILD_ID, 1, 60) == (0, False)
+    assert await aggregator.add_xp(GUILD_ID, 1, 60) == (1, True)
+
+    assert await stored(1) is None
+    assert await aggregator.get_stats(GUILD_ID, 1) == (120, 1, 2)
+    assert aggregator.pending(GUILD_ID) == [(1, 1, 120)]
+    assert aggregator.dirty_count == 1
+
+    await aggregator.flush()
+    assert await stored(1) == (120, 1, 2)
+    assert aggregator.dirty_count == 0
+    assert aggregator.pending(GUILD_ID) == []
+
+async def test_gains_merge_onto_the_stored_row(db):
+    await db.execute("INSERT INTO users (guild_id, user_id, xp, level, messages) VALUES (?, 2, 95, 0, 40)", (GUILD_ID,))
+    aggregator = main.xp_aggregator
+    assert await aggregator.add_xp(GUILD_ID, 2, 10) == (1, True)
+    await aggregator.flush()
+    assert await stored(2) == (105, 1, 41)
+
+async def test_failed_flush_keeps_users_dirty(db, monkeypatch):
+    aggregator = main.xp_aggregator
+    await aggregator.add_xp(GUILD_ID, 3, 10)
+
+    async def fail(*args, **kwargs):
+        raise RuntimeError("disk full")
+    with monkeypatch.context() as patch:
+        patch.setattr(db, "executemany", fail)
+        with pytest.raises(RuntimeError):
+            await aggregator.flush()
+    assert aggregator.dirty_count == 1
+
+    await aggregator.add_xp(GUILD_ID, 3, 10)
+    await aggregator.flush()
+    assert await stored(3) == (20, 0, 2)
+
+async def test_threshold_starts_a_background_flush(db, monkeypatch):
+    monkeypatch.setattr(main, "XP_FLUSH_THRESHOLD", 3)
+    aggregator = main.xp_aggregator
+    for user_id in (10, 11, 12):
+        await aggregator.add_xp(GUILD_ID, user_id, 5)
+    assert aggregator._flush_task is not None
+    await aggregator._flush_task
+    assert aggregator.dirty_count == 0
+    assert [await stored(user_id) for user_id in (10, 11, 12)] == [(5, 0, 1)] * 3
+
+async def test_eviction_never_drops_unflushed_users(db, monkeypatch):
+    monkeypatch.setattr(main, "XP_CACHE_SIZE", 2)
+    aggregator = main.xp_aggregator
+    for user_id in range(20, 25):
+        await aggregator.add_xp(GUILD_ID, user_id, 5)
+    await aggregator.flush()
+    assert len(aggregator._state) == 2  # clean entries trimmed to the cache size after the write
+
+    await aggregator.add_xp(GUILD_ID, 30, 5)
+    await aggregator.add_xp(GUILD_ID, 31, 5)
+    await aggregator.add_xp(GUILD_ID, 32, 5)
+    aggregator._evict()
+    assert {(GUILD_ID, user_id) for user_id in (30, 31, 32)} <= set(aggregator._state)
+
+async def test_concurrent_first_messages_share_one_state(db):
+    aggregator = main.xp_aggregator
+    await asyncio.gather(*(aggregator.add_xp(GUILD_ID, 40, 10) for _ in range(5)))
+    await aggregator.flush()
+    assert await stored(40) == (50, 0, 5)